@@ -3,6 +3,7 @@ import signal
 import sys
 import uvicorn
 import httpx
+import threading
 from collections.abc import Callable
 from fastapi import (
     FastAPI,
@@ -13,10 +14,13 @@ from contextlib import asynccontextmanager
 
 # Custom
 from embeddings import storage as vector_storage
-from core import common, classes
+from core import common, classes, settings_store
 from services.route import router as services
 from embeddings.route import router as embeddings
-from inference.route import router as text_inference
+from inference.route import router as text_inference, load_model as load_text_model
+from inference import batch_jobs, lora_adapters, preload, remote_tools, tool_executor
+from inference import model_downloads, model_quota
+from inference.scheduler import scheduler
 from storage.route import router as storage
 
 
@@ -33,12 +37,15 @@ class ApiServer:
         selected_webui_url: str = "",
         SSL_ENABLED: bool | None = None,
         on_startup_callback: Callable | None = None,
+        PRELOAD_MODELS: bool | None = None,
     ):
         # Init logic here
         self.remote_url = remote_url
         self.SERVER_HOST = SERVER_HOST or "0.0.0.0"
         self.SERVER_PORT = SERVER_PORT or 8008
         self.SSL_ENABLED = SSL_ENABLED or common.get_ssl_env()
+        # Load the most used models in the background on startup
+        self.PRELOAD_MODELS = PRELOAD_MODELS or preload.get_preload_env()
         if self.SSL_ENABLED:
             self.XHR_PROTOCOL = "https"
         else:
@@ -92,10 +99,27 @@ class ApiServer:
             app.state.path_to_model = ""  # Set each time user loads a model
             app.state.model_id = ""
             app.state.embed_model = None
+            app.state.embedding_batcher = None
             app.state.loaded_text_model_data = {}
             app.state.is_prod = self.is_prod
             app.state.is_dev = self.is_dev
             app.state.is_debug = self.is_debug
+            # Warm up the tool worker processes without delaying startup
+            threading.Thread(
+                target=tool_executor.get_executor().start, daemon=True
+            ).start()
+            # Swap in the LoRA adapter a request asked for when it gets the model
+            scheduler.add_acquire_hook(lora_adapters.activate_requested)
+            # Continue unfinished batch jobs
+            batch_jobs.get_manager().start(app)
+            # The loaded model is never evicted by the disk quota
+            model_quota.quota.attach(app)
+            # Continue unfinished model downloads
+            model_downloads.get_manager().start()
+
+            # Runs in a thread, /v1/connect answers right away
+            if self.PRELOAD_MODELS:
+                preload.preloader.start(app, load_text_model)
 
             # Tell front-end to go to webui
             if self.on_startup_callback:
@@ -104,6 +128,14 @@ class ApiServer:
             yield
             # Do shutdown cleanup here...
             print(f"{common.PRNT_API} Lifespan shutdown", flush=True)
+            preload.preloader.stop()
+            await batch_jobs.get_manager().stop()
+            await model_downloads.get_manager().stop()
+            tool_executor.shutdown()
+            lora_adapters.get_manager().files.clear()
+            remote_tools.shutdown()
+            # Write settings changes that are still pending
+            settings_store.flush_all()
 
         # Create FastAPI instance
         app_inst = FastAPI(
@@ -6,7 +6,7 @@ from chromadb import Collection
 from chromadb.api import ClientAPI
 from llama_index.llms.llama_cpp import LlamaCPP
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from inference.classes import RetrievalTypes
+from inference.classes import EmbeddingEncodings, RetrievalTypes, ToolCallModes
 
 DEFAULT_TEMPERATURE = 0.2
 DEFAULT_CONTEXT_WINDOW = 2000
@@ -22,6 +22,7 @@ class AppState(dict):
     path_to_model: str
     model_id: str
     embed_model: HuggingFaceEmbedding | str
+    embedding_batcher: object | None
     loaded_text_model_data: dict
 
 
@@ -78,6 +79,12 @@ class LoadTextInferenceInit(BaseModel):
     use_mmap: Optional[bool] = True
     use_mlock: Optional[bool] = False
     f16_kv: Optional[bool] = True
+    type_k: Optional[str] = (
+        None  # KV cache types: f32, f16 (default), q8_0, q5_1, q5_0, q4_1, q4_0
+    )
+    type_v: Optional[str] = None
+    flash_attn: Optional[bool] = False
+    load_policy: Optional[str] = None  # lazy, prefetch or mlock (use_mlock)
     seed: Optional[int] = DEFAULT_SEED
     n_ctx: Optional[int] = DEFAULT_CONTEXT_WINDOW
     n_batch: Optional[int] = 512
@@ -109,6 +116,8 @@ class LoadInferenceRequest(BaseModel):
     modelPath: str
     modelId: str
     mode: Optional[str] = DEFAULT_CHAT_MODE
+    # Which text inference backend to load with ("llama_cpp", "fake")
+    backend: Optional[str] = None
     # __init__ args - https://llama-cpp-python.readthedocs.io/en/latest/api-reference/
     init: LoadTextInferenceInit
     # __call__ args
@@ -118,7 +127,7 @@ class LoadInferenceRequest(BaseModel):
 class LoadInferenceResponse(BaseModel):
     message: str
     success: bool
-    data: NoneType
+    data: Optional[dict] = None  # {"kvCache": memory used by the KV cache}
 
     model_config = {
         "json_schema_extra": {
@@ -177,6 +186,37 @@ class GetModelInfoRequest(BaseModel):
 class DownloadTextModelRequest(BaseModel):
     repo_id: str
     filename: str
+    segments: Optional[int] = None  # parallel HTTP range requests, DOWNLOAD_SEGMENTS
+    maxMbPerSec: Optional[float] = None  # bandwidth cap, DOWNLOAD_MAX_MB_PER_SEC
+
+
+class ModelDownload(BaseModel):
+    id: str
+    repo_id: str
+    filename: str
+    status: str  # queued, downloading, verifying, paused, completed, failed
+    size: Optional[int] = None
+    downloaded: int
+    percent: float
+    mb_per_sec: float
+    eta_secs: Optional[int] = None
+    sha256: Optional[str] = None
+    file_path: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
+
+class ModelDownloadResponse(BaseModel):
+    success: bool
+    message: str
+    data: Optional[ModelDownload] = None
+
+
+class ModelDownloadsResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[ModelDownload]
 
 
 class DeleteTextModelRequest(BaseModel):
@@ -184,6 +224,17 @@ class DeleteTextModelRequest(BaseModel):
     repoId: str
 
 
+class PinTextModelRequest(BaseModel):
+    filename: str
+    repoId: str
+    pinned: bool = True
+
+
+class ChatHistoryMessage(BaseModel):
+    role: str  # system, user or assistant
+    content: str
+
+
 class InferenceRequest(BaseModel):
     # __init__ args
     n_ctx: Optional[int] = DEFAULT_CONTEXT_WINDOW
@@ -192,6 +243,13 @@ class InferenceRequest(BaseModel):
     collectionNames: Optional[List[str]] = []
     tools: Optional[List[str]] = []
     retrievalType: Optional[RetrievalTypes | None] = None
+    toolCallMode: Optional[ToolCallModes | None] = None  # parse unless set
+    maxAgentSteps: Optional[int] = (
+        None  # Model replies (tool calls or answer) per agent turn
+    )
+    agentTokenBudget: Optional[int] = (
+        None  # Generated tokens allowed across all agent steps
+    )
     mode: Optional[str] = DEFAULT_CHAT_MODE
     systemMessage: Optional[str] = None
     messageFormat: Optional[str] = None
@@ -199,8 +257,15 @@ class InferenceRequest(BaseModel):
     ragPromptTemplate: Optional[RagTemplateData] = None
     # __call__ args
     prompt: str
-    messages: Optional[List[str]] = []
+    messages: Optional[List[ChatHistoryMessage | str]] = []
+    threadId: Optional[str] = None  # Saved thread, its summary replaces older messages
+    # Registered LoRA adapter to apply, "" for the base model, none keeps the active one
+    loraAdapter: Optional[str] = None
     stream: Optional[bool] = True
+    n: Optional[int] = (
+        1  # Candidates to generate for the prompt (instruct, not streamed)
+    )
+    selectBest: Optional[bool] = False  # Return the most likely candidate as the text
     # suffix: Optional[str] = ""
     temperature: Optional[float] = 0.0  # precise
     max_tokens: Optional[int] = DEFAULT_MAX_TOKENS
@@ -211,7 +276,9 @@ class InferenceRequest(BaseModel):
     model: Optional[str] = (
         "local"  # The name to use for the model in the completion object
     )
-    grammar: Optional[dict] = None  # A grammar to use for constrained sampling
+    grammar: Optional[dict] = (
+        None  # A grammar to use for constrained sampling. A JSON schema or {"gbnf": "..."}
+    )
     mirostat_tau: Optional[float] = (
         5.0  # A higher value corresponds to more surprising or less predictable text, while a lower value corresponds to less surprising or more predictable text.
     )
@@ -294,6 +361,160 @@ class InferenceResponse(BaseModel):
     }
 
 
+class EmbeddingRequest(BaseModel):
+    texts: List[str]
+    encoding: Optional[EmbeddingEncodings] = EmbeddingEncodings.FLOAT
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "texts": ["Why is the sky blue?", "Rayleigh scattering"],
+                    "encoding": "float",
+                }
+            ]
+        }
+    }
+
+
+class EmbeddingResData(BaseModel):
+    embeddings: List[List[float]] | List[str]
+    dimensions: int
+    encoding: EmbeddingEncodings
+
+
+class EmbeddingResponse(BaseModel):
+    success: bool
+    message: str
+    data: EmbeddingResData
+
+
+class CopilotRequest(BaseModel):
+    prefix: str  # code before the cursor
+    suffix: Optional[str] = ""  # code after the cursor
+    clientId: Optional[str] = (
+        None  # a newer request from the same client cancels this one
+    )
+    fimFormat: Optional[str] = (
+        None  # codellama, starcoder, deepseek, ... detected from the model when empty
+    )
+    max_tokens: Optional[int] = 64
+    temperature: Optional[float] = 0.0
+    stop: Optional[List[str]] = []
+    multiline: Optional[bool] = True  # False stops at the end of the line
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "prefix": "def fibonacci(n):\n    ",
+                    "suffix": "\n\nprint(fibonacci(10))\n",
+                    "clientId": "editor-1",
+                }
+            ]
+        }
+    }
+
+
+class CopilotResData(BaseModel):
+    text: str
+    tokens: int
+    elapsed_ms: float
+
+
+class CopilotResponse(BaseModel):
+    success: bool
+    message: str
+    data: Optional[CopilotResData] = None
+
+
+class BatchJob(BaseModel):
+    id: str
+    name: str
+    status: str  # queued, running, paused, completed, failed
+    total: int
+    completed: int
+    failed: int
+    error: Optional[str] = None
+    created_at: float
+    updated_at: float
+
+
+class BatchJobResponse(BaseModel):
+    success: bool
+    message: str
+    data: Optional[BatchJob] = None
+
+
+class BatchJobsResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[BatchJob]
+
+
+class LoraAdapter(BaseModel):
+    name: str
+    path: str  # adapter file (.gguf or .bin)
+    scale: Optional[float] = 1.0
+    base: Optional[str] = (
+        None  # f16 model the quantized model was made from, removes adapters without drift
+    )
+
+
+class LoraAdapterResponse(BaseModel):
+    success: bool
+    message: str
+    data: Optional[LoraAdapter] = None
+
+
+class LoraAdaptersResponse(BaseModel):
+    success: bool
+    message: str
+    data: List[LoraAdapter]
+
+
+class ExtractionRequest(BaseModel):
+    text: Optional[str] = None
+    documents: Optional[List[str]] = None  # bulk mode, run at batch priority
+    jsonSchema: Optional[dict] = None
+    schemaId: Optional[str] = None  # name or id of a tool, its Params schema is used
+    promptTemplate: Optional[str] = None  # placeholders: {text} and {schema}
+    systemMessage: Optional[str] = None
+    messageFormat: Optional[str] = None
+    max_tokens: Optional[int] = None
+
+    model_config = {
+        "json_schema_extra": {
+            "examples": [
+                {
+                    "text": "Jane Doe, 34, lives in Lisbon.",
+                    "jsonSchema": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "age": {"type": "integer"},
+                            "city": {"type": "string"},
+                        },
+                        "required": ["name", "age", "city"],
+                    },
+                }
+            ]
+        }
+    }
+
+
+class ExtractionResult(BaseModel):
+    success: bool
+    data: Optional[dict] = None
+    errors: List[str] = []
+
+
+class ExtractionResponse(BaseModel):
+    success: bool
+    message: str
+    data: ExtractionResult | List[ExtractionResult]
+
+
 class PreProcessRequest(BaseModel):
     document_id: Optional[str] = ""
     document_name: str
@@ -658,6 +879,10 @@ class PerformanceSettings(BaseModel):
     offload_kqv: bool = None
     chat_format: str = None
     f16_kv: bool = None
+    type_k: str = None
+    type_v: str = None
+    flash_attn: bool = None
+    load_policy: str = None
 
 
 class ToolsSettings(BaseModel):
@@ -673,6 +898,7 @@ class ModelSettings(BaseModel):
     id: str = None  # @TODO change to modelId
     filename: str = None
     botName: Optional[str] = None
+    loraAdapter: Optional[str] = None  # Applied to the loaded model for this bot
 
 
 class PromptSettings(BaseModel):
@@ -704,12 +930,20 @@ class ToolDefinition(BaseModel):
     example_arguments: Optional[dict | None] = None
     id: Optional[str] = None
     description: Optional[str] = ""
+    cacheable: Optional[bool] = (
+        False  # Pure tool, same arguments always give the same result
+    )
+    cache_ttl: Optional[float] = (
+        None  # Seconds a cached result is reused, None uses the default
+    )
 
 
 class ToolSaveRequest(BaseModel):
     name: str
     path: str
     id: Optional[str] = None  # pass string to edit tool, leave blank to add new tool
+    cacheable: Optional[bool] = False
+    cache_ttl: Optional[float] = None
 
     @field_validator("id")
     @classmethod
@@ -787,6 +1021,12 @@ class InstalledTextModelMetadata(BaseModel):
     savePath: Optional[str | dict] = None
     numTimesRun: Optional[int] = None
     isFavorited: Optional[bool] = None
+    # filename -> size (bytes) and revision, from the model cache index
+    files: Optional[dict] = None
+    # filename -> last load time (unix secs)
+    lastLoaded: Optional[dict] = None
+    # Filenames the disk quota never evicts
+    pinned: Optional[List[str]] = None
 
     model_config = {
         "json_schema_extra": {
@@ -899,8 +1139,11 @@ class InstalledTextModelResponse(BaseModel):
 class LoadedTextModelResData(BaseModel):
     modelId: str
     mode: str = None
+    backend: str = None
     modelSettings: LoadTextInferenceInit
     generateSettings: LoadTextInferenceCall
+    kvCache: Optional[dict] = None
+    loadPolicy: Optional[str] = None
 
 
 class LoadedTextModelResponse(BaseModel):
@@ -1,8 +1,10 @@
 import re
 import sys
 import os
+import copy
 import json
 import glob
+import time
 import httpx
 import subprocess
 from typing import Any, List, Optional, Tuple
@@ -14,13 +16,7 @@ from core.classes import (
     DEFAULT_CHAT_MODE,
     DEFAULT_CONTEXT_WINDOW,
 )
-from huggingface_hub import (
-    scan_cache_dir,
-    try_to_load_from_cache,
-    _CACHED_NO_EXIST,
-    HFCacheInfo,
-    CachedFileInfo,
-)
+from core import settings_store
 
 
 # Pass relative string to get absolute path
@@ -50,11 +46,18 @@ TOOL_PATH = app_path(TOOL_FOLDER)
 TOOL_DEFS_PATH = os.path.join(TOOL_PATH, "defs")
 TOOL_PREBUILT_PATH = os.path.join(TOOL_FOLDER, TOOL_FUNCS_FOLDER)
 TOOL_FUNCS_PATH = os.path.join(TOOL_PATH, TOOL_FUNCS_FOLDER)
+BATCH_JOBS_FOLDER = "batch_jobs"
+BATCH_JOBS_PATH = app_path(BATCH_JOBS_FOLDER)
+DOWNLOADS_FOLDER = "downloads"
+DOWNLOADS_PATH = app_path(DOWNLOADS_FOLDER)
+THREADS_FOLDER = "threads"
+THREADS_PATH = app_path(THREADS_FOLDER)
 MODEL_METADATAS_FILEPATH = os.path.join(APP_SETTINGS_PATH, MODEL_METADATAS_FILENAME)
 TEXT_MODELS_CACHE_DIR = "text_models"
 INSTALLED_TEXT_MODELS = "installed_text_models"  # key in json file
 DEFAULT_SETTINGS_DICT = {"current_download_path": "", INSTALLED_TEXT_MODELS: []}
 DEFAULT_MAX_TOKENS = 128
+DEFAULT_TEXT_BACKEND = "llama_cpp"
 
 
 # Colors for logging
@@ -163,48 +166,6 @@ async def get_file_from_url(url: str, pathname: str, app):
     return True
 
 
-def check_cached_file_exists(cache_dir: str, repo_id: str, filename: str):
-    filepath = try_to_load_from_cache(
-        cache_dir=cache_dir, repo_id=repo_id, filename=filename
-    )
-    if isinstance(filepath, str):
-        # file exists and is cached
-        print(f"{PRNT_API} File exists: {filepath}", flush=True)
-    elif filepath is _CACHED_NO_EXIST:
-        # non-existence of file is cached
-        err = "File non-existence has been recorded."
-        print(f"{PRNT_API} {err}", flush=True)
-        raise Exception(err)
-    else:
-        # file is not cached
-        err = "File not cached."
-        print(f"{PRNT_API} {err}", flush=True)
-        raise Exception(err)
-
-
-# Find the specified model repo and return all revisions
-def scan_cached_repo(cache_dir: str, repo_id: str) -> Tuple[HFCacheInfo, list]:
-    # Pass nothing to scan the default dir
-    model_cache_info = scan_cache_dir(cache_dir)
-    repos = model_cache_info.repos
-    repoIndex = next(
-        (x for x, info in enumerate(repos) if info.repo_id == repo_id), None
-    )
-    target_repo = list(repos)[repoIndex]
-    repo_revisions = list(target_repo.revisions)
-    return [model_cache_info, repo_revisions]
-
-
-def get_cached_blob_path(repo_revisions: list, filename: str):
-    for r in repo_revisions:
-        files: List[CachedFileInfo] = list(r.files)
-        for file in files:
-            if file.file_name == filename:
-                # CachedFileInfo: file.blob_path same as -> file.file_path.resolve()
-                actual_path = str(file.blob_path)
-                return actual_path
-
-
 # Determine if the input string is acceptable as an id
 def check_valid_id(input: str):
     l = len(input)
@@ -286,99 +247,120 @@ class SaveTextModelRequestArgs(dict):
 # Index the path of the downloaded model in a file
 def save_text_model(data: SaveTextModelRequestArgs):
     repo_id = data["repoId"]
-    folderpath = APP_SETTINGS_PATH
-    filepath = MODEL_METADATAS_FILEPATH
-    existing_data = DEFAULT_SETTINGS_DICT
 
-    try:
-        # Create folder
-        if not os.path.exists(folderpath):
-            os.makedirs(folderpath)
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            existing_data = json.load(file)
-    except (Exception, FileNotFoundError):
-        # If the file doesn't exist yet, create an empty dictionary
-        existing_data = DEFAULT_SETTINGS_DICT
-
-    # Update the existing data with the new variables
-    models_list: List = existing_data[INSTALLED_TEXT_MODELS]
-    modelIndex = next(
-        (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
+    def update(existing_data):
+        # If the file doesn't exist yet, start from the defaults
+        if not existing_data:
+            existing_data = copy.deepcopy(DEFAULT_SETTINGS_DICT)
+        # Update the existing data with the new variables
+        models_list: List = existing_data[INSTALLED_TEXT_MODELS]
+        modelIndex = next(
+            (x for x, item in enumerate(models_list) if item["repoId"] == repo_id),
+            None,
+        )
+        if modelIndex is None:
+            # Assign new data
+            new_data = data
+            new_data["savePath"] = {}
+            new_data["numTimesRun"] = 0
+            new_data["isFavorited"] = False
+            models_list.append(copy.deepcopy(new_data))
+        else:
+            model = models_list[modelIndex]
+            # Assign updated data
+            for key, val in data.items():
+                if key == "savePath":
+                    new_save_paths: dict = data[key]
+                    prev_save_paths: dict = model[key]
+                    model[key] = {
+                        **prev_save_paths,
+                        **new_save_paths,
+                    }
+                else:
+                    model[key] = val
+            models_list[modelIndex] = model
+        return existing_data
+
+    # This will overwrite all values in the key's dict.
+    return settings_store.get_store(MODEL_METADATAS_FILEPATH).update(update)
+
+
+# Count a load of an installed model, models that are run the most get preloaded
+def increment_model_runs(repo_id: str, model_path: Optional[str] = None):
+    def update(settings):
+        if not settings or INSTALLED_TEXT_MODELS not in settings:
+            return settings
+        for item in settings[INSTALLED_TEXT_MODELS]:
+            if item.get("repoId") == repo_id:
+                item["numTimesRun"] = (item.get("numTimesRun") or 0) + 1
+                # Last load time of the file, the disk quota evicts the oldest first
+                save_paths = item.get("savePath")
+                if model_path and isinstance(save_paths, dict):
+                    for filename, path in save_paths.items():
+                        if os.path.realpath(path) == os.path.realpath(model_path):
+                            item.setdefault("lastLoaded", {})[filename] = time.time()
+                break
+        return settings
+
+    settings_store.get_store(MODEL_METADATAS_FILEPATH).update(update)
+
+
+# Pinned files are never evicted by the disk quota
+def pin_text_model(repo_id: str, filename: str, pinned: bool):
+    def update(settings):
+        if not settings or INSTALLED_TEXT_MODELS not in settings:
+            raise Exception("No installed models found.")
+        item = next(
+            (x for x in settings[INSTALLED_TEXT_MODELS] if x.get("repoId") == repo_id),
+            None,
+        )
+        if not item or filename not in (item.get("savePath") or {}):
+            raise Exception(f"Model file [{filename}] of [{repo_id}] is not installed.")
+        pinned_files = [name for name in item.get("pinned") or [] if name != filename]
+        if pinned:
+            pinned_files.append(filename)
+        item["pinned"] = pinned_files
+        return settings
+
+    settings = settings_store.get_store(MODEL_METADATAS_FILEPATH).update(update)
+    return next(
+        x for x in settings[INSTALLED_TEXT_MODELS] if x.get("repoId") == repo_id
     )
-    if modelIndex is None:
-        # Assign new data
-        new_data = data
-        new_data["savePath"] = {}
-        new_data["numTimesRun"] = 0
-        new_data["isFavorited"] = False
-        models_list.append(data)
-    else:
-        model = models_list[modelIndex]
-        # Assign updated data
-        for key, val in data.items():
-            if key == "savePath":
-                new_save_paths: dict = data[key]
-                prev_save_paths: dict = model[key]
-                model[key] = {
-                    **prev_save_paths,
-                    **new_save_paths,
-                }
-            else:
-                model[key] = val
-        models_list[modelIndex] = model
-
-    # Save the updated data to the file, this will overwrite all values in the key's dict.
-    with open(filepath, "w") as file:
-        json.dump(existing_data, file, indent=2)
-    return existing_data
 
 
 # Deletes all files associated with a revision (model)
 def delete_text_model_revisions(repo_id: str):
-    filepath = MODEL_METADATAS_FILEPATH
-
-    try:
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            metadata = json.load(file)
+    def update(metadata):
+        if not metadata:
+            print(f"{PRNT_API} File not found.", flush=True)
+            return metadata
         # Remove model entry from metadata
         models_list: List = metadata[INSTALLED_TEXT_MODELS]
-        modelIndex = next(
-            (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
-        )
-        del models_list[modelIndex]
-        # Save updated metadata
-        with open(filepath, "w") as file:
-            json.dump(metadata, file, indent=2)
-    except FileNotFoundError:
-        print(f"{PRNT_API} File not found.", flush=True)
-    except json.JSONDecodeError:
-        print(f"{PRNT_API} JSON parsing error.", flush=True)
+        metadata[INSTALLED_TEXT_MODELS] = [
+            item for item in models_list if item["repoId"] != repo_id
+        ]
+        return metadata
+
+    settings_store.get_store(MODEL_METADATAS_FILEPATH).update(update)
 
 
 # Delete a single (quant) file for the model
 def delete_text_model(filename: str, repo_id: str):
-    filepath = MODEL_METADATAS_FILEPATH
-
-    try:
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            metadata = json.load(file)
-        # Remove model entry from metadata
+    def update(metadata):
+        if not metadata:
+            print(f"{PRNT_API} File not found.", flush=True)
+            return metadata
+        # Remove file entry from the model's metadata
         models_list: List = metadata[INSTALLED_TEXT_MODELS]
-        modelIndex = next(
-            (x for x, item in enumerate(models_list) if item["repoId"] == repo_id), None
-        )
-        model = models_list[modelIndex]
-        del model["savePath"][filename]
-        # Save updated metadata
-        with open(filepath, "w") as file:
-            json.dump(metadata, file, indent=2)
-    except FileNotFoundError:
-        print(f"{PRNT_API} File not found.", flush=True)
-    except json.JSONDecodeError:
-        print(f"{PRNT_API} JSON parsing error.", flush=True)
+        for model in models_list:
+            if model["repoId"] == repo_id:
+                model["savePath"].pop(filename, None)
+                (model.get("lastLoaded") or {}).pop(filename, None)
+                if filename in (model.get("pinned") or []):
+                    model["pinned"].remove(filename)
+        return metadata
+
+    settings_store.get_store(MODEL_METADATAS_FILEPATH).update(update)
 
 
 def delete_vector_store(target_file_path: str, folder_path):
@@ -404,23 +386,23 @@ def dedupe_substrings(input_string):
     return " ".join(result)
 
 
-def get_settings_file(folderpath: str, filepath: str):
-    loaded_data = None
+# Write to a temp file first so a crash never leaves a half written file
+def write_json_atomic(path: str, data: Any):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_path, path)
 
-    try:
-        # Check if folder exists
-        if not os.path.exists(folderpath):
-            print(f"{PRNT_API} Folder does not exist: {folderpath}", flush=True)
-            os.makedirs(folderpath)
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            loaded_data = json.load(file)
-    except FileNotFoundError:
-        print(f"{PRNT_API} File does not exist.", flush=True)
-        loaded_data = None
-    except json.JSONDecodeError:
-        print(f"{PRNT_API} Invalid JSON format or empty file.", flush=True)
-        loaded_data = None
+
+def get_settings_file(folderpath: str, filepath: str):
+    # Check if folder exists
+    if not os.path.exists(folderpath):
+        print(f"{PRNT_API} Folder does not exist: {folderpath}", flush=True)
+        os.makedirs(folderpath)
+    # Served from memory after the first read
+    loaded_data = settings_store.get_store(filepath).read()
+    if loaded_data is None:
+        print(f"{PRNT_API} File does not exist or has invalid JSON.", flush=True)
     return loaded_data
 
 
@@ -441,20 +423,11 @@ def store_tool_definition(
     match operation:
         # Write new tool
         case "w":
-            # Try to open the file (if it exists)
-            try:
-                with open(filepath, "r") as file:
-                    existing_data = json.load(file)
-            except FileNotFoundError:
-                # If the file doesn't exist yet, create an empty
-                existing_data = {}
-            except json.JSONDecodeError:
-                existing_data = {}
-            # Update the existing data
-            existing_data = {**existing_data, **data}
-            # Save the updated data to the file, this will overwrite all values
-            with open(filepath, "w") as file:
-                json.dump(existing_data, file, indent=2)
+            store = settings_store.get_store(filepath)
+            # Update the existing data, this will overwrite all values
+            store.update(lambda existing_data: {**(existing_data or {}), **data})
+            # The tool registry watches the files, write it now
+            store.flush()
         # Read all tools
         case "r":
             try:
@@ -463,8 +436,8 @@ def store_tool_definition(
                 for file_name in files:
                     file_path = os.path.join(folderpath, file_name)
                     if os.path.isfile(file_path) and file_path.endswith(".json"):
-                        with open(file_path, "r") as file:
-                            prev_data = json.load(file)
+                        prev_data = settings_store.get_store(file_path).read()
+                        if prev_data is not None:
                             existing_data.append(prev_data)
             except:
                 existing_data = []
@@ -478,7 +451,7 @@ def store_tool_definition(
                 file_path = os.path.join(folderpath, file_name)
                 file_id = file_name.split(".")[0]
                 if file_id == id:
-                    os.remove(file_path)
+                    settings_store.get_store(file_path).delete()
 
 
 def save_bot_settings_file(folderpath: str, filepath: str, data: Any):
@@ -486,50 +459,22 @@ def save_bot_settings_file(folderpath: str, filepath: str, data: Any):
     if not os.path.exists(folderpath):
         os.makedirs(folderpath)
 
-    # Try to open the file (if it exists)
-    try:
-        with open(filepath, "r") as file:
-            existing_data = json.load(file)
-    except FileNotFoundError:
-        # If the file doesn't exist yet, create an empty
-        existing_data = []
-    except json.JSONDecodeError:
-        existing_data = []
-
-    # Update the existing data
-    existing_data.append(data)
-
-    # Save the updated data to the file, this will overwrite all values
-    with open(filepath, "w") as file:
-        json.dump(existing_data, file, indent=2)
-
-    return existing_data
+    # Update the existing data, start empty if the file doesn't exist yet
+    return settings_store.get_store(filepath).update(
+        lambda existing_data: [*(existing_data or []), data]
+    )
 
 
 def save_settings_file(folderpath: str, filepath: str, data: dict):
-    try:
-        # Create folder/file
-        if not os.path.exists(folderpath):
-            print(f"{PRNT_API} Folder does not exist: {folderpath}", flush=True)
-            os.makedirs(folderpath)
-        # Try to open the file (if it exists)
-        with open(filepath, "r") as file:
-            existing_data = json.load(file)
-    except FileNotFoundError:
-        # If the file doesn't exist yet, create an empty dictionary
-        existing_data = {}
-    except json.JSONDecodeError:
-        existing_data = {}
-
-    # Update the existing data with the new variables
-    for key, val in data.items():
-        existing_data[key] = val
-
-    # Save the updated data to the file, this will overwrite all values in the key's dict.
-    with open(filepath, "w") as file:
-        json.dump(existing_data, file, indent=2)
-
-    return existing_data
+    # Create folder/file
+    if not os.path.exists(folderpath):
+        print(f"{PRNT_API} Folder does not exist: {folderpath}", flush=True)
+        os.makedirs(folderpath)
+
+    # Update the existing data with the new variables, this will overwrite all values in the key's dict.
+    return settings_store.get_store(filepath).update(
+        lambda existing_data: {**(existing_data or {}), **data}
+    )
 
 
 # Return metadata for the currently loaded model
@@ -561,6 +506,11 @@ def get_file_extension_from_path(path: str):
     return file_extension
 
 
+# Name of the text inference backend to use when a load request does not specify one
+def get_text_backend_env():
+    return os.getenv("TEXT_INFERENCE_BACKEND", DEFAULT_TEXT_BACKEND)
+
+
 def get_ssl_env():
     val = os.getenv("ENABLE_SSL", "False").lower() in ("true", "1", "t")
     if val is None:
@@ -0,0 +1,125 @@
+###
+# Settings files (installed_models.json, bots.json, tool definitions...) kept in memory. A file is
+# read once, reads are served from memory and updates are made under a lock, so two requests
+# changing the same file can not lose each other's changes. Writes are coalesced: the file is
+# rewritten once, FLUSH_DELAY_SECS after the first pending change, to a temp file that is renamed
+# over it. Pending changes are flushed on shutdown and at exit.
+# A file edited by hand is read again when it has no pending changes.
+###
+import os
+import copy
+import json
+import atexit
+import threading
+from typing import Any, Callable, Optional
+
+FLUSH_DELAY_SECS = 0.5
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class JsonFileStore:
+    def __init__(self, path: str, flush_delay: float = FLUSH_DELAY_SECS):
+        self.path = path
+        self.flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._data: Any = None
+        self._loaded = False
+        self._mtime: Optional[int] = None
+        self._dirty = False
+        self._timer: Optional[threading.Timer] = None
+
+    def _load(self):
+        # Read again only when someone else changed the file
+        if self._loaded and (self._dirty or _mtime(self.path) == self._mtime):
+            return
+        self._mtime = _mtime(self.path)
+        try:
+            with open(self.path, "r") as file:
+                self._data = json.load(file)
+        except (OSError, ValueError):
+            # Missing or invalid
+            self._data = None
+        self._loaded = True
+
+    # A copy of the file's contents, None if it does not exist or is invalid
+    def read(self) -> Any:
+        with self._lock:
+            self._load()
+            return copy.deepcopy(self._data)
+
+    # Change the contents with update(data) -> new data, returns a copy of the new data
+    def update(self, update: Callable[[Any], Any]) -> Any:
+        with self._lock:
+            self._load()
+            self._data = update(copy.deepcopy(self._data))
+            self._dirty = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return copy.deepcopy(self._data)
+
+    def write(self, data: Any) -> Any:
+        return self.update(lambda _: copy.deepcopy(data))
+
+    # Write pending changes to disk now
+    def flush(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(self._data, file, indent=2)
+            os.replace(tmp_path, self.path)
+            self._mtime = _mtime(self.path)
+            self._dirty = False
+
+    # Remove the file and drop pending changes
+    def delete(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            self._dirty = False
+            self._data = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._mtime = None
+
+
+_stores: dict[str, JsonFileStore] = {}
+_stores_lock = threading.Lock()
+
+
+# The store of a file, one per path
+def get_store(path: str) -> JsonFileStore:
+    key = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = JsonFileStore(key)
+            _stores[key] = store
+        return store
+
+
+def flush_all():
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        try:
+            store.flush()
+        except OSError as err:
+            print(f"Failed to save settings file {store.path}: {err}", flush=True)
+
+
+atexit.register(flush_all)
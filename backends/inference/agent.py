@@ -1,48 +1,33 @@
 import json
-import os
-from typing import Any, List
+from typing import Any, List, Optional
+from collections import OrderedDict
 import re
 import json
 from pydantic import BaseModel
 from core import classes
-import importlib.util
-from core import common
+from inference import (
+    grammars,
+    remote_tools,
+    text_llama_index,
+    tool_executor,
+    tool_registry,
+)
 
 
-# Load the code module and pydantic model for the tool
+# Load the code module and pydantic model for the tool (compiled once and cached)
 # file name and function name must be the same!
 def load_function_file(filename: str):
-    func_name = os.path.splitext(filename)[0]
-    prebuilt_funcs_path = common.dep_path(os.path.join(common.TOOL_PREBUILT_PATH, filename))
-    custom_funcs_path = os.path.join(common.TOOL_FUNCS_PATH, filename)
-    try:
-        # Check pre-made funcs first
-        spec = importlib.util.spec_from_file_location(
-            name=filename,
-            location=prebuilt_funcs_path,
-        )
-    except:
-        pass
-    try:
-        # Check custom user funcs
-        spec = importlib.util.spec_from_file_location(
-            name=filename,
-            location=custom_funcs_path,
-        )
-    except:
-        raise Exception("No path/function found.")
-    if not spec:
-        raise Exception("No tool found.")
-    tool_code = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(tool_code)
-    tool_func = getattr(tool_code, func_name)
-    pydantic_model_name = "Params"
-    pydantic_model = getattr(tool_code, pydantic_model_name)
-    return {
-        "func": tool_func,
-        "model": pydantic_model.model_json_schema(),
-        # "model": pydantic_model.__annotations__,
-    }
+    return tool_registry.registry.get_module(filename)
+
+# Json schema of the tool's Params, from its code or from its endpoint for remote tools
+def get_tool_schema(path: str) -> dict:
+    if remote_tools.is_url(path):
+        return remote_tools.get_client().definition(path)
+    return load_function_file(filename=path)["model"]
+
+# Compiled grammar that constrains generation to the tool's Params schema
+def get_tool_grammar(tool_def: classes.ToolDefinition):
+    return grammars.registry.from_json_schema(get_tool_schema(tool_def["path"]))
 
 # Return arguments in a (Pydantic) schema and example output
 def construct_arguments(schema: Any):
@@ -82,6 +67,23 @@ def dict_list_to_markdown(dict_list: List[dict]):
                 markdown_string += f"## {key}\n{value}\n\n"
     return markdown_string
 
+# Rendered markdown of the most recent tool sets. The registry returns the same
+# definition objects until a tool changes, so identity tells us the entry is still valid.
+_tools_markdown_cache: OrderedDict[tuple, tuple[list, str]] = OrderedDict()
+MAX_TOOLS_MARKDOWN_CACHE = 32
+
+def get_tools_markdown(tool_defs: List[classes.ToolDefinition]) -> str:
+    key = tuple(tool_def["name"] for tool_def in tool_defs)
+    cached = _tools_markdown_cache.get(key)
+    if cached and all(a is b for a, b in zip(cached[0], tool_defs)):
+        _tools_markdown_cache.move_to_end(key)
+        return cached[1]
+    markdown = dict_list_to_markdown(tool_defs)
+    _tools_markdown_cache[key] = (list(tool_defs), markdown)
+    while len(_tools_markdown_cache) > MAX_TOOLS_MARKDOWN_CACHE:
+        _tools_markdown_cache.popitem(last=False)
+    return markdown
+
 # Filter out all "required_arg" props
 def get_allowed_args(tool_args: dict):
     result = []
@@ -107,39 +109,49 @@ def get_tool_props(tool_def: classes.ToolDefinition):
         "allowed_arguments": tool_allowed_keys,
     }
 
-# Get the actual function using the provided path
-def get_tool_function(path: str, tool: classes.ToolDefinition):
-    is_url = path.startswith("https://")
-    tool_code = load_function_file(filename=tool["path"])
-    tool_func = tool_code["func"]
-    # @TODO Construct api call for endpoint
-    if is_url:
-        return tool_func
-    # Load local func
-    else:
-        return tool_func
-
-# Pass the text response which includes the function params
-def eval(tool: classes.ToolDefinition, args: dict):
-    # pass llm response to function
-    path = tool["path"]
-    tool_function = get_tool_function(tool=tool, path=path)
-    return tool_function(args)
+# Pass the text response which includes the function params.
+# Local tools run in the tool pool and remote tools (https:// paths) are called over http.
+# Returns {"success", "result", "error", "elapsed"}
+def eval(tool: classes.ToolDefinition, args: dict) -> dict:
+    return tool_executor.get_executor().execute(tool, args)
 
 class ParsedOutput(BaseModel):
     raw: str
     text: str
 
-# Parse out the json result using either regex or another llm call
-def parse_output(output: str, tool_def: classes.ToolDefinition) -> ParsedOutput:
-    print(f"Agent output response::\n{output}")
-
+# Remove any unrelated keys from the llm's json
+def filter_tool_args(json_object: dict, tool_def: classes.ToolDefinition) -> dict:
     tool_attrs = get_tool_props(tool_def=tool_def)
     allowed_arguments: List[str] = tool_attrs.get("allowed_arguments", [])
+    # Filter out keys not in the allowed_keys set
+    return {
+        k: v
+        for k, v in json_object.items()
+        if k in allowed_arguments
+    }
+
+# Call the tool and format its result as the agent's answer
+def run_tool(tool_def: classes.ToolDefinition, args: dict) -> ParsedOutput:
+    output = eval(
+        tool=tool_def,
+        args=args,
+    )
+    if not output["success"]:
+        error = output["error"]
+        raise Exception(f"Tool [{tool_def['name']}] failed ({error['type']}): {error['message']}")
+    result = output["result"]
+    # Preserve the correct type
     parsed_output = {
-        "raw": "",
-        "text": "",
+        "raw": {"result": result},
+        "text": f"{result}",
     }
+    print(f"Agent answer:: {parsed_output}")
+    return parsed_output
+
+# Parse out the json result using either regex or another llm call
+def parse_output(output: str, tool_def: classes.ToolDefinition) -> ParsedOutput:
+    print(f"Agent output response::\n{output}")
+
     pattern_object = r"({.*?})"
     pattern_json_object = r"\`\`\`json\n({.*?})\n\`\`\`"
     match_json_object = re.search(
@@ -164,36 +176,108 @@ def parse_output(output: str, tool_def: classes.ToolDefinition) -> ParsedOutput:
         json_block = json_block.strip()
         # Convert JSON block back to a dictionary to ensure it's valid JSON
         try:
-            # Remove any unrelated keys from json
             json_object: dict = json.loads(json_block)
-            # Filter out keys not in the allowed_keys set
-            filtered_json_object = {
-                k: v
-                for k, v in json_object.items()
-                if k in allowed_arguments
-            }
-            result = eval(
-                tool=tool_def,
-                args=filtered_json_object,
-            )
-            # Preserve the correct type
-            parsed_output["raw"] = {"result": result}
-            parsed_output["text"] = f"{result}"
-            print(f"Agent answer:: {parsed_output}")
-            return parsed_output
+            filtered_json_object = filter_tool_args(json_object, tool_def)
+            return run_tool(tool_def=tool_def, args=filtered_json_object)
         except json.JSONDecodeError as e:
             print("Invalid JSON:", e)
             raise Exception("Invalid JSON.")
     else:
         raise Exception("No JSON block found!")
 
+# Follows streamed text and reports when the first top-level JSON object has closed
+class JsonObjectStream:
+    def __init__(self):
+        self.text = ""
+        self.depth = 0
+        self.start = -1
+        self.end = -1
+        self.in_string = False
+        self.escaped = False
+
+    # Returns True once the object is complete
+    def feed(self, delta: str) -> bool:
+        offset = len(self.text)
+        self.text += delta
+        for index, char in enumerate(delta, start=offset):
+            if self.end >= 0:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"' and self.depth > 0:
+                self.in_string = True
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = index
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = index + 1
+        return self.end >= 0
+
+    def result(self) -> dict:
+        if self.end < 0:
+            raise Exception("Tool call did not produce a complete JSON object.")
+        return json.loads(self.text[self.start : self.end])
+
+# Generate json with sampling constrained by the grammar.
+# The json is parsed as tokens stream in and generation stops once the object closes
+# (or max_tokens is reached). Returns the stream and the number of generated tokens.
+def generate_json(
+    llm: Any,
+    message: str,
+    grammar,
+    max_tokens: Optional[int] = None,
+) -> tuple[JsonObjectStream, int]:
+    json_stream = JsonObjectStream()
+    num_tokens = 0
+    with text_llama_index.request_grammar(llm, grammar):
+        token_generator = llm.stream_complete(message, formatted=True)
+    try:
+        for token in token_generator:
+            num_tokens += 1
+            if json_stream.feed(token.delta):
+                break
+            if max_tokens and num_tokens >= max_tokens:
+                break
+    finally:
+        # Stops any further generation
+        token_generator.close()
+    return json_stream, num_tokens
+
+# Generate the tool's arguments with sampling constrained to its Params schema.
+def constrained_tool_call(
+    llm: Any,
+    prompt: str,
+    system_message: str,
+    message_format: str,
+    tool_def: classes.ToolDefinition,
+) -> ParsedOutput:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    grammar = get_tool_grammar(tool_def)
+    message = text_llama_index.completion_to_prompt(
+        prompt, system_message or "", message_format
+    )
+    json_stream, _ = generate_json(llm, message, grammar)
+    print(f"Agent output response::\n{json_stream.text}")
+    args = filter_tool_args(json_stream.result(), tool_def)
+    return run_tool(tool_def=tool_def, args=args)
+
 # Create arguments and example response for llm prompt from pydantic model
 def create_tool_args(tool_def: classes.ToolSaveRequest) -> classes.ToolDefinition:
     new_dict = dict(arguments={}, example_arguments={}, description="")
     # Get values
     new_def = {**new_dict, **tool_def.model_dump()}
-    tool_code = load_function_file(filename=tool_def.path)
-    tool_model = tool_code["model"]
+    tool_model = get_tool_schema(tool_def.path)
+    # Compile the tool's grammar ahead of its first constrained call
+    grammars.registry.from_json_schema(tool_model)
     tool_schema = construct_arguments(tool_model)
     tool_description = tool_model["description"]
     tool_args = tool_schema.get("arguments", {})
@@ -0,0 +1,193 @@
+###
+# Multi-step agent loop. On each step the model replies with JSON (constrained by a grammar) that
+# either calls one or more tools or gives the final answer. The tool calls of a step run in parallel
+# on the tool pool and their results are added to the prompt of the next step.
+# Progress is streamed to the client as SSE events.
+###
+import json
+import asyncio
+from typing import Any, List, Optional
+from core import classes
+from inference import agent, grammars, text_llama_index, tool_executor
+from inference.scheduler import scheduler
+
+DEFAULT_MAX_AGENT_STEPS = 4
+TOOL_CALLS_KEY = "tool_calls"
+ANSWER_KEY = "answer"
+STEP_INSTRUCTIONS = f"""Reply only with JSON. To use tools reply with {{"{TOOL_CALLS_KEY}": [{{"name": "<tool name>", "parameters": {{...}}}}]}}, tools in the same list run at the same time so only group calls that do not depend on each other. When you know the answer reply with {{"{ANSWER_KEY}": "<your answer>"}}."""
+FINAL_STEP_INSTRUCTIONS = f"""Reply only with JSON containing your final answer: {{"{ANSWER_KEY}": "<your answer>"}}."""
+
+
+def event(name: str, data: Any) -> str:
+    # Tool results may not be json types
+    return json.dumps({"event": name, "data": data}, default=str)
+
+
+# Json schema of a step's reply. Properties are emitted in alphabetical order by the
+# grammar converter, so "name" is always generated before "parameters".
+def step_schema(tool_defs: List[classes.ToolDefinition], allow_tools: bool) -> dict:
+    answer_schema = {
+        "type": "object",
+        "properties": {ANSWER_KEY: {"type": "string"}},
+    }
+    if not allow_tools:
+        return answer_schema
+    defs = {}
+    call_schemas = []
+    for tool_def in tool_defs:
+        params_schema = dict(agent.get_tool_schema(tool_def["path"]))
+        # Nested models are referenced as "#/$defs/..." so they must live at the root
+        defs.update(params_schema.pop("$defs", {}))
+        call_schemas.append(
+            {
+                "type": "object",
+                "properties": {
+                    "name": {"const": tool_def["name"]},
+                    "parameters": params_schema,
+                },
+            }
+        )
+    schema = {
+        "anyOf": [
+            {
+                "type": "object",
+                "properties": {
+                    TOOL_CALLS_KEY: {"type": "array", "items": {"anyOf": call_schemas}}
+                },
+            },
+            answer_schema,
+        ]
+    }
+    if defs:
+        schema["$defs"] = defs
+    return schema
+
+
+# Previous calls and their results, appended to the prompt of each step
+def format_tool_results(results: List[dict]) -> str:
+    if not results:
+        return ""
+    lines = ["# Tool results"]
+    for item in results:
+        output = (
+            item["result"] if item["success"] else f"Error: {item['error']['message']}"
+        )
+        lines.append(f"{item['name']}({json.dumps(item['parameters'])}) -> {output}")
+    return "\n".join(lines)
+
+
+# Render a chat history in front of the prompt
+def chat_history_prompt(messages: List[Any], prompt: str) -> str:
+    lines = []
+    for message in messages or []:
+        if isinstance(message, dict):
+            lines.append(f"{message.get('role', 'user')}: {message.get('content', '')}")
+        elif hasattr(message, "role"):
+            lines.append(f"{message.role}: {message.content}")
+        else:
+            lines.append(f"user: {message}")
+    lines.append(f"user: {prompt}")
+    return "\n".join(lines)
+
+
+async def run_tool_call(
+    tool_defs: dict[str, classes.ToolDefinition], call: dict
+) -> dict:
+    name = call.get("name")
+    parameters = call.get("parameters") or {}
+    tool_def = tool_defs.get(name)
+    if not tool_def:
+        output = tool_executor.tool_error("not_found", f"No tool found named [{name}].")
+    else:
+        parameters = agent.filter_tool_args(parameters, tool_def)
+        output = await tool_executor.get_executor().execute_async(tool_def, parameters)
+    return {"name": name, "parameters": parameters, **output}
+
+
+# Grammars of a step that may call tools and of the final answer
+def step_grammars(tool_defs: List[classes.ToolDefinition]) -> tuple:
+    return (
+        grammars.registry.from_json_schema(step_schema(tool_defs, True)),
+        grammars.registry.from_json_schema(step_schema(tool_defs, False)),
+    )
+
+
+# Async generator of SSE payloads
+async def agent_loop(
+    llm: Any,
+    prompt: str,
+    system_message: str,
+    message_format: str,
+    tool_defs: List[classes.ToolDefinition],
+    max_tokens: int,
+    max_steps: Optional[int] = None,
+    token_budget: Optional[int] = None,
+):
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    max_steps = max_steps or DEFAULT_MAX_AGENT_STEPS
+    tools_by_name = {tool_def["name"]: tool_def for tool_def in tool_defs}
+    # Remote tool schemas are fetched over http, keep the event loop free meanwhile
+    tool_grammar, answer_grammar = await asyncio.to_thread(step_grammars, tool_defs)
+    results: List[dict] = []
+    tokens_used = 0
+
+    for step in range(1, max_steps + 1):
+        is_last_step = step == max_steps
+        remaining = token_budget - tokens_used if token_budget else max_tokens
+        if remaining <= 0:
+            yield event(
+                "AGENT_DONE",
+                dict(steps=step - 1, tokens=tokens_used, reason="token_budget"),
+            )
+            return
+        yield event("AGENT_STEP", dict(step=step, tokens=tokens_used))
+        instructions = FINAL_STEP_INSTRUCTIONS if is_last_step else STEP_INSTRUCTIONS
+        step_prompt = "\n\n".join(
+            part
+            for part in [prompt, format_tool_results(results), instructions]
+            if part
+        )
+        message = text_llama_index.completion_to_prompt(
+            step_prompt, system_message or "", message_format
+        )
+        json_stream, num_tokens = await scheduler.run(
+            agent.generate_json,
+            llm,
+            message,
+            answer_grammar if is_last_step else tool_grammar,
+            min(max_tokens, remaining),
+        )
+        tokens_used += num_tokens
+        print(f"Agent step output::\n{json_stream.text}", flush=True)
+        try:
+            reply = json_stream.result()
+        except Exception:
+            reply = None
+        if reply is None:
+            yield event(
+                "AGENT_DONE",
+                dict(steps=step, tokens=tokens_used, reason="invalid_output"),
+            )
+            return
+        # Final answer
+        if ANSWER_KEY in reply:
+            yield event("GENERATING_TOKENS", f"{reply[ANSWER_KEY]}")
+            yield event(
+                "AGENT_DONE", dict(steps=step, tokens=tokens_used, reason="answer")
+            )
+            return
+        # Independent calls, run them all at once
+        calls: List[dict] = reply.get(TOOL_CALLS_KEY) or []
+        for call in calls:
+            yield event("TOOL_CALL", dict(step=step, **call))
+        step_results = await asyncio.gather(
+            *[run_tool_call(tools_by_name, call) for call in calls]
+        )
+        for item in step_results:
+            yield event("TOOL_RESULT", dict(step=step, **item))
+        results.extend(step_results)
+
+    yield event(
+        "AGENT_DONE", dict(steps=max_steps, tokens=tokens_used, reason="max_steps")
+    )
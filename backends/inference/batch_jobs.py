@@ -0,0 +1,307 @@
+###
+# Offline bulk inference. A job is a JSONL file of InferenceRequest shaped items (plain completions,
+# no RAG or tools), processed one item at a time at batch priority so interactive requests go first.
+#
+# Each job lives in its own folder:
+#   job.json       status and progress
+#   items.jsonl    the uploaded items
+#   results.jsonl  one line per finished item, appended as they complete
+# On startup jobs that were running are queued again and skip the items already in results.jsonl.
+#
+# llama-cpp-python decodes one sequence at a time, so items are ordered by their formatted prompt
+# instead. Items sharing a system message/template run back to back and llama.cpp re-uses the KV
+# cache of their common prompt start.
+###
+import os
+import json
+import time
+import shutil
+import asyncio
+from typing import Any, List, Optional
+from nanoid import generate as uuid
+from core import common
+from core.classes import InferenceRequest
+from inference import grammars, lora_adapters, prompt_templates, text_llama_index
+from inference.scheduler import Priority, scheduler
+
+JOB_FILENAME = "job.json"
+ITEMS_FILENAME = "items.jsonl"
+RESULTS_FILENAME = "results.jsonl"
+# Seconds to wait before checking again for a loaded model
+NO_MODEL_RETRY_SECS = 5.0
+QUERY_INPUT = "query_str"
+# Generation settings an item may set, the loaded model's settings are used for the rest
+GENERATE_KWARGS = [
+    "temperature",
+    "stop",
+    "mirostat_tau",
+    "tfs_z",
+    "top_k",
+    "top_p",
+    "min_p",
+    "seed",
+    "repeat_penalty",
+    "presence_penalty",
+    "frequency_penalty",
+]
+
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    PAUSED = "paused"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+# The prompt sent to the model
+def format_item(item: InferenceRequest) -> str:
+    prompt = item.prompt
+    if item.promptTemplate:
+        prompt = prompt_templates.render(item.promptTemplate, {QUERY_INPUT: prompt})
+    return text_llama_index.completion_to_prompt(
+        prompt, item.systemMessage or "", item.messageFormat
+    )
+
+
+# Blocking, run it through the scheduler
+def run_item(llm: Any, item: InferenceRequest) -> str:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    settings = item.model_dump(exclude_unset=True)
+    overrides = {name: settings[name] for name in GENERATE_KWARGS if name in settings}
+    if item.max_tokens:
+        overrides["max_tokens"] = item.max_tokens
+    if item.grammar:
+        overrides["grammar"] = grammars.registry.from_request(item.grammar)
+    with text_llama_index.request_generate_kwargs(llm, overrides):
+        response = llm.complete(format_item(item), formatted=True)
+    return response.text
+
+
+# Parse an uploaded JSONL file, raises on the first invalid line
+def parse_items(content: bytes) -> List[dict]:
+    items = []
+    for line_number, line in enumerate(content.decode("utf-8").splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            InferenceRequest.model_validate(data)
+        except Exception as err:
+            raise Exception(f"Invalid item on line {line_number}: {err}")
+        items.append(data)
+    if not items:
+        raise Exception("No items found in the file.")
+    return items
+
+
+class BatchJobManager:
+    def __init__(self, jobs_path: str):
+        self.jobs_path = jobs_path
+        self.jobs: dict[str, dict] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _job_path(self, job_id: str, filename: str = "") -> str:
+        return os.path.join(self.jobs_path, job_id, filename)
+
+    def _save(self, job: dict):
+        job["updated_at"] = time.time()
+        common.write_json_atomic(self._job_path(job["id"], JOB_FILENAME), job)
+
+    # Routes call this from the threadpool, the event belongs to the server's loop
+    def _notify(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    # Index -> success of the finished items. A partly written last line (crash) is cut off.
+    def _finished_items(self, job_id: str) -> dict[int, bool]:
+        path = self._job_path(job_id, RESULTS_FILENAME)
+        if not os.path.exists(path):
+            return {}
+        finished = {}
+        valid_size = 0
+        with open(path, "rb") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                    finished[result["index"]] = result["success"]
+                except (ValueError, KeyError):
+                    break
+                valid_size += len(line)
+        if valid_size < os.path.getsize(path):
+            with open(path, "r+b") as file:
+                file.truncate(valid_size)
+        return finished
+
+    # Read the jobs on disk, the ones that were running are queued again
+    def load(self):
+        self.jobs = {}
+        if not os.path.isdir(self.jobs_path):
+            return
+        for job_id in os.listdir(self.jobs_path):
+            try:
+                with open(self._job_path(job_id, JOB_FILENAME), "r") as file:
+                    job = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if job["status"] == JobStatus.RUNNING:
+                job["status"] = JobStatus.QUEUED
+            self.jobs[job_id] = job
+        print(f"{common.PRNT_API} Loaded {len(self.jobs)} batch job(s).", flush=True)
+
+    def start(self, app):
+        self.load()
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run(app))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def submit(self, content: bytes, name: Optional[str] = None) -> dict:
+        items = parse_items(content)
+        formatted = [format_item(InferenceRequest(**item)) for item in items]
+        job_id = uuid()
+        os.makedirs(self._job_path(job_id))
+        with open(self._job_path(job_id, ITEMS_FILENAME), "w") as file:
+            for item in items:
+                file.write(json.dumps(item) + "\n")
+        job = {
+            "id": job_id,
+            "name": name or job_id,
+            "status": JobStatus.QUEUED,
+            "total": len(items),
+            "completed": 0,
+            "failed": 0,
+            "error": None,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+            # Processing order, items with the same prompt start are next to each other
+            "order": sorted(range(len(items)), key=lambda index: formatted[index]),
+        }
+        self._save(job)
+        self.jobs[job_id] = job
+        self._notify()
+        return job
+
+    def get(self, job_id: str) -> dict:
+        job = self.jobs.get(job_id)
+        if not job:
+            raise Exception(f"No batch job found with id [{job_id}].")
+        return job
+
+    def list(self) -> List[dict]:
+        return sorted(self.jobs.values(), key=lambda job: job["created_at"])
+
+    def results_path(self, job_id: str) -> str:
+        self.get(job_id)
+        return self._job_path(job_id, RESULTS_FILENAME)
+
+    def pause(self, job_id: str) -> dict:
+        job = self.get(job_id)
+        if job["status"] in (JobStatus.QUEUED, JobStatus.RUNNING):
+            job["status"] = JobStatus.PAUSED
+            self._save(job)
+        return job
+
+    def resume(self, job_id: str) -> dict:
+        job = self.get(job_id)
+        if job["status"] in (JobStatus.PAUSED, JobStatus.FAILED):
+            job["status"] = JobStatus.QUEUED
+            job["error"] = None
+            self._save(job)
+            self._notify()
+        return job
+
+    def delete(self, job_id: str):
+        self.get(job_id)
+        # The worker stops when it sees the job is gone
+        del self.jobs[job_id]
+        shutil.rmtree(self._job_path(job_id), ignore_errors=True)
+
+    # Oldest job that is waiting to run
+    def _next_job(self) -> Optional[dict]:
+        for job in self.list():
+            if job["status"] in (JobStatus.QUEUED, JobStatus.RUNNING):
+                return job
+        return None
+
+    async def _run(self, app):
+        while True:
+            job = self._next_job()
+            if not job:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            if not app.state.llm:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), NO_MODEL_RETRY_SECS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(app, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                print(f"{common.PRNT_API} Batch job [{job['id']}] failed: {err}")
+                if job["id"] in self.jobs:
+                    job["status"] = JobStatus.FAILED
+                    job["error"] = f"{err}"
+                    self._save(job)
+
+    async def _process(self, app, job: dict):
+        job_id = job["id"]
+        with open(self._job_path(job_id, ITEMS_FILENAME), "r") as file:
+            items = [json.loads(line) for line in file]
+        finished = self._finished_items(job_id)
+        job["failed"] = len([ok for ok in finished.values() if not ok])
+        job["completed"] = len(finished) - job["failed"]
+        job["status"] = JobStatus.RUNNING
+        self._save(job)
+        with open(self._job_path(job_id, RESULTS_FILENAME), "a") as results_file:
+            for index in job["order"]:
+                if index in finished:
+                    continue
+                # Paused, deleted or the model was unloaded
+                if self.jobs.get(job_id) is not job:
+                    return
+                if job["status"] != JobStatus.RUNNING or not app.state.llm:
+                    return
+                item = InferenceRequest(**items[index])
+                result = {"index": index, "id": items[index].get("id")}
+                lora_adapters.requested_adapter.set(item.loraAdapter)
+                try:
+                    text = await scheduler.run(
+                        run_item, app.state.llm, item, priority=Priority.BATCH
+                    )
+                    result.update(success=True, text=text, error=None)
+                    job["completed"] += 1
+                except Exception as err:
+                    result.update(success=False, text=None, error=f"{err}")
+                    job["failed"] += 1
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+                self._save(job)
+        job["status"] = JobStatus.COMPLETED
+        self._save(job)
+
+
+_manager: Optional[BatchJobManager] = None
+
+
+def get_manager() -> BatchJobManager:
+    global _manager
+    if _manager is None:
+        _manager = BatchJobManager(common.BATCH_JOBS_PATH)
+    return _manager
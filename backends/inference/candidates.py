@@ -0,0 +1,98 @@
+###
+# Several candidate completions (n) for one prompt, scored by their log-probability.
+# llama.cpp keeps the prompt's KV cache between calls and only evaluates what differs from the
+# last prompt, so the candidates are sampled back to back while the scheduler slot is held and
+# the prompt is processed once. Each candidate uses its own seed.
+# The log-probabilities are read from the raw logits by a logits processor (the model does not
+# need to be loaded with logits_all).
+###
+from typing import Any, List, Optional
+import numpy as np
+from llama_cpp import LogitsProcessorList
+from core import common
+from inference import text_llama_index
+
+MAX_CANDIDATES = 16
+# Sampling at temperature 0 would return n copies of the same text
+DEFAULT_CANDIDATE_TEMPERATURE = 0.7
+
+
+# Collects the log-probability of each sampled token. The token picked at one step is known
+# when the next step starts, so the final token (usually end of sequence) is not scored.
+class TokenLogprobs:
+    def __init__(self):
+        self.logprobs: List[float] = []
+        self._prev_logprobs: Optional[np.ndarray] = None
+
+    def __call__(self, input_ids: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        if self._prev_logprobs is not None:
+            self.logprobs.append(float(self._prev_logprobs[input_ids[-1]]))
+        max_score = np.max(scores)
+        log_total = max_score + np.log(np.sum(np.exp(scores - max_score)))
+        self._prev_logprobs = scores - log_total
+        return scores
+
+
+def candidate_score(logprobs: List[float]) -> Optional[float]:
+    if not logprobs:
+        return None
+    # Normalized by length so short candidates are not always preferred
+    return sum(logprobs) / len(logprobs)
+
+
+# Blocking, run it through the scheduler
+def complete_candidates(
+    llm: Any,
+    prompt: str,
+    system_message: str,
+    message_format: str,
+    n: int,
+    options: dict,
+    select_best: bool = False,
+) -> dict:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    if n > MAX_CANDIDATES:
+        raise Exception(f"'n' may not be more than {MAX_CANDIDATES}.")
+    message = text_llama_index.completion_to_prompt(
+        prompt, system_message or "", message_format
+    )
+    seed = options.get("seed") or 0
+    overrides = {
+        key: options[key]
+        for key in ["max_tokens", "stop", "top_k", "top_p", "min_p", "grammar"]
+        if options.get(key)
+    }
+    overrides["temperature"] = (
+        options.get("temperature") or DEFAULT_CANDIDATE_TEMPERATURE
+    )
+
+    print(f"{common.PRNT_API} Text Completion ({n} candidates): {message}", flush=True)
+
+    candidates = []
+    for index in range(n):
+        token_logprobs = TokenLogprobs()
+        overrides["seed"] = seed + index
+        overrides["logits_processor"] = LogitsProcessorList([token_logprobs])
+        with text_llama_index.request_generate_kwargs(llm, overrides):
+            response = llm.complete(message, formatted=True)
+        logprobs = token_logprobs.logprobs
+        candidates.append(
+            {
+                "index": index,
+                "text": response.text,
+                "logprob": sum(logprobs) if logprobs else None,
+                "mean_logprob": candidate_score(logprobs),
+                "scored_tokens": len(logprobs),
+            }
+        )
+    best = None
+    if select_best:
+        scored = [item for item in candidates if item["mean_logprob"] is not None]
+        if scored:
+            best = max(scored, key=lambda item: item["mean_logprob"])["index"]
+    return {
+        "text": candidates[best if best is not None else 0]["text"],
+        "best": best,
+        "candidates": candidates,
+    }
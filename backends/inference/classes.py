@@ -5,3 +5,13 @@ class RetrievalTypes(Enum):
     BASE = "base"
     AUGMENTED = "augmented"
     AGENT = "agent"
+
+
+class ToolCallModes(Enum):
+    CONSTRAINED = "constrained"  # sampling constrained to the tool's schema
+    PARSE = "parse"  # free text, JSON is scraped from the output
+
+
+class EmbeddingEncodings(Enum):
+    FLOAT = "float"  # json list of floats per text
+    BASE64 = "base64"  # little-endian float32 bytes per text, base64 encoded
@@ -0,0 +1,215 @@
+###
+# Chat history compaction. Once the turns of a saved thread pass CHAT_COMPACTION_TOKENS, the older
+# turns are summarized in the background at batch priority. The summary is stored in the thread
+# under "compaction" and chat requests that pass the threadId send it (with the system message)
+# in place of those turns, so the prompt of each turn stays about the same size.
+# Summaries are incremental, the previous summary is folded into the next one. A summary keeps a
+# hash of the turns it covers and is dropped once those turns are edited or removed.
+###
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Any, List, Optional, Tuple
+from core import common
+from inference import prompt_templates, text_llama_index
+from inference.scheduler import Priority, scheduler
+
+COMPACTION_KEY = "compaction"
+DEFAULT_SUMMARY_MAX_TOKENS = 256
+# Share of the threshold kept as recent turns, the rest is summarized
+RECENT_TURNS_RATIO = 0.5
+# Placeholders: {summary} the previous summary, {conversation} the turns to add to it
+DEFAULT_COMPACTION_TEMPLATE = """Summarize the conversation below so it can be continued without it. Keep names, facts, decisions and open questions. Be brief.
+
+Summary so far:
+{summary}
+
+Conversation:
+{conversation}
+"""
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+
+def get_threshold() -> int:
+    return int(os.getenv("CHAT_COMPACTION_TOKENS", 0))
+
+
+def thread_path(thread_id: str) -> str:
+    return os.path.join(common.THREADS_PATH, f"{thread_id}.json")
+
+
+# Use the model's tokenizer when there is one, otherwise a rough estimate
+def count_tokens(llm: Any, text: str) -> int:
+    model = getattr(llm, "_model", None)
+    if hasattr(model, "tokenize"):
+        return len(model.tokenize(text.encode("utf-8"), add_bos=False))
+    if hasattr(llm, "count_tokens"):
+        return llm.count_tokens(text)
+    return max(1, len(text) // 4)
+
+
+def format_turns(messages: List[dict]) -> str:
+    return "\n".join(
+        f"{message.get('role', 'user')}: {message.get('content', '')}"
+        for message in messages
+    )
+
+
+# Role and content of a thread message (dict) or a request message (ChatHistoryMessage or str).
+# A plain string takes turns with the message before it, like in text_llama_index.to_chat_messages.
+def message_key(message: Any, previous_role: Optional[str] = None) -> list:
+    if isinstance(message, str):
+        return ["assistant" if previous_role == "user" else "user", message]
+    if isinstance(message, dict):
+        return [message.get("role", "user"), message.get("content", "")]
+    return [getattr(message, "role", "user"), getattr(message, "content", "")]
+
+
+# Identifies the summarized messages, a summary is only used while they are unchanged
+def messages_hash(messages: List[Any]) -> str:
+    keys = []
+    for message in messages:
+        keys.append(message_key(message, keys[-1][0] if keys else None))
+    return hashlib.sha256(json.dumps(keys).encode("utf-8")).hexdigest()
+
+
+# Whether the summary still matches the first messages (edited or removed turns make it stale)
+def is_current(compaction: Optional[dict], messages: List[Any]) -> bool:
+    if not compaction or not compaction.get("messagesHash"):
+        return False
+    num_messages = compaction["numMessages"]
+    if len(messages) < num_messages:
+        return False
+    return messages_hash(messages[:num_messages]) == compaction["messagesHash"]
+
+
+# Number of leading messages to summarize, or 0 if the thread is under the threshold.
+# The cut is always before a user message so the remaining turns start with one.
+def compaction_cut(llm: Any, messages: List[dict], compacted: int, threshold: int):
+    sizes = [count_tokens(llm, message.get("content", "")) for message in messages]
+    if threshold <= 0 or sum(sizes[compacted:]) <= threshold:
+        return 0
+    recent_budget = int(threshold * RECENT_TURNS_RATIO)
+    cut = len(messages)
+    recent = 0
+    while cut > compacted and recent + sizes[cut - 1] <= recent_budget:
+        cut -= 1
+        recent += sizes[cut]
+    while cut < len(messages) and messages[cut].get("role") != "user":
+        cut += 1
+    return cut if cut > compacted and cut < len(messages) else 0
+
+
+# Blocking, run it through the scheduler
+def summarize(llm: Any, summary: str, messages: List[dict]) -> str:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    prompt = prompt_templates.render(
+        DEFAULT_COMPACTION_TEMPLATE,
+        {"summary": summary or "(none)", "conversation": format_turns(messages)},
+    )
+    message = text_llama_index.completion_to_prompt(prompt, "", None)
+    overrides = {
+        "max_tokens": DEFAULT_SUMMARY_MAX_TOKENS,
+        "temperature": 0.0,
+        "grammar": None,
+    }
+    with text_llama_index.request_generate_kwargs(llm, overrides):
+        response = llm.complete(message, formatted=True)
+    return response.text.strip()
+
+
+def read_thread(thread_id: str) -> Optional[dict]:
+    try:
+        with open(thread_path(thread_id), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_thread(thread_id: str, thread: dict):
+    common.write_json_atomic(thread_path(thread_id), thread)
+
+
+class ThreadCompactor:
+    def __init__(self):
+        # Threads being summarized, one at a time per thread
+        self._running: set[str] = set()
+        # The loop only keeps weak references to tasks
+        self._tasks: set[asyncio.Task] = set()
+        self.compactions = 0
+
+    # Called after a thread is saved, returns right away
+    def schedule(self, app, thread_id: str):
+        threshold = get_threshold()
+        if threshold <= 0 or thread_id in self._running or not app.state.llm:
+            return
+        self._running.add(thread_id)
+        task = asyncio.create_task(self._compact(app, thread_id, threshold))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, app, thread_id: str, threshold: int):
+        try:
+            thread = read_thread(thread_id)
+            if not thread:
+                return
+            messages = thread.get("messages") or []
+            previous = thread.get(COMPACTION_KEY)
+            if not is_current(previous, messages):
+                previous = {}
+            compacted = previous.get("numMessages", 0)
+            llm = app.state.llm
+            cut = compaction_cut(llm, messages, compacted, threshold)
+            if not cut:
+                return
+            summary = await scheduler.run(
+                summarize,
+                llm,
+                previous.get("summary", ""),
+                messages[compacted:cut],
+                priority=Priority.BATCH,
+            )
+            # The thread may have been saved again meanwhile, only the summarized part must match
+            latest = read_thread(thread_id)
+            if not latest or (latest.get("messages") or [])[:cut] != messages[:cut]:
+                return
+            latest[COMPACTION_KEY] = {
+                "summary": summary,
+                "numMessages": cut,
+                "messagesHash": messages_hash(messages[:cut]),
+                "updatedAt": time.time(),
+            }
+            write_thread(thread_id, latest)
+            self.compactions += 1
+            print(
+                f"{common.PRNT_API} Compacted {cut} message(s) of thread [{thread_id}].",
+                flush=True,
+            )
+        except Exception as err:
+            print(f"{common.PRNT_API} Failed to compact thread [{thread_id}]: {err}")
+        finally:
+            self._running.discard(thread_id)
+
+
+# Shared by all requests
+compactor = ThreadCompactor()
+
+
+# Replace the summarized turns of a chat request with the thread's summary,
+# which is added to the system message.
+def apply_compaction(
+    thread_id: str, messages: List[Any], system_message: Optional[str]
+) -> Tuple[List[Any], Optional[str]]:
+    thread = read_thread(thread_id)
+    compaction = (thread or {}).get(COMPACTION_KEY)
+    if not is_current(compaction, messages):
+        return messages, system_message
+    num_messages = compaction["numMessages"]
+    system_message = system_message or text_llama_index.DEFAULT_SYSTEM_MESSAGE
+    system_message = (
+        f"{system_message.strip()}\n\n{SUMMARY_HEADER}\n{compaction['summary']}"
+    )
+    return messages[num_messages:], system_message
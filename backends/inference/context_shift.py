@@ -0,0 +1,99 @@
+###
+# Context shifting for long chats on llama.cpp models.
+# When a conversation no longer fits in n_ctx (leaving room for the reply), its oldest turns are
+# dropped. The system message at the start is always kept (n_keep tokens). If the KV cache still
+# holds the conversation from the last request, the dropped turns are removed from it in place and
+# the turns after them are shifted down, so only the new turn is evaluated.
+###
+from typing import Any, List, Optional, Tuple
+import numpy as np
+
+# Share of the context kept free for the reply when max_tokens is not set
+DEFAULT_REPLY_RATIO = 0.25
+# The reply may take at most this share of the context
+MAX_REPLY_RATIO = 0.5
+# Sequence used by llama-cpp-python
+SEQ_ID = 0
+
+
+# Only a llama-cpp-python Llama exposes its KV cache
+def is_supported(model: Any) -> bool:
+    ctx = getattr(model, "_ctx", None)
+    return hasattr(ctx, "kv_cache_seq_rm") and hasattr(ctx, "kv_cache_seq_shift")
+
+
+def tokenize(model: Any, text: str, add_bos: bool = False) -> List[int]:
+    return model.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+
+# Remove the dropped turns from the KV cache and shift the rest down.
+# Returns the number of evicted tokens, or None if the cache holds a different conversation.
+def shift_cache(
+    model: Any, pinned_tokens: List[int], turn_tokens: List[List[int]], drop: int
+) -> Optional[int]:
+    n_keep = len(pinned_tokens)
+    n_tokens = model.n_tokens
+    cached = model.input_ids[:n_tokens]
+    if n_tokens <= n_keep or not np.array_equal(cached[:n_keep], pinned_tokens):
+        return None
+    kept = [token for tokens in turn_tokens[drop:] for token in tokens]
+    # Turns dropped by earlier requests are already gone, find where the cache starts
+    for start in range(drop + 1):
+        evicted = [token for tokens in turn_tokens[start:drop] for token in tokens]
+        num_evicted = len(evicted)
+        end = n_keep + num_evicted
+        if end >= n_tokens:
+            continue
+        if not np.array_equal(cached[n_keep:end], evicted):
+            continue
+        if cached[end] != kept[0]:
+            continue
+        if num_evicted:
+            model._ctx.kv_cache_seq_rm(SEQ_ID, n_keep, end)
+            model._ctx.kv_cache_seq_shift(SEQ_ID, end, n_tokens, -num_evicted)
+            model.input_ids[n_keep : n_tokens - num_evicted] = model.input_ids[
+                end:n_tokens
+            ].copy()
+            model.n_tokens = n_tokens - num_evicted
+        return num_evicted
+    return None
+
+
+# Tokens of the conversation that fit in the context, the reply's max tokens,
+# and a report of the shift (None when nothing was dropped).
+def prepare_chat_tokens(
+    model: Any, pinned: str, turns: List[str], max_tokens: Optional[int] = None
+) -> Tuple[List[int], int, Optional[dict]]:
+    n_ctx = model.n_ctx()
+    reply_tokens = min(
+        max_tokens or int(n_ctx * DEFAULT_REPLY_RATIO), int(n_ctx * MAX_REPLY_RATIO)
+    )
+    budget = n_ctx - reply_tokens
+    pinned_tokens = tokenize(model, pinned, add_bos=True)
+    turn_tokens = [tokenize(model, turn) for turn in turns]
+    total = len(pinned_tokens) + sum(len(tokens) for tokens in turn_tokens)
+    # Drop the oldest turns, the newest one is always kept
+    drop = 0
+    while total > budget and drop < len(turn_tokens) - 1:
+        total -= len(turn_tokens[drop])
+        drop += 1
+    if total > budget:
+        raise Exception(
+            f"The prompt ({total} tokens) does not fit in the context window ({n_ctx} tokens)."
+        )
+    tokens = pinned_tokens + [token for item in turn_tokens[drop:] for token in item]
+    if drop == 0:
+        return tokens, reply_tokens, None
+    evicted = shift_cache(model, pinned_tokens, turn_tokens, drop)
+    shift = {
+        "n_keep": len(pinned_tokens),
+        "n_ctx": n_ctx,
+        "dropped_turns": drop,
+        "dropped_tokens": sum(len(item) for item in turn_tokens[:drop]),
+        # Tokens removed from the KV cache by this request
+        "evicted_tokens": evicted or 0,
+        # False when the conversation had to be evaluated again
+        "in_place": evicted is not None,
+        "prompt_tokens": len(tokens),
+    }
+    return tokens, reply_tokens, shift
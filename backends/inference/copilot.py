@@ -0,0 +1,185 @@
+###
+# Code completion for editors (/v1/text/copilot).
+# The code before and after the cursor is formatted as a fill-in-the-middle (FIM) prompt for the
+# loaded code model and only a few tokens are generated.
+#
+# Latency:
+# - llama.cpp keeps the evaluated tokens of the last prompt and only processes what comes after the
+#   longest shared start. Prompts put the prefix first, and the window of code kept before the cursor
+#   starts at a line that only moves in big steps, so consecutive keystrokes on the same file
+#   re-use almost all of the prefix's KV cache.
+# - Each client's newest request supersedes the older ones. Those are dropped while they wait for
+#   the model or stop generating at the next token.
+###
+import time
+import threading
+from typing import Any, List, Optional
+from core import common
+from inference import prompt_templates, text_llama_index
+
+DEFAULT_COPILOT_MAX_TOKENS = 64
+DEFAULT_MAX_PREFIX_CHARS = 6000
+DEFAULT_MAX_SUFFIX_CHARS = 1500
+# The prefix window's start moves in steps of this size
+PREFIX_WINDOW_STEP_CHARS = 1500
+DEFAULT_FIM_FORMAT = "codellama"
+# Prompt and end tokens per model family. All are prefix-suffix-middle ordered.
+FIM_FORMATS = {
+    "codellama": {
+        "template": "<PRE> {prefix} <SUF>{suffix} <MID>",
+        "stop": ["<EOT>"],
+    },
+    "starcoder": {
+        "template": "<fim_prefix>{prefix}<fim_suffix>{suffix}<fim_middle>",
+        "stop": ["<|endoftext|>", "<file_sep>"],
+    },
+    "deepseek": {
+        "template": "<｜fim▁begin｜>{prefix}<｜fim▁hole｜>{suffix}<｜fim▁end｜>",
+        "stop": ["<｜end▁of▁sentence｜>", "<|EOT|>"],
+    },
+    "codegemma": {
+        "template": "<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>",
+        "stop": ["<|file_separator|>", "<end_of_turn>"],
+    },
+    "qwen": {
+        "template": "<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>",
+        "stop": ["<|endoftext|>", "<|file_sep|>"],
+    },
+}
+# Model file names -> FIM format, first match wins
+FIM_MODEL_NAMES = [
+    ("codellama", "codellama"),
+    ("code-llama", "codellama"),
+    ("starcoder", "starcoder"),
+    ("stable-code", "starcoder"),
+    ("deepseek-coder", "deepseek"),
+    ("codegemma", "codegemma"),
+    ("qwen", "qwen"),
+]
+
+
+def get_fim_format(name: Optional[str], path_to_model: Optional[str]) -> dict:
+    if name:
+        fim_format = FIM_FORMATS.get(name)
+        if not fim_format:
+            raise Exception(f"No FIM format named [{name}].")
+        return fim_format
+    model_name = (path_to_model or "").lower()
+    for keyword, format_name in FIM_MODEL_NAMES:
+        if keyword in model_name:
+            return FIM_FORMATS[format_name]
+    return FIM_FORMATS[DEFAULT_FIM_FORMAT]
+
+
+# Keep the end of the prefix. The cut is rounded to a step and then to the next line,
+# so it stays put while typing and the start of the prompt does not change.
+def window_prefix(prefix: str, max_chars: int = DEFAULT_MAX_PREFIX_CHARS) -> str:
+    overflow = len(prefix) - max_chars
+    if overflow <= 0:
+        return prefix
+    steps = -(-overflow // PREFIX_WINDOW_STEP_CHARS)
+    start = steps * PREFIX_WINDOW_STEP_CHARS
+    line_start = prefix.find("\n", start)
+    if line_start != -1:
+        start = line_start + 1
+    return prefix[start:]
+
+
+# Keep the start of the suffix, cut at a line end
+def window_suffix(suffix: str, max_chars: int = DEFAULT_MAX_SUFFIX_CHARS) -> str:
+    if len(suffix) <= max_chars:
+        return suffix
+    line_end = suffix.rfind("\n", 0, max_chars)
+    return suffix[: line_end if line_end > 0 else max_chars]
+
+
+def fim_prompt(prefix: str, suffix: str, fim_format: dict) -> str:
+    return prompt_templates.render(
+        fim_format["template"],
+        {"prefix": window_prefix(prefix), "suffix": window_suffix(suffix)},
+    )
+
+
+# Tracks the newest request of each client
+class CopilotSessions:
+    def __init__(self):
+        self._generations: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.superseded = 0
+
+    # Returns the new request's generation
+    def start(self, client_id: Optional[str]) -> int:
+        if not client_id:
+            return 0
+        with self._lock:
+            generation = self._generations.get(client_id, 0) + 1
+            self._generations[client_id] = generation
+            return generation
+
+    def is_current(self, client_id: Optional[str], generation: int) -> bool:
+        if not client_id:
+            return True
+        return self._generations.get(client_id) == generation
+
+    def end(self, client_id: Optional[str], generation: int):
+        if not client_id:
+            return
+        with self._lock:
+            if self._generations.get(client_id) == generation:
+                del self._generations[client_id]
+
+
+# Shared by all requests
+sessions = CopilotSessions()
+
+
+# Blocking, run it through the scheduler. Returns None if a newer request from the client came in.
+def complete(
+    llm: Any,
+    prefix: str,
+    suffix: str,
+    fim_format: dict,
+    client_id: Optional[str],
+    generation: int,
+    max_tokens: int = DEFAULT_COPILOT_MAX_TOKENS,
+    temperature: float = 0.0,
+    stop: Optional[List[str]] = None,
+    multiline: bool = True,
+) -> Optional[dict]:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    if not sessions.is_current(client_id, generation):
+        sessions.superseded += 1
+        return None
+    start_time = time.perf_counter()
+    prompt = fim_prompt(prefix, suffix, fim_format)
+    stop_words = [*fim_format["stop"], *(stop or [])]
+    if not multiline:
+        stop_words.append("\n")
+    overrides = {
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stop": stop_words,
+        "grammar": None,
+        "echo": False,
+    }
+    text = ""
+    num_tokens = 0
+    with text_llama_index.request_generate_kwargs(llm, overrides):
+        token_generator = llm.stream_complete(prompt, formatted=True)
+        try:
+            for token in token_generator:
+                if not sessions.is_current(client_id, generation):
+                    sessions.superseded += 1
+                    return None
+                text += token.delta
+                num_tokens += 1
+        finally:
+            # Stops any further generation
+            token_generator.close()
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    print(
+        f"{common.PRNT_API} Copilot completion: {num_tokens} tokens in {elapsed_ms:.0f}ms",
+        flush=True,
+    )
+    return {"text": text, "tokens": num_tokens, "elapsed_ms": round(elapsed_ms, 1)}
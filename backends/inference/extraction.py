@@ -0,0 +1,142 @@
+###
+# Structured data extraction. The model's output is constrained by the grammar of a json schema
+# and then validated against the same schema.
+# Schemas describe an object and are given inline or by id (the name or id of a tool, whose
+# Params schema is used).
+# Compiled grammars come from the shared grammar registry, validators are cached here.
+###
+import json
+from functools import lru_cache
+from typing import Any, List, Optional
+from inference import agent, grammars, prompt_templates, text_llama_index, tool_registry
+
+DEFAULT_EXTRACTION_MAX_TOKENS = 512
+DEFAULT_MAX_VALIDATORS = 32
+# Placeholders: {text} the document, {schema} the json schema
+DEFAULT_EXTRACTION_TEMPLATE = """Extract the data described by this JSON schema from the text below.
+
+Schema:
+```json
+{schema}
+```
+
+Text:
+{text}
+"""
+JSON_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "object": (dict,),
+    "array": (list,),
+    "null": (type(None),),
+}
+
+
+# Validates the json schema keywords that grammars support ($ref, anyOf/oneOf, const, enum,
+# type, properties, required, items). Returns a list of errors, empty when valid.
+class SchemaValidator:
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self.defs = schema.get("$defs", {})
+
+    def validate(self, value: Any) -> List[str]:
+        errors = []
+        self._check(value, self.schema, "$", errors)
+        return errors
+
+    def _check(self, value: Any, schema: dict, path: str, errors: List[str]):
+        if "$ref" in schema:
+            name = schema["$ref"].split("/")[-1]
+            self._check(value, self.defs.get(name, {}), path, errors)
+            return
+        options = schema.get("anyOf") or schema.get("oneOf")
+        if options:
+            for option in options:
+                option_errors = []
+                self._check(value, option, path, option_errors)
+                if not option_errors:
+                    return
+            errors.append(f"{path}: does not match any of the allowed schemas")
+            return
+        if "const" in schema and value != schema["const"]:
+            errors.append(f"{path}: must be {json.dumps(schema['const'])}")
+            return
+        if "enum" in schema and value not in schema["enum"]:
+            errors.append(f"{path}: must be one of {json.dumps(schema['enum'])}")
+            return
+        schema_type = schema.get("type")
+        if schema_type in JSON_TYPES:
+            # bool is a subclass of int in python
+            is_bool = isinstance(value, bool)
+            if not isinstance(value, JSON_TYPES[schema_type]) or (
+                is_bool and schema_type != "boolean"
+            ):
+                errors.append(f"{path}: must be of type {schema_type}")
+                return
+        if isinstance(value, dict):
+            for name in schema.get("required", []):
+                if name not in value:
+                    errors.append(f"{path}: missing required property [{name}]")
+            for name, prop_schema in schema.get("properties", {}).items():
+                if name in value:
+                    self._check(value[name], prop_schema, f"{path}.{name}", errors)
+        if isinstance(value, list) and "items" in schema:
+            for index, item in enumerate(value):
+                self._check(item, schema["items"], f"{path}[{index}]", errors)
+
+
+@lru_cache(maxsize=DEFAULT_MAX_VALIDATORS)
+def _get_validator(schema_json: str) -> SchemaValidator:
+    return SchemaValidator(json.loads(schema_json))
+
+
+def get_validator(schema: dict) -> SchemaValidator:
+    return _get_validator(json.dumps(schema, sort_keys=True))
+
+
+# Inline schema, or the Params schema of the tool with this name/id
+def resolve_schema(json_schema: Optional[dict], schema_id: Optional[str]) -> dict:
+    if json_schema:
+        return json_schema
+    if not schema_id:
+        raise Exception("Provide a 'jsonSchema' or 'schemaId'.")
+    tool_def = tool_registry.registry.get(
+        schema_id
+    ) or tool_registry.registry.get_by_id(schema_id)
+    if not tool_def:
+        raise Exception(f"No schema found with id [{schema_id}].")
+    return agent.get_tool_schema(tool_def["path"])
+
+
+# Blocking, run it through the scheduler
+def extract(
+    llm: Any,
+    text: str,
+    schema: dict,
+    prompt_template: Optional[str] = None,
+    system_message: Optional[str] = None,
+    message_format: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+) -> dict:
+    if llm == None:
+        raise Exception("No Ai loaded.")
+    grammar = grammars.registry.from_json_schema(schema)
+    validator = get_validator(schema)
+    prompt = prompt_templates.render(
+        prompt_template or DEFAULT_EXTRACTION_TEMPLATE,
+        {"text": text, "schema": json.dumps(schema, indent=2)},
+    )
+    message = text_llama_index.completion_to_prompt(
+        prompt, system_message or "", message_format
+    )
+    json_stream, _ = agent.generate_json(
+        llm, message, grammar, max_tokens or DEFAULT_EXTRACTION_MAX_TOKENS
+    )
+    try:
+        data = json_stream.result()
+    except Exception as err:
+        return {"success": False, "data": None, "errors": [f"{err}"]}
+    errors = validator.validate(data)
+    return {"success": not errors, "data": data, "errors": errors}
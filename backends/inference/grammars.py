@@ -0,0 +1,78 @@
+###
+# Compiled grammars for constrained sampling.
+# Parsing a GBNF grammar (or converting a JSON schema to one) is done in Python and is slow,
+# so each grammar is compiled once, keyed by a hash of its content and kept in an LRU cache.
+###
+import json
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+from typing import Optional, Type
+from pydantic import BaseModel
+from llama_cpp import LlamaGrammar
+
+DEFAULT_MAX_GRAMMARS = 32
+GBNF_KEY = "gbnf"  # InferenceRequest.grammar may be {"gbnf": "..."}, otherwise a JSON schema
+
+
+class GrammarRegistry:
+    def __init__(self, max_size: int = DEFAULT_MAX_GRAMMARS):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._grammars: OrderedDict[str, LlamaGrammar] = OrderedDict()
+        self._lock = Lock()
+
+    def _get_or_compile(self, kind: str, content: str, compile) -> LlamaGrammar:
+        key = f"{kind}:{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+                return grammar
+            self.misses += 1
+        # Compile outside the lock, a duplicate compile is cheaper than blocking all requests
+        grammar = compile(content)
+        with self._lock:
+            self._grammars[key] = grammar
+            self._grammars.move_to_end(key)
+            while len(self._grammars) > self.max_size:
+                self._grammars.popitem(last=False)
+        return grammar
+
+    def from_gbnf(self, gbnf: str) -> LlamaGrammar:
+        return self._get_or_compile(
+            "gbnf", gbnf, lambda g: LlamaGrammar.from_string(g, verbose=False)
+        )
+
+    def from_json_schema(self, schema: dict) -> LlamaGrammar:
+        # Key order should not produce a new grammar
+        content = json.dumps(schema, sort_keys=True)
+        return self._get_or_compile(
+            "json",
+            content,
+            lambda s: LlamaGrammar.from_json_schema(s, verbose=False),
+        )
+
+    def from_model(self, model: Type[BaseModel]) -> LlamaGrammar:
+        return self.from_json_schema(model.model_json_schema())
+
+    def from_request(self, grammar: Optional[dict]) -> Optional[LlamaGrammar]:
+        if not grammar:
+            return None
+        gbnf = grammar.get(GBNF_KEY)
+        if isinstance(gbnf, str):
+            return self.from_gbnf(gbnf)
+        return self.from_json_schema(grammar)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._grammars),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Shared by all requests
+registry = GrammarRegistry()
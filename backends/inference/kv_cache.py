@@ -0,0 +1,111 @@
+###
+# KV cache options for llama.cpp models. The cache holds a K and a V vector per layer for every
+# token of the context, so for a large n_ctx it can take more memory than the model itself.
+# Storing it quantized (ie q8_0 takes ~half of f16) trades a little precision for context length.
+#
+# The pinned llama-cpp-python (0.2.32) has no type_k/type_v arguments, they are set on the context
+# params it creates while the model loads. Its llama.cpp has no flash attention, which quantized V
+# caches need, so only the K cache may be quantized.
+###
+import threading
+from contextlib import contextmanager
+from typing import Any, Optional, Tuple
+import llama_cpp
+
+# name -> (ggml_type, bytes per value)
+KV_CACHE_TYPES = {
+    "f32": (0, 4.0),
+    "f16": (1, 2.0),
+    "q8_0": (8, 34 / 32),
+    "q5_1": (7, 24 / 32),
+    "q5_0": (6, 22 / 32),
+    "q4_1": (3, 20 / 32),
+    "q4_0": (2, 18 / 32),
+}
+# Without flash attention the V cache can not be quantized
+V_CACHE_TYPES = ["f32", "f16"]
+SUPPORTS_FLASH_ATTN = False
+DEFAULT_CACHE_TYPE = "f16"
+_params_lock = threading.Lock()
+
+
+# K and V cache types to load with, raises if the settings are not supported
+def resolve_cache_types(init_settings: Any) -> Tuple[str, str]:
+    # f16_kv=False asked for a full precision cache
+    default_type = DEFAULT_CACHE_TYPE if init_settings.f16_kv != False else "f32"
+    type_k = init_settings.type_k or default_type
+    type_v = init_settings.type_v or default_type
+    if type_k not in KV_CACHE_TYPES:
+        raise Exception(
+            f"Unsupported K cache type [{type_k}]. Use one of: {', '.join(KV_CACHE_TYPES)}."
+        )
+    if type_v not in KV_CACHE_TYPES:
+        raise Exception(
+            f"Unsupported V cache type [{type_v}]. Use one of: {', '.join(KV_CACHE_TYPES)}."
+        )
+    if init_settings.flash_attn and not SUPPORTS_FLASH_ATTN:
+        raise Exception("Flash attention is not supported by this llama.cpp version.")
+    if type_v not in V_CACHE_TYPES and not init_settings.flash_attn:
+        raise Exception(
+            f"A quantized V cache [{type_v}] needs flash attention. Use f16 or f32."
+        )
+    return type_k, type_v
+
+
+# Models created inside this block use the given cache types
+@contextmanager
+def context_params(type_k: str, type_v: str):
+    low_level = llama_cpp.llama_cpp
+    with _params_lock:
+        default_params = low_level.llama_context_default_params
+
+        def params_with_cache_types():
+            params = default_params()
+            params.type_k = KV_CACHE_TYPES[type_k][0]
+            params.type_v = KV_CACHE_TYPES[type_v][0]
+            return params
+
+        low_level.llama_context_default_params = params_with_cache_types
+        try:
+            yield
+        finally:
+            low_level.llama_context_default_params = default_params
+
+
+# Size of the KV cache from the model's GGUF metadata, None if it is unknown
+def estimate_memory(
+    metadata: dict, n_ctx: int, type_k: str, type_v: str
+) -> Optional[dict]:
+    try:
+        arch = metadata["general.architecture"]
+        n_layer = int(metadata[f"{arch}.block_count"])
+        n_embd = int(metadata[f"{arch}.embedding_length"])
+        n_head = int(metadata[f"{arch}.attention.head_count"])
+        n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+    except (KeyError, ValueError):
+        return None
+    # Models with grouped query attention store fewer heads
+    values = n_layer * n_ctx * (n_embd // n_head) * n_head_kv
+    k_bytes = values * KV_CACHE_TYPES[type_k][1]
+    v_bytes = values * KV_CACHE_TYPES[type_v][1]
+    f16_bytes = values * KV_CACHE_TYPES["f16"][1] * 2
+    mb = 1024 * 1024
+    return {
+        "n_ctx": n_ctx,
+        "type_k": type_k,
+        "type_v": type_v,
+        "k_mb": round(k_bytes / mb, 1),
+        "v_mb": round(v_bytes / mb, 1),
+        "total_mb": round((k_bytes + v_bytes) / mb, 1),
+        "saved_vs_f16_mb": round((f16_bytes - k_bytes - v_bytes) / mb, 1),
+        "per_token_kb": round((k_bytes + v_bytes) / n_ctx / 1024, 2),
+    }
+
+
+# KV cache size of a loaded model, None for backends without one
+def model_memory(llm: Any, type_k: str, type_v: str) -> Optional[dict]:
+    model = getattr(llm, "_model", None)
+    metadata = getattr(model, "metadata", None)
+    if not metadata:
+        return None
+    return estimate_memory(metadata, model.n_ctx(), type_k, type_v)
@@ -0,0 +1,254 @@
+###
+# LoRA adapters on the resident llama.cpp model. Adapters are registered by name (kept in
+# settings/lora_adapters.json) and a bot picks one with model.loraAdapter, so bots that only differ
+# by a fine-tune share one loaded base model. When a request gets its turn on the model (scheduler
+# slot), the adapter it asked for is swapped in: the active one is removed and the new one applied
+# to the weights in place, without reloading them.
+#
+# The pinned llama-cpp-python (0.2.32) can only merge an adapter into the weights, it has no way
+# to detach one. Removing an adapter merges it again with the opposite scale or, when it was
+# registered with a base (f16) model, with scale 0 which rebuilds the changed weights from the base.
+# Quantized models without a base lose a little precision with each swap.
+# The model must be loaded with use_mmap=false, mapped weights are read-only.
+#
+# Adapter files are held in memory (LRU, LORA_CACHE_MB) so a swap does not read them from disk.
+###
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any, List, Optional
+from core import common, settings_store
+from inference.scheduler import run_in_thread
+
+LORA_ADAPTERS_FILENAME = "lora_adapters.json"
+LORA_ADAPTERS_FILEPATH = os.path.join(common.APP_SETTINGS_PATH, LORA_ADAPTERS_FILENAME)
+DEFAULT_CACHE_MB = 512
+ADAPTER_EXTENSIONS = (".gguf", ".bin")
+
+# Adapter asked for by the current request, "" for the plain base model. Requests that do not name
+# one (and background work like summaries) run with whatever adapter is active, ie the one set
+# with /lora-adapter/activate.
+requested_adapter: ContextVar[Optional[str]] = ContextVar(
+    "requested_adapter", default=None
+)
+
+
+def get_cache_limit() -> int:
+    return int(os.getenv("LORA_CACHE_MB", DEFAULT_CACHE_MB)) * 1024 * 1024
+
+
+# Adapter files kept in anonymous memory files, least recently used ones are dropped first.
+# llama.cpp opens adapters by path, so it is handed /proc/self/fd/<fd> of the memory file.
+class AdapterFileCache:
+    def __init__(self):
+        # path -> (fd, size, mtime)
+        self._files: OrderedDict[str, tuple[int, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, "memfd_create") and os.path.isdir("/proc/self/fd")
+
+    def size(self) -> int:
+        return sum(item[1] for item in self._files.values())
+
+    # Path to read the adapter from, its cached copy when it fits in the cache
+    def open(self, path: str) -> str:
+        if not self.is_supported():
+            return path
+        with self._lock:
+            mtime = os.path.getmtime(path)
+            cached = self._files.get(path)
+            if cached and cached[2] == mtime:
+                self._files.move_to_end(path)
+                self.hits += 1
+                return f"/proc/self/fd/{cached[0]}"
+            self.misses += 1
+            if cached:
+                self._drop(path)
+            size = os.path.getsize(path)
+            limit = get_cache_limit()
+            if size > limit:
+                return path
+            while self._files and self.size() + size > limit:
+                self._drop(next(iter(self._files)))
+                self.evictions += 1
+            fd = os.memfd_create(os.path.basename(path))
+            with open(path, "rb") as file, os.fdopen(fd, "wb", closefd=False) as memory:
+                while chunk := file.read(16 * 1024 * 1024):
+                    memory.write(chunk)
+            self._files[path] = (fd, size, mtime)
+            return f"/proc/self/fd/{fd}"
+
+    def _drop(self, path: str):
+        fd, _, _ = self._files.pop(path)
+        os.close(fd)
+
+    def clear(self):
+        with self._lock:
+            for path in list(self._files):
+                self._drop(path)
+
+    def stats(self) -> dict:
+        return {
+            "files": list(self._files),
+            "size_mb": round(self.size() / 1024 / 1024, 1),
+            "limit_mb": round(get_cache_limit() / 1024 / 1024, 1),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class LoraAdapterManager:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.adapters: dict[str, dict] = {}
+        self.files = AdapterFileCache()
+        self._loaded = False
+        # Resident model and the adapter merged into it
+        self._llm: Any = None
+        self._use_mmap = True
+        self.active: Optional[str] = None
+        self.swaps = 0
+        self.last_swap_secs: Optional[float] = None
+        # Removals that could not rebuild the weights from a base model
+        self.drifting_removals = 0
+
+    def _load(self):
+        if self._loaded:
+            return
+        data = common.get_settings_file(common.APP_SETTINGS_PATH, self.filepath)
+        self.adapters = data or {}
+        self._loaded = True
+
+    def _save(self):
+        settings_store.get_store(self.filepath).write(self.adapters)
+
+    def list(self) -> List[dict]:
+        self._load()
+        return list(self.adapters.values())
+
+    def get(self, name: str) -> dict:
+        self._load()
+        adapter = self.adapters.get(name)
+        if not adapter:
+            raise Exception(f"No LoRA adapter registered as [{name}].")
+        return adapter
+
+    def register(
+        self, name: str, path: str, scale: float = 1.0, base: Optional[str] = None
+    ) -> dict:
+        self._load()
+        if not name:
+            raise Exception("A LoRA adapter needs a name.")
+        if not path.endswith(ADAPTER_EXTENSIONS) or not os.path.isfile(path):
+            raise Exception(f"No LoRA adapter file found at [{path}].")
+        if base and not os.path.isfile(base):
+            raise Exception(f"No base model file found at [{base}].")
+        if name == self.active:
+            raise Exception(f"LoRA adapter [{name}] is in use, remove it first.")
+        adapter = {"name": name, "path": path, "scale": scale, "base": base}
+        self.adapters[name] = adapter
+        self._save()
+        return adapter
+
+    def unregister(self, name: str):
+        self.get(name)
+        if name == self.active:
+            raise Exception(f"LoRA adapter [{name}] is in use, remove it first.")
+        del self.adapters[name]
+        self._save()
+
+    # Called when a llama.cpp model is loaded, it starts without an adapter
+    def attach(self, llm: Any, use_mmap: bool):
+        self._llm = llm
+        self._use_mmap = use_mmap
+        self.active = None
+
+    def detach(self):
+        self._llm = None
+        self.active = None
+
+    # Blocking, only call it while holding the scheduler slot
+    def activate(self, name: Optional[str]):
+        if name == self.active:
+            return
+        if name:
+            self.get(name)
+        if self._llm is None:
+            raise Exception("LoRA adapters need a loaded llama.cpp model.")
+        if self._use_mmap:
+            raise Exception(
+                "Load the model with use_mmap=false to apply LoRA adapters."
+            )
+        start = time.time()
+        if self.active:
+            self._merge(self.adapters.get(self.active), remove=True)
+            self.active = None
+        if name:
+            self._merge(self.adapters[name])
+            self.active = name
+        # The KV cache was computed with the old weights
+        self._llm._model.reset()
+        self.swaps += 1
+        self.last_swap_secs = round(time.time() - start, 3)
+        print(
+            f"{common.PRNT_API} LoRA adapter [{name or 'none'}] active ({self.last_swap_secs}s)",
+            flush=True,
+        )
+
+    def _merge(self, adapter: Optional[dict], remove: bool = False):
+        if not adapter:
+            raise Exception(
+                "The active LoRA adapter is no longer registered, reload the model."
+            )
+        scale = adapter["scale"]
+        base = adapter.get("base")
+        if remove:
+            # With a base the weights are rebuilt from it, otherwise the adapter is subtracted
+            scale = 0.0 if base else -scale
+            if not base:
+                self.drifting_removals += 1
+        model = self._llm._model
+        result = model._model.apply_lora_from_file(
+            self.files.open(adapter["path"]), scale, base, model.n_threads
+        )
+        if result != 0:
+            raise Exception(
+                f"Failed to {'remove' if remove else 'apply'} LoRA adapter [{adapter['name']}]."
+            )
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "swaps": self.swaps,
+            "last_swap_secs": self.last_swap_secs,
+            "drifting_removals": self.drifting_removals,
+            "cache": self.files.stats(),
+        }
+
+
+_manager: Optional[LoraAdapterManager] = None
+
+
+def get_manager() -> LoraAdapterManager:
+    global _manager
+    if _manager is None:
+        _manager = LoraAdapterManager(LORA_ADAPTERS_FILEPATH)
+    return _manager
+
+
+# Scheduler hook, swaps in the adapter of the request that got the slot.
+# The slot is held until the weights are merged, even if the request goes away.
+async def activate_requested():
+    manager = get_manager()
+    name = requested_adapter.get()
+    if name is None or (name or None) == manager.active:
+        return
+    await run_in_thread(manager.activate, name or None)
@@ -0,0 +1,253 @@
+###
+# Index of the model files in the HuggingFace cache (text_models), kept in
+# settings/model_cache_index.json as repo -> filename -> {blob_path, size, revision}.
+# Downloads and deletes update it as they happen, so looking up a file no longer scans the whole
+# cache (scan_cache_dir). It is reconciled lazily: only repos whose folder appeared, went away or
+# lost a file are read from disk again.
+###
+import os
+import json
+import shutil
+import threading
+from typing import List, Optional
+from huggingface_hub.file_download import repo_folder_name
+from core import common
+
+INDEX_FILENAME = "model_cache_index.json"
+INDEX_VERSION = 1
+REPO_FOLDER_PREFIX = "models--"
+REVISION = "main"
+# Partial downloads in blobs/, ours (model_downloads) and the hub's
+INCOMPLETE_SUFFIX = ".incomplete"
+
+
+def format_size(num_bytes: int) -> str:
+    size = float(num_bytes)
+    for unit in ["", "K", "M", "G", "T"]:
+        if size < 1000 or unit == "T":
+            return f"{size:.1f}{unit}"
+        size /= 1000
+
+
+def repo_id_from_folder(folder_name: str) -> str:
+    return "/".join(folder_name[len(REPO_FOLDER_PREFIX) :].split("--"))
+
+
+# An installed model record with its paths, sizes and revisions from the index
+def with_cached_files(metadata: dict, files: dict[str, dict]) -> dict:
+    return {
+        **metadata,
+        "savePath": {name: entry["blob_path"] for name, entry in files.items()},
+        "files": {
+            name: {"size": entry["size"], "revision": entry["revision"]}
+            for name, entry in files.items()
+        },
+    }
+
+
+class ModelCacheIndex:
+    def __init__(self, cache_dir: str, index_path: str):
+        self.cache_dir = cache_dir
+        self.index_path = index_path
+        # repo_id -> filename -> entry
+        self._repos: Optional[dict[str, dict[str, dict]]] = None
+        self._lock = threading.RLock()
+
+    def _storage_folder(self, repo_id: str) -> str:
+        return os.path.join(
+            self.cache_dir, repo_folder_name(repo_id=repo_id, repo_type="model")
+        )
+
+    def _load(self) -> dict:
+        if self._repos is not None:
+            return self._repos
+        try:
+            with open(self.index_path, "r") as file:
+                data = json.load(file)
+            if data.get("version") != INDEX_VERSION:
+                raise ValueError("Old index version")
+            self._repos = data["repos"]
+        except (OSError, ValueError, KeyError):
+            # First run or unreadable, build it from the cache once
+            self._repos = {}
+            for folder_name in self._repo_folders():
+                repo_id = repo_id_from_folder(folder_name)
+                files = self._scan_repo(repo_id)
+                if files:
+                    self._repos[repo_id] = files
+            self._save()
+        return self._repos
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        common.write_json_atomic(
+            self.index_path, {"version": INDEX_VERSION, "repos": self._repos}
+        )
+
+    def _repo_folders(self) -> List[str]:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [
+            name
+            for name in os.listdir(self.cache_dir)
+            if name.startswith(REPO_FOLDER_PREFIX)
+            and os.path.isdir(os.path.join(self.cache_dir, name))
+        ]
+
+    # Files of one repo on disk, the revision refs/main points to wins
+    def _scan_repo(self, repo_id: str) -> dict[str, dict]:
+        storage_folder = self._storage_folder(repo_id)
+        snapshots_path = os.path.join(storage_folder, "snapshots")
+        if not os.path.isdir(snapshots_path):
+            return {}
+        main_commit = None
+        try:
+            with open(os.path.join(storage_folder, "refs", REVISION), "r") as file:
+                main_commit = file.read().strip()
+        except OSError:
+            pass
+        files = {}
+        for revision in os.listdir(snapshots_path):
+            snapshot_path = os.path.join(snapshots_path, revision)
+            for root, _, names in os.walk(snapshot_path):
+                for name in names:
+                    pointer_path = os.path.join(root, name)
+                    filename = os.path.relpath(pointer_path, snapshot_path)
+                    filename = filename.replace(os.sep, "/")
+                    blob_path = os.path.realpath(pointer_path)
+                    if not os.path.isfile(blob_path):
+                        continue
+                    if filename in files and revision != main_commit:
+                        continue
+                    files[filename] = {
+                        "blob_path": blob_path,
+                        "size": os.path.getsize(blob_path),
+                        "revision": revision,
+                    }
+        return files
+
+    def _rescan_repo(self, repo_id: str):
+        repos = self._load()
+        files = self._scan_repo(repo_id)
+        if files:
+            repos[repo_id] = files
+        else:
+            repos.pop(repo_id, None)
+        self._save()
+
+    # Entry of a cached file, None if it is not in the cache
+    def get_file(self, repo_id: str, filename: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._load().get(repo_id, {}).get(filename)
+            if entry and os.path.isfile(entry["blob_path"]):
+                return entry
+            # Missing or removed outside of the app
+            self._rescan_repo(repo_id)
+            return self._load().get(repo_id, {}).get(filename)
+
+    def add_file(
+        self, repo_id: str, filename: str, blob_path: str, size: int, revision: str
+    ) -> dict:
+        with self._lock:
+            entry = {"blob_path": blob_path, "size": size, "revision": revision}
+            self._load().setdefault(repo_id, {})[filename] = entry
+            self._save()
+            return entry
+
+    # Remove a repo and all its files from the cache, returns the bytes freed
+    def delete_repo(self, repo_id: str) -> int:
+        with self._lock:
+            repos = self._load()
+            files = repos.pop(repo_id, None)
+            if files is None:
+                files = self._scan_repo(repo_id)
+            # Revisions can share a blob
+            freed = sum(
+                {entry["blob_path"]: entry["size"] for entry in files.values()}.values()
+            )
+            storage_folder = self._storage_folder(repo_id)
+            if os.path.isdir(storage_folder):
+                shutil.rmtree(storage_folder)
+            self._save()
+            return freed
+
+    # Remove one file (all its revisions) of a repo, returns the bytes freed
+    def delete_file(self, repo_id: str, filename: str) -> int:
+        with self._lock:
+            repos = self._load()
+            files = repos.get(repo_id) or self._scan_repo(repo_id)
+            storage_folder = self._storage_folder(repo_id)
+            snapshots_path = os.path.join(storage_folder, "snapshots")
+            blob_paths = set()
+            if os.path.isdir(snapshots_path):
+                for revision in os.listdir(snapshots_path):
+                    pointer_path = os.path.join(snapshots_path, revision, filename)
+                    if os.path.lexists(pointer_path):
+                        blob_paths.add(os.path.realpath(pointer_path))
+                        os.remove(pointer_path)
+            remaining = {
+                name: entry for name, entry in files.items() if name != filename
+            }
+            # Blobs are shared by files with the same content
+            in_use = {entry["blob_path"] for entry in remaining.values()}
+            freed = 0
+            for blob_path in blob_paths - in_use:
+                if os.path.isfile(blob_path):
+                    freed += os.path.getsize(blob_path)
+                    os.remove(blob_path)
+            if remaining:
+                repos[repo_id] = remaining
+            else:
+                repos.pop(repo_id, None)
+                # Keep the folder of a repo with a file being downloaded
+                if os.path.isdir(storage_folder) and not self._downloading(repo_id):
+                    shutil.rmtree(storage_folder)
+            self._save()
+            return freed
+
+    def _downloading(self, repo_id: str) -> bool:
+        blobs_path = os.path.join(self._storage_folder(repo_id), "blobs")
+        if not os.path.isdir(blobs_path):
+            return False
+        return any(name.endswith(INCOMPLETE_SUFFIX) for name in os.listdir(blobs_path))
+
+    # All cached repos, repos added or removed outside of the app are picked up
+    def list(self) -> dict[str, dict[str, dict]]:
+        with self._lock:
+            repos = self._load()
+            on_disk = {repo_id_from_folder(name) for name in self._repo_folders()}
+            changed = False
+            for repo_id in list(repos):
+                if repo_id not in on_disk:
+                    del repos[repo_id]
+                    changed = True
+            for repo_id in on_disk:
+                files = repos.get(repo_id)
+                if files and all(
+                    os.path.isfile(entry["blob_path"]) for entry in files.values()
+                ):
+                    continue
+                files = self._scan_repo(repo_id)
+                # A folder with only a download in progress has no files yet
+                if files:
+                    repos[repo_id] = files
+                    changed = True
+                elif repo_id in repos:
+                    del repos[repo_id]
+                    changed = True
+            if changed:
+                self._save()
+            return {repo_id: dict(files) for repo_id, files in repos.items()}
+
+
+_index: Optional[ModelCacheIndex] = None
+
+
+def get_index() -> ModelCacheIndex:
+    global _index
+    if _index is None:
+        _index = ModelCacheIndex(
+            common.app_path(common.TEXT_MODELS_CACHE_DIR),
+            os.path.join(common.APP_SETTINGS_PATH, INDEX_FILENAME),
+        )
+    return _index
@@ -0,0 +1,571 @@
+###
+# Background model downloads from the HuggingFace hub. A download is a job with an id, it runs on
+# the event loop and never ties up a request. Large files are split in HTTP range segments that
+# download in parallel and each segment resumes where it stopped, after a dropped connection or a
+# restart of the server. The sha256 of the file is computed while it downloads (in file order, from
+# the part already on disk) and checked against the hub's etag before the file is used.
+#
+# Files land in the same HuggingFace cache layout hf_hub_download uses (blobs, snapshots, refs), so
+# the rest of the app finds them as before. Set HF_ENDPOINT to download from another hub.
+#
+# Job state is kept in downloads/<id>.json, the data in blobs/<etag>.incomplete until it is verified.
+###
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import List, Optional
+from urllib.parse import urlparse
+import httpx
+from nanoid import generate as uuid
+from huggingface_hub import get_hf_file_metadata, hf_hub_url
+from huggingface_hub.utils import build_hf_headers
+from huggingface_hub.file_download import (
+    repo_folder_name,
+    _create_symlink,
+    _cache_commit_hash_for_specific_revision,
+)
+from core import common
+from inference import model_cache, model_quota
+
+REVISION = "main"
+PART_SUFFIX = ".incomplete"
+CHUNK_BYTES = 1024 * 1024
+# Files are not split in segments smaller than this
+MIN_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENTS = 4
+MAX_SEGMENTS = 16
+PROGRESS_INTERVAL_SECS = 0.5
+SAVE_INTERVAL_SECS = 2.0
+RETRIES = 5
+RETRY_DELAY_SECS = 2.0
+TIMEOUT_SECS = 30.0
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# Windows has no pread/pwrite, seek and read/write under a lock instead
+_io_lock = threading.Lock()
+
+
+class DownloadStatus:
+    QUEUED = "queued"
+    DOWNLOADING = "downloading"
+    VERIFYING = "verifying"
+    PAUSED = "paused"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
+class DownloadStopped(Exception):
+    pass
+
+
+def get_segments_env() -> int:
+    return int(os.getenv("DOWNLOAD_SEGMENTS", DEFAULT_SEGMENTS))
+
+
+def get_rate_env() -> float:
+    return float(os.getenv("DOWNLOAD_MAX_MB_PER_SEC", 0))
+
+
+# Blocking
+def write_at(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            with _io_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+# Blocking
+def read_at(fd: int, size: int, offset: int) -> bytes:
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    with _io_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+# Shared by the segments of a download, at most one second of data is sent in a burst
+class RateLimiter:
+    def __init__(self, mb_per_sec: float):
+        self.rate = mb_per_sec * 1024 * 1024
+        self._allowance = self.rate
+        self._last = time.monotonic()
+
+    async def consume(self, num_bytes: int):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._allowance = min(
+            self.rate, self._allowance + (now - self._last) * self.rate
+        )
+        self._last = now
+        self._allowance -= num_bytes
+        if self._allowance < 0:
+            await asyncio.sleep(-self._allowance / self.rate)
+
+
+# sha256 of the file in order, fed from the part on disk as its written start grows
+class StreamingHash:
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.position = 0
+
+    # Blocking
+    def update_to(self, fd: int, end: int):
+        while self.position < end:
+            data = read_at(fd, min(CHUNK_BYTES * 8, end - self.position), self.position)
+            if not data:
+                break
+            self._hash.update(data)
+            self.position += len(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def split_segments(size: int, num_segments: int) -> List[dict]:
+    if size == 0:
+        return [{"start": 0, "end": 0, "written": 0}]
+    num_segments = max(1, min(num_segments, MAX_SEGMENTS, size // MIN_SEGMENT_BYTES))
+    length = -(-size // num_segments)
+    return [
+        {"start": start, "end": min(start + length, size), "written": 0}
+        for start in range(0, size, length)
+    ]
+
+
+# Bytes at the start of the file that are fully written
+def written_prefix(segments: List[dict]) -> int:
+    end = 0
+    for segment in segments:
+        end = segment["start"] + segment["written"]
+        if segment["start"] + segment["written"] < segment["end"]:
+            break
+    return end
+
+
+class ModelDownloadManager:
+    def __init__(self, jobs_path: str, cache_dir: str):
+        self.jobs_path = jobs_path
+        self.cache_dir = cache_dir
+        self.jobs: dict[str, dict] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        # Set when a job changes, wakes up the progress streams
+        self._changed: Optional[asyncio.Condition] = None
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_path, f"{job_id}.json")
+
+    def _storage_folder(self, repo_id: str) -> str:
+        return os.path.join(
+            self.cache_dir, repo_folder_name(repo_id=repo_id, repo_type="model")
+        )
+
+    def _part_path(self, job: dict) -> str:
+        return os.path.join(
+            self._storage_folder(job["repo_id"]), "blobs", job["etag"] + PART_SUFFIX
+        )
+
+    def _save(self, job: dict):
+        job["updated_at"] = time.time()
+        os.makedirs(self.jobs_path, exist_ok=True)
+        common.write_json_atomic(self._job_path(job["id"]), job)
+
+    async def _notify_changed(self):
+        if self._changed:
+            async with self._changed:
+                self._changed.notify_all()
+
+    # Routes call this from the threadpool, the event belongs to the server's loop
+    def _wake_up(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def load(self):
+        self.jobs = {}
+        if not os.path.isdir(self.jobs_path):
+            return
+        for file_name in os.listdir(self.jobs_path):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.jobs_path, file_name), "r") as file:
+                    job = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if job["status"] in (DownloadStatus.DOWNLOADING, DownloadStatus.VERIFYING):
+                job["status"] = DownloadStatus.QUEUED
+            self.jobs[job["id"]] = job
+
+    def start(self):
+        self.load()
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._changed = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def submit(
+        self,
+        repo_id: str,
+        filename: str,
+        segments: Optional[int] = None,
+        max_mb_per_sec: Optional[float] = None,
+    ) -> dict:
+        # The same file is only downloaded once at a time
+        for job in self.jobs.values():
+            if (
+                job["repo_id"] == repo_id
+                and job["filename"] == filename
+                and job["status"] != DownloadStatus.COMPLETED
+            ):
+                if job["status"] in (DownloadStatus.PAUSED, DownloadStatus.FAILED):
+                    return self.resume(job["id"])
+                return job
+        job = {
+            "id": uuid(),
+            "repo_id": repo_id,
+            "filename": filename,
+            "status": DownloadStatus.QUEUED,
+            "num_segments": segments or get_segments_env(),
+            "max_mb_per_sec": max_mb_per_sec,
+            "size": None,
+            "downloaded": 0,
+            "percent": 0.0,
+            "mb_per_sec": 0.0,
+            "eta_secs": None,
+            "etag": None,
+            "commit_hash": None,
+            "sha256": None,
+            "segments": [],
+            "file_path": None,
+            "error": None,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        }
+        self._save(job)
+        self.jobs[job["id"]] = job
+        # Record the model as installed, the path is added once it is downloaded
+        common.save_text_model({"repoId": repo_id, "savePath": {filename: ""}})
+        self._wake_up()
+        return job
+
+    def get(self, job_id: str) -> dict:
+        job = self.jobs.get(job_id)
+        if not job:
+            raise Exception(f"No download found with id [{job_id}].")
+        return job
+
+    def list(self) -> List[dict]:
+        return sorted(self.jobs.values(), key=lambda job: job["created_at"])
+
+    def pause(self, job_id: str) -> dict:
+        job = self.get(job_id)
+        if job["status"] in (DownloadStatus.QUEUED, DownloadStatus.DOWNLOADING):
+            job["status"] = DownloadStatus.PAUSED
+            self._save(job)
+        return job
+
+    def resume(self, job_id: str) -> dict:
+        job = self.get(job_id)
+        if job["status"] in (DownloadStatus.PAUSED, DownloadStatus.FAILED):
+            job["status"] = DownloadStatus.QUEUED
+            job["error"] = None
+            self._save(job)
+            self._wake_up()
+        return job
+
+    # Stops the download and removes its partial file
+    def delete(self, job_id: str):
+        job = self.get(job_id)
+        del self.jobs[job_id]
+        if os.path.exists(self._job_path(job_id)):
+            os.remove(self._job_path(job_id))
+        if job["etag"] and job["status"] != DownloadStatus.COMPLETED:
+            try:
+                os.remove(self._part_path(job))
+            except OSError:
+                pass
+
+    # Yields the job each time it changes until it is done
+    async def watch(self, job_id: str):
+        job = self.get(job_id)
+        while True:
+            yield job
+            if self.jobs.get(job_id) is not job or job["status"] in (
+                DownloadStatus.COMPLETED,
+                DownloadStatus.FAILED,
+                DownloadStatus.PAUSED,
+            ):
+                return
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(
+                        self._changed.wait(), PROGRESS_INTERVAL_SECS * 4
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    def _next_job(self) -> Optional[dict]:
+        for job in self.list():
+            if job["status"] in (DownloadStatus.QUEUED, DownloadStatus.DOWNLOADING):
+                return job
+        return None
+
+    async def _run(self):
+        while True:
+            job = self._next_job()
+            if not job:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except DownloadStopped:
+                pass
+            except Exception as err:
+                print(
+                    f"{common.PRNT_API} Download of [{job['filename']}] failed: {err}",
+                    flush=True,
+                )
+                if job["id"] in self.jobs:
+                    job["status"] = DownloadStatus.FAILED
+                    job["error"] = f"{err}"
+                    self._save(job)
+            await self._notify_changed()
+
+    def _check_running(self, job: dict):
+        if self.jobs.get(job["id"]) is not job:
+            raise DownloadStopped()
+        if job["status"] != DownloadStatus.DOWNLOADING:
+            raise DownloadStopped()
+
+    async def _process(self, job: dict):
+        job["status"] = DownloadStatus.DOWNLOADING
+        self._save(job)
+        url = hf_hub_url(job["repo_id"], job["filename"], revision=REVISION)
+        metadata = await asyncio.to_thread(get_hf_file_metadata, url)
+        if not metadata.etag or metadata.size is None:
+            raise Exception("The hub did not return the file's etag and size.")
+        # The file changed on the hub since the download started
+        if job["etag"] and job["etag"] != metadata.etag:
+            try:
+                os.remove(self._part_path(job))
+            except OSError:
+                pass
+            job["segments"] = []
+        job["etag"] = metadata.etag
+        job["commit_hash"] = metadata.commit_hash
+        job["size"] = metadata.size
+        # Older model files are deleted when the quota is full
+        await asyncio.to_thread(
+            model_quota.quota.make_room, job["size"], job["repo_id"], job["filename"]
+        )
+        location = metadata.location
+        # Auth headers only go to the hub, not to the storage it redirects to
+        headers = {"Accept-Encoding": "identity"}
+        if urlparse(location).netloc == urlparse(url).netloc:
+            headers.update(build_hf_headers())
+
+        part_path = self._part_path(job)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        limiter = RateLimiter(job["max_mb_per_sec"] or get_rate_env())
+        hasher = StreamingHash()
+        async with httpx.AsyncClient(
+            timeout=TIMEOUT_SECS, follow_redirects=True
+        ) as client:
+            resumable = job["size"] > 0 and await self._supports_ranges(
+                client, location, headers
+            )
+            if not job["segments"] or not os.path.exists(part_path):
+                job["segments"] = split_segments(
+                    job["size"], job["num_segments"] if resumable else 1
+                )
+            if not resumable:
+                for segment in job["segments"]:
+                    segment["written"] = 0
+            fd = os.open(part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+            try:
+                if os.fstat(fd).st_size != job["size"]:
+                    os.ftruncate(fd, job["size"])
+                self._save(job)
+                segment_tasks = [
+                    asyncio.create_task(
+                        self._download_segment(
+                            client, job, segment, location, headers, fd, limiter
+                        )
+                    )
+                    for segment in job["segments"]
+                ]
+                monitor = asyncio.create_task(self._monitor(job, fd, hasher))
+                try:
+                    await asyncio.gather(*segment_tasks)
+                finally:
+                    monitor.cancel()
+                    for task in segment_tasks:
+                        task.cancel()
+                    await asyncio.gather(
+                        *segment_tasks, monitor, return_exceptions=True
+                    )
+                    if job["id"] in self.jobs:
+                        self._update_progress(job, 0.0)
+                        self._save(job)
+                job["status"] = DownloadStatus.VERIFYING
+                self._save(job)
+                await self._notify_changed()
+                await asyncio.to_thread(hasher.update_to, fd, job["size"])
+            finally:
+                os.close(fd)
+        self._finish(job, hasher.hexdigest())
+
+    async def _supports_ranges(
+        self, client: httpx.AsyncClient, location: str, headers: dict
+    ) -> bool:
+        async with client.stream(
+            "GET", location, headers={**headers, "Range": "bytes=0-0"}
+        ) as res:
+            res.raise_for_status()
+            return res.status_code == 206
+
+    async def _download_segment(
+        self,
+        client: httpx.AsyncClient,
+        job: dict,
+        segment: dict,
+        location: str,
+        headers: dict,
+        fd: int,
+        limiter: RateLimiter,
+    ):
+        retries = 0
+        while segment["start"] + segment["written"] < segment["end"]:
+            self._check_running(job)
+            offset = segment["start"] + segment["written"]
+            range_headers = {**headers, "Range": f"bytes={offset}-{segment['end'] - 1}"}
+            try:
+                async with client.stream("GET", location, headers=range_headers) as res:
+                    res.raise_for_status()
+                    if res.status_code != 206 and offset > 0:
+                        raise Exception("The server does not support resuming.")
+                    async for data in res.aiter_bytes(CHUNK_BYTES):
+                        self._check_running(job)
+                        data = data[: segment["end"] - offset]
+                        await limiter.consume(len(data))
+                        await asyncio.to_thread(write_at, fd, data, offset)
+                        offset += len(data)
+                        segment["written"] = offset - segment["start"]
+                        retries = 0
+                        if offset >= segment["end"]:
+                            break
+            except (httpx.TransportError, httpx.HTTPStatusError) as err:
+                retries += 1
+                if retries > RETRIES:
+                    raise Exception(f"Download failed after {RETRIES} retries: {err}")
+                await asyncio.sleep(RETRY_DELAY_SECS * retries)
+
+    def _update_progress(self, job: dict, mb_per_sec: float):
+        job["downloaded"] = sum(segment["written"] for segment in job["segments"])
+        job["percent"] = (
+            round(job["downloaded"] / job["size"] * 100, 1) if job["size"] else 100.0
+        )
+        job["mb_per_sec"] = round(mb_per_sec, 2)
+        remaining = job["size"] - job["downloaded"]
+        job["eta_secs"] = (
+            round(remaining / (mb_per_sec * 1024 * 1024)) if mb_per_sec else None
+        )
+
+    # Progress, hashing of the written start of the file and saving of the job state
+    async def _monitor(self, job: dict, fd: int, hasher: StreamingHash):
+        last_bytes = sum(segment["written"] for segment in job["segments"])
+        last_time = time.monotonic()
+        last_save = last_time
+        mb_per_sec = 0.0
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL_SECS)
+            now = time.monotonic()
+            downloaded = sum(segment["written"] for segment in job["segments"])
+            # Smoothed so the estimate does not jump around
+            speed = (downloaded - last_bytes) / (now - last_time) / 1024 / 1024
+            mb_per_sec = speed if not mb_per_sec else mb_per_sec * 0.7 + speed * 0.3
+            last_bytes, last_time = downloaded, now
+            self._update_progress(job, mb_per_sec)
+            await asyncio.to_thread(
+                hasher.update_to, fd, written_prefix(job["segments"])
+            )
+            if now - last_save >= SAVE_INTERVAL_SECS:
+                self._save(job)
+                last_save = now
+            await self._notify_changed()
+
+    # Move the verified file into the cache and record it as installed
+    def _finish(self, job: dict, sha256: str):
+        part_path = self._part_path(job)
+        job["sha256"] = sha256
+        # Files stored with git LFS have their sha256 as etag
+        if SHA256_PATTERN.match(job["etag"]) and sha256 != job["etag"]:
+            os.remove(part_path)
+            job["segments"] = []
+            raise Exception(
+                f"Checksum mismatch, expected {job['etag']} but got {sha256}."
+            )
+        storage_folder = self._storage_folder(job["repo_id"])
+        blob_path = os.path.join(storage_folder, "blobs", job["etag"])
+        pointer_path = os.path.join(
+            storage_folder, "snapshots", job["commit_hash"], job["filename"]
+        )
+        os.replace(part_path, blob_path)
+        os.makedirs(os.path.dirname(pointer_path), exist_ok=True)
+        if not os.path.exists(pointer_path):
+            _create_symlink(blob_path, pointer_path, new_blob=True)
+        _cache_commit_hash_for_specific_revision(
+            storage_folder, REVISION, job["commit_hash"]
+        )
+        file_path = os.path.realpath(blob_path)
+        model_cache.get_index().add_file(
+            repo_id=job["repo_id"],
+            filename=job["filename"],
+            blob_path=file_path,
+            size=job["size"],
+            revision=job["commit_hash"],
+        )
+        common.save_text_model(
+            {"repoId": job["repo_id"], "savePath": {job["filename"]: file_path}}
+        )
+        job["file_path"] = file_path
+        job["status"] = DownloadStatus.COMPLETED
+        self._save(job)
+        print(
+            f"{common.PRNT_API} Downloaded {job['filename']} to {file_path}", flush=True
+        )
+
+
+_manager: Optional[ModelDownloadManager] = None
+
+
+def get_manager() -> ModelDownloadManager:
+    global _manager
+    if _manager is None:
+        _manager = ModelDownloadManager(
+            common.DOWNLOADS_PATH, common.app_path(common.TEXT_MODELS_CACHE_DIR)
+        )
+    return _manager
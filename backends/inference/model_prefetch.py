@@ -0,0 +1,144 @@
+###
+# Cold start policies for memory mapped (use_mmap) models. Loading a mapped model is quick but its
+# weights are read from disk the first time each page is touched, so the first request after a
+# load pays for reading the whole model in small random faults.
+#   lazy      pages are read on demand (llama.cpp default)
+#   prefetch  a background thread reads the file ahead (fadvise hints) into the page cache while the
+#             model loads, so later faults are served from memory
+#   mlock     llama.cpp locks the mapping in RAM, the load reads every page and they are never
+#             paged out (needs a high enough RLIMIT_MEMLOCK)
+# The policy is set per load (load_policy) or with MODEL_LOAD_POLICY.
+###
+import os
+import time
+import threading
+from typing import Any, Optional
+from core import common
+
+LAZY = "lazy"
+PREFETCH = "prefetch"
+MLOCK = "mlock"
+LOAD_POLICIES = [LAZY, PREFETCH, MLOCK]
+DEFAULT_LOAD_POLICY = PREFETCH
+CHUNK_BYTES = 16 * 1024 * 1024
+# Chunks hinted ahead of the one being read
+READAHEAD_CHUNKS = 4
+
+
+def get_policy_env() -> str:
+    return os.getenv("MODEL_LOAD_POLICY", DEFAULT_LOAD_POLICY)
+
+
+# The policy to load with, raises if it is unknown
+def resolve_policy(init_settings: Any) -> str:
+    policy = getattr(init_settings, "load_policy", None)
+    if not policy:
+        policy = MLOCK if init_settings.use_mlock else get_policy_env()
+    if policy not in LOAD_POLICIES:
+        raise Exception(
+            f"Unknown load policy [{policy}]. Use one of: {', '.join(LOAD_POLICIES)}."
+        )
+    # Without mmap the weights are read into memory while loading
+    if init_settings.use_mmap == False and policy == PREFETCH:
+        return LAZY
+    return policy
+
+
+# Locked memory allowed for this process in bytes, None if unlimited or unknown
+def mlock_limit() -> Optional[int]:
+    try:
+        import resource
+
+        limit = resource.getrlimit(resource.RLIMIT_MEMLOCK)[0]
+    except (ImportError, AttributeError, ValueError):
+        return None
+    return None if limit == resource.RLIM_INFINITY else limit
+
+
+def new_progress(path: Optional[str], policy: str, total: int) -> dict:
+    return {
+        "path": path,
+        "policy": policy,
+        "status": "idle",  # idle, running, done, cancelled, failed
+        "total_bytes": total,
+        "read_bytes": 0,
+        "percent": 0.0,
+        "elapsed_secs": 0.0,
+        "mb_per_sec": 0.0,
+        "error": None,
+    }
+
+
+# Read a file into the page cache, progress is updated as it goes
+def read_ahead(path: str, cancel: threading.Event, progress: dict):
+    start = time.perf_counter()
+    total = progress["total_bytes"]
+    can_advise = hasattr(os, "posix_fadvise")
+    buffer = bytearray(CHUNK_BYTES)
+    try:
+        with open(path, "rb", buffering=0) as file:
+            fd = file.fileno()
+            if can_advise:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            offset = 0
+            while offset < total and not cancel.is_set():
+                # The kernel reads the next chunks while this one is copied
+                if can_advise:
+                    os.posix_fadvise(
+                        fd,
+                        offset + CHUNK_BYTES,
+                        CHUNK_BYTES * READAHEAD_CHUNKS,
+                        os.POSIX_FADV_WILLNEED,
+                    )
+                num_bytes = file.readinto(buffer)
+                if not num_bytes:
+                    break
+                offset += num_bytes
+                elapsed = time.perf_counter() - start
+                progress.update(
+                    read_bytes=offset,
+                    percent=round(offset / total * 100, 1),
+                    elapsed_secs=round(elapsed, 2),
+                    mb_per_sec=round(offset / 1024 / 1024 / max(elapsed, 1e-6), 1),
+                )
+        progress["status"] = "cancelled" if cancel.is_set() else "done"
+    except OSError as err:
+        progress.update(status="failed", error=f"{err}")
+    print(
+        f"{common.PRNT_API} Prefetch {progress['status']}: {progress['read_bytes'] // (1024 * 1024)} MB in {progress['elapsed_secs']}s ({progress['mb_per_sec']} MB/s)",
+        flush=True,
+    )
+
+
+class ModelPrefetcher:
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._cancel = threading.Event()
+        self.progress = new_progress(None, LAZY, 0)
+
+    # Start reading the model file in the background, replaces a running prefetch
+    def start(self, path: str, policy: str):
+        self.cancel()
+        if policy != PREFETCH or not os.path.isfile(path):
+            self.progress = new_progress(path, policy, 0)
+            return
+        self._cancel = threading.Event()
+        self.progress = new_progress(path, policy, os.path.getsize(path))
+        self.progress["status"] = "running"
+        self._thread = threading.Thread(
+            target=read_ahead, args=(path, self._cancel, self.progress), daemon=True
+        )
+        self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return dict(self.progress)
+
+
+# Shared by all loads, one model is loaded at a time
+prefetcher = ModelPrefetcher()
@@ -0,0 +1,143 @@
+###
+# Disk quota for the model cache (text_models). Before a download starts, the least recently loaded
+# model files are deleted until the new file fits in MODEL_DISK_QUOTA_MB (0 for no quota).
+# A file's size comes from the model cache index, its last load time from installed_models.json
+# (lastLoaded, the download time if it was never loaded). Pinned files and the loaded model are
+# never deleted.
+###
+import os
+import threading
+from typing import List, Optional
+from core import common
+from inference import model_cache
+
+
+def get_quota_env() -> int:
+    return int(os.getenv("MODEL_DISK_QUOTA_MB", 0)) * 1024 * 1024
+
+
+# Every cached model file with what the quota needs to know about it
+def installed_files(installed: Optional[dict], cached_repos: dict) -> List[dict]:
+    records = {
+        item.get("repoId"): item
+        for item in (installed or {}).get(common.INSTALLED_TEXT_MODELS) or []
+    }
+    files = []
+    for repo_id, cached_files in cached_repos.items():
+        record = records.get(repo_id) or {}
+        last_loaded = record.get("lastLoaded") or {}
+        pinned = record.get("pinned") or []
+        save_paths = record.get("savePath")
+        for filename, entry in cached_files.items():
+            path = entry["blob_path"]
+            if filename in last_loaded:
+                last_used = last_loaded[filename]
+            else:
+                try:
+                    last_used = os.path.getmtime(path)
+                except OSError:
+                    last_used = 0
+            files.append(
+                {
+                    "repoId": repo_id,
+                    "filename": filename,
+                    "path": path,
+                    "size": entry["size"],
+                    "lastUsed": last_used,
+                    "pinned": filename in pinned,
+                    "installed": isinstance(save_paths, dict)
+                    and filename in save_paths,
+                }
+            )
+    return files
+
+
+# Files to delete, least recently used first, so that num_bytes more fit in the quota
+def plan_eviction(
+    files: List[dict], num_bytes: int, quota: int, protected_paths: List[str]
+) -> List[dict]:
+    protected = {os.path.realpath(path) for path in protected_paths if path}
+    # A blob shared by several files is only freed once
+    used = sum({item["path"]: item["size"] for item in files}.values())
+    planned = []
+    for item in sorted(files, key=lambda item: item["lastUsed"]):
+        if used + num_bytes <= quota:
+            break
+        if item["pinned"] or os.path.realpath(item["path"]) in protected:
+            continue
+        planned.append(item)
+        used -= item["size"]
+    if used + num_bytes > quota:
+        raise Exception(
+            f"Not enough room in the model disk quota ({quota // (1024 * 1024)} MB) for {num_bytes // (1024 * 1024)} MB, unpin or delete a model."
+        )
+    return planned
+
+
+class ModelDiskQuota:
+    def __init__(self):
+        self._app = None
+        self._lock = threading.Lock()
+
+    # The loaded model is read from the app's state
+    def attach(self, app):
+        self._app = app
+
+    def _protected_paths(self) -> List[str]:
+        if not self._app:
+            return []
+        return [getattr(self._app.state, "path_to_model", "")]
+
+    def _files(self) -> List[dict]:
+        installed = common.get_settings_file(
+            common.APP_SETTINGS_PATH, common.MODEL_METADATAS_FILEPATH
+        )
+        return installed_files(installed, model_cache.get_index().list())
+
+    # Delete old model files until num_bytes fit, returns the files deleted
+    def make_room(self, num_bytes: int, repo_id: str, filename: str) -> List[dict]:
+        quota = get_quota_env()
+        if not quota:
+            return []
+        with self._lock:
+            # The file being replaced frees its own space
+            files = [
+                item
+                for item in self._files()
+                if (item["repoId"], item["filename"]) != (repo_id, filename)
+            ]
+            planned = plan_eviction(files, num_bytes, quota, self._protected_paths())
+            index = model_cache.get_index()
+            for item in planned:
+                index.delete_file(repo_id=item["repoId"], filename=item["filename"])
+                print(
+                    f"{common.PRNT_API} Disk quota: evicted {item['filename']} of {item['repoId']} ({item['size'] // (1024 * 1024)} MB)",
+                    flush=True,
+                )
+                # Files cached by other tools have no install record
+                if not item["installed"]:
+                    continue
+                # The record of the repo being downloaded keeps its stats and pins
+                if item["repoId"] == repo_id or index.list().get(item["repoId"]):
+                    common.delete_text_model(
+                        filename=item["filename"], repo_id=item["repoId"]
+                    )
+                else:
+                    common.delete_text_model_revisions(repo_id=item["repoId"])
+            return planned
+
+    def stats(self) -> dict:
+        files = self._files()
+        protected = {os.path.realpath(path) for path in self._protected_paths() if path}
+        return {
+            "quota": get_quota_env(),
+            "used": sum({item["path"]: item["size"] for item in files}.values()),
+            "files": [
+                {**item, "loaded": os.path.realpath(item["path"]) in protected}
+                for item in sorted(files, key=lambda item: item["lastUsed"])
+            ],
+        }
+
+
+# Shared by the downloads and the routes
+quota = ModelDiskQuota()
@@ -0,0 +1,207 @@
+###
+# Startup preload. Instead of making the first user wait for a full model load, the server ranks
+# the installed models by how often they were loaded (numTimesRun) and, in a background thread,
+# loads the most used one with the settings of the bot that uses it. The next ones are read into
+# the page cache while they fit in the memory budget, so switching to them is fast too.
+# Enabled with PRELOAD_MODELS=true. PRELOAD_MEMORY_MB caps the memory used (default: the memory
+# available at startup). A model's size is taken as its file size.
+###
+import os
+import threading
+from typing import Any, List, Optional
+from core import common, classes, settings_store
+from inference import model_prefetch
+
+BOT_SETTINGS_FILENAME = "bots.json"
+
+
+def get_preload_env() -> bool:
+    return os.getenv("PRELOAD_MODELS", "false").lower() == "true"
+
+
+def get_budget_env() -> int:
+    return int(os.getenv("PRELOAD_MEMORY_MB", 0)) * 1024 * 1024
+
+
+# Free memory in bytes, None if it can not be read
+def available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo", "r") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        pass
+    if os.name == "nt":
+        import ctypes
+
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+    return None
+
+
+def read_bots() -> List[dict]:
+    path = os.path.join(common.APP_SETTINGS_PATH, BOT_SETTINGS_FILENAME)
+    return settings_store.get_store(path).read() or []
+
+
+# Installed model files that were run before, most used first
+def rank_models(installed: Optional[dict], bots: List[dict]) -> List[dict]:
+    models = (installed or {}).get(common.INSTALLED_TEXT_MODELS) or []
+    ranked = sorted(
+        models,
+        key=lambda item: (item.get("numTimesRun") or 0, bool(item.get("isFavorited"))),
+        reverse=True,
+    )
+    candidates = []
+    for model in ranked:
+        if not model.get("numTimesRun"):
+            continue
+        repo_id = model.get("repoId")
+        save_paths = model.get("savePath") or {}
+        if isinstance(save_paths, str):
+            save_paths = {os.path.basename(save_paths): save_paths}
+        # The bot's file and settings when a bot uses this model
+        bot = next(
+            (
+                item
+                for item in bots
+                if (item.get("model") or {}).get("id") == repo_id
+                and item["model"].get("filename") in save_paths
+            ),
+            None,
+        )
+        filename = bot["model"]["filename"] if bot else next(iter(save_paths), None)
+        path = save_paths.get(filename)
+        if not path or not os.path.isfile(path):
+            continue
+        candidates.append(
+            {
+                "repoId": repo_id,
+                "filename": filename,
+                "path": path,
+                "size": os.path.getsize(path),
+                "numTimesRun": model.get("numTimesRun"),
+                "bot": bot,
+            }
+        )
+    return candidates
+
+
+# Candidates that fit in the budget, in order
+def plan_preload(candidates: List[dict], budget: int) -> List[dict]:
+    planned = []
+    used = 0
+    for candidate in candidates:
+        if used + candidate["size"] > budget:
+            continue
+        planned.append(candidate)
+        used += candidate["size"]
+    return planned
+
+
+def load_request(candidate: dict) -> classes.LoadInferenceRequest:
+    bot = candidate["bot"] or {}
+
+    def settings(name: str) -> dict:
+        values = bot.get(name) or {}
+        return {key: val for key, val in values.items() if val is not None}
+
+    return classes.LoadInferenceRequest(
+        modelPath=candidate["path"],
+        modelId=candidate["repoId"],
+        mode=settings("attention").get("mode") or classes.DEFAULT_CHAT_MODE,
+        init=classes.LoadTextInferenceInit(**settings("performance")),
+        call=classes.LoadTextInferenceCall(**settings("response")),
+    )
+
+
+class ModelPreloader:
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._cancel = threading.Event()
+        self.status = "idle"  # idle, running, done, skipped, failed
+        self.loaded: Optional[str] = None
+        self.cached: List[dict] = []
+        self.error: Optional[str] = None
+
+    # Returns right away, the models are loaded in a background thread
+    def start(self, app, load_model: Any):
+        self._thread = threading.Thread(
+            target=self._run, args=(app, load_model), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._cancel.set()
+
+    def _run(self, app, load_model: Any):
+        self.status = "running"
+        try:
+            installed = common.get_settings_file(
+                common.APP_SETTINGS_PATH, common.MODEL_METADATAS_FILEPATH
+            )
+            candidates = rank_models(installed, read_bots())
+            budget = get_budget_env() or available_memory() or 0
+            planned = plan_preload(candidates, budget)
+            if not planned:
+                self.status = "skipped"
+                print(
+                    f"{common.PRNT_API} Preload skipped: no used model fits in {budget // (1024 * 1024)} MB.",
+                    flush=True,
+                )
+                return
+            first, *rest = planned
+            # A model the user loaded meanwhile is kept
+            if not self._cancel.is_set():
+                result = load_model(app, load_request(first), keep_loaded=True)
+                if not result["success"]:
+                    raise Exception(result["message"])
+                if result["data"] is not None:
+                    self.loaded = first["repoId"]
+            for candidate in rest:
+                if self._cancel.is_set():
+                    break
+                progress = model_prefetch.new_progress(
+                    candidate["path"], model_prefetch.PREFETCH, candidate["size"]
+                )
+                model_prefetch.read_ahead(candidate["path"], self._cancel, progress)
+                self.cached.append(progress)
+            self.status = "done"
+        except Exception as err:
+            self.status = "failed"
+            self.error = f"{err}"
+            print(f"{common.PRNT_API} Preload failed: {err}", flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "status": self.status,
+            "loaded": self.loaded,
+            "cached": [
+                {"path": item["path"], "status": item["status"]} for item in self.cached
+            ],
+            "error": self.error,
+        }
+
+
+# Shared by the server
+preloader = ModelPreloader()
@@ -0,0 +1,51 @@
+###
+# Prompt templates ("Answer this: {query_str}") are parsed once into literal text and placeholder
+# segments, and kept in an LRU cache keyed by the template's text.
+# Rendering is a single pass. Only placeholders that are given a value are substituted, the rest
+# (ie {context_str} which is filled in later by RAG) are kept as-is.
+###
+import re
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+DEFAULT_MAX_TEMPLATES = 128
+# Only well formed names count as placeholders, so json like {"a": 1} is left alone
+PLACEHOLDER_PATTERN = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class PromptTemplate:
+    def __init__(self, text: str):
+        self.text = text
+        # (is_placeholder, literal text or placeholder name)
+        self.segments: List[Tuple[bool, str]] = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(text):
+            if match.start() > position:
+                self.segments.append((False, text[position : match.start()]))
+            self.segments.append((True, match.group(1)))
+            position = match.end()
+        if position < len(text):
+            self.segments.append((False, text[position:]))
+        self.placeholders = {name for is_name, name in self.segments if is_name}
+
+    def render(self, values: Dict[str, str]) -> str:
+        parts = []
+        for is_placeholder, value in self.segments:
+            if not is_placeholder:
+                parts.append(value)
+            elif value in values:
+                parts.append(f"{values[value]}")
+            else:
+                parts.append(f"{{{value}}}")
+        return "".join(parts)
+
+
+@lru_cache(maxsize=DEFAULT_MAX_TEMPLATES)
+def get_template(text: str) -> PromptTemplate:
+    return PromptTemplate(text)
+
+
+def render(text: str, values: Dict[str, str]) -> str:
+    if not text:
+        return text
+    return get_template(text).render(values)
@@ -0,0 +1,245 @@
+###
+# Tools hosted at a url (tool "path" starts with https://).
+# All requests share one async http client (pooled connections) that runs on its own event loop thread,
+# so both sync and async code can use it. Requests are limited per host, retried with exponential
+# backoff, and responses are cached when the server allows it (Cache-Control: max-age).
+#
+# A remote tool must serve:
+#   GET  {path}/endpoint.json  -> json schema of its params (same shape as a local tool's Params model)
+#   POST {path}                -> called with the arguments as json body, returns {"result": ...} or any json
+###
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+from urllib.parse import urlsplit
+import httpx
+
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_TIMEOUT_SECS = 15.0
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF_SECS = 0.25
+DEFAULT_DEFINITION_TTL_SECS = 600.0
+DEFAULT_CACHE_SIZE = 256
+DEFINITION_FILENAME = "endpoint.json"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_url(path: str) -> bool:
+    return path.startswith("https://")
+
+
+def definition_url(path: str) -> str:
+    return f"{path.rstrip('/')}/{DEFINITION_FILENAME}"
+
+
+# Seconds the response may be reused according to its Cache-Control header
+def max_age(response: httpx.Response) -> float:
+    cache_control = response.headers.get("cache-control", "")
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        if name in ("no-store", "no-cache"):
+            return 0.0
+        if name == "max-age" and value.isdigit():
+            return float(value)
+    return 0.0
+
+
+class RemoteToolClient:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        max_per_host: int = DEFAULT_MAX_PER_HOST,
+        timeout: float = DEFAULT_TIMEOUT_SECS,
+        retries: int = DEFAULT_RETRIES,
+        backoff: float = DEFAULT_BACKOFF_SECS,
+        definition_ttl: float = DEFAULT_DEFINITION_TTL_SECS,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.definition_ttl = definition_ttl
+        self.cache_size = cache_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+        # Only used from the client's loop
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        # (method, url, body) -> (expires_at, json)
+        self._cache: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, daemon=True)
+                self._thread.start()
+                self._loop = loop
+            return self._loop
+
+    # Run a coroutine on the client's loop, returns a concurrent Future
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                follow_redirects=True,
+            )
+        return self._client
+
+    def _cache_get(self, key: tuple):
+        item = self._cache.get(key)
+        if not item:
+            return None
+        if item[0] <= time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return item[1]
+
+    def _cache_set(self, key: tuple, value: Any, ttl: float):
+        if ttl <= 0:
+            return
+        self._cache[key] = (time.monotonic() + ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _request(self, method: str, url: str, body: Any = None) -> httpx.Response:
+        host = urlsplit(url).netloc
+        host_limit = self._host_limits.setdefault(
+            host, asyncio.Semaphore(self.max_per_host)
+        )
+        attempt = 0
+        while True:
+            try:
+                async with host_limit:
+                    response = await self._get_client().request(method, url, json=body)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+                error = httpx.HTTPStatusError(
+                    f"Server responded with {response.status_code}",
+                    request=response.request,
+                    response=response,
+                )
+            except (httpx.TransportError, httpx.TimeoutException) as err:
+                error = err
+            if attempt >= self.retries:
+                raise error
+            # Exponential backoff with jitter
+            await asyncio.sleep(self.backoff * (2**attempt) * (1 + random.random()))
+            attempt += 1
+
+    async def _fetch_json(
+        self, method: str, url: str, body: Any = None, default_ttl: float = 0.0
+    ) -> Any:
+        key = (method, url, json.dumps(body, sort_keys=True))
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        response = await self._request(method, url, body)
+        data = response.json()
+        self._cache_set(key, data, max_age(response) or default_ttl)
+        return data
+
+    async def _call(self, path: str, args: dict) -> dict:
+        try:
+            data = await self._fetch_json("POST", path, args)
+            result = (
+                data["result"] if isinstance(data, dict) and "result" in data else data
+            )
+            return {"success": True, "result": result, "error": None}
+        except httpx.HTTPStatusError as err:
+            message = f"{err.response.status_code} {err.response.text[:200]}"
+            return {
+                "success": False,
+                "result": None,
+                "error": {"type": "http", "message": message},
+            }
+        except (httpx.HTTPError, ValueError) as err:
+            return {
+                "success": False,
+                "result": None,
+                "error": {"type": "http", "message": f"{err}"},
+            }
+
+    # Call a remote tool, returns {"success", "result", "error"} like a local tool
+    def call(self, path: str, args: dict, timeout: Optional[float] = None) -> dict:
+        future = self._submit(self._call(path, args))
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # Stop retrying in the background
+            future.cancel()
+            raise
+
+    async def call_async(
+        self, path: str, args: dict, timeout: Optional[float] = None
+    ) -> dict:
+        future = asyncio.wrap_future(self._submit(self._call(path, args)))
+        return await asyncio.wait_for(future, timeout)
+
+    # Json schema of the tool's params, cached for `definition_ttl` (or the server's max-age)
+    def definition(self, path: str) -> dict:
+        coro = self._fetch_json(
+            "GET", definition_url(path), default_ttl=self.definition_ttl
+        )
+        return self._submit(coro).result(self.timeout * (self.retries + 1))
+
+    def close(self):
+        with self._lock:
+            loop = self._loop
+            self._loop = None
+        if loop is None:
+            return
+        if self._client:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result()
+            self._client = None
+        loop.call_soon_threadsafe(loop.stop)
+
+
+_client: Optional[RemoteToolClient] = None
+_client_lock = threading.Lock()
+
+
+# Created on first use so settings from .env are loaded by then
+def get_client() -> RemoteToolClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RemoteToolClient(
+                max_connections=int(
+                    os.getenv("REMOTE_TOOL_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)
+                ),
+                max_per_host=int(
+                    os.getenv("REMOTE_TOOL_MAX_PER_HOST", DEFAULT_MAX_PER_HOST)
+                ),
+                timeout=float(
+                    os.getenv("REMOTE_TOOL_TIMEOUT_SECS", DEFAULT_TIMEOUT_SECS)
+                ),
+                retries=int(os.getenv("REMOTE_TOOL_RETRIES", DEFAULT_RETRIES)),
+            )
+        return _client
+
+
+def shutdown():
+    with _client_lock:
+        client = _client
+    if client:
+        client.close()
@@ -1,15 +1,21 @@
 import os
+import json
+import asyncio
+import threading
 from typing import List
-from fastapi import APIRouter, Request, HTTPException, Depends
+from fastapi import APIRouter, Request, HTTPException, Depends, File, UploadFile
+from fastapi.responses import FileResponse
 from sse_starlette.sse import EventSourceResponse
-from inference.classes import RetrievalTypes
-from inference import agent
-from storage import route as storage_route
+from inference.classes import EmbeddingEncodings, RetrievalTypes, ToolCallModes
+from inference.scheduler import Priority, scheduler
+from inference import agent, agent_executor, extraction, tool_executor, tool_registry
+from inference import batch_jobs, candidates, compaction, copilot, kv_cache
+from inference import lora_adapters, model_cache, model_downloads, model_prefetch
+from inference import model_quota, preload
 from embeddings import main, query
-from inference import text_llama_index
+from inference import text_llama_index, text_embedding, grammars, prompt_templates
 from core import classes, common
 from huggingface_hub import (
-    hf_hub_download,
     get_hf_file_metadata,
     hf_hub_url,
     HfApi,
@@ -30,7 +36,16 @@ def get_installed_models() -> classes.TextModelInstallMetadataResponse:
         if not metadatas:
             metadatas = common.DEFAULT_SETTINGS_DICT
         if common.INSTALLED_TEXT_MODELS in metadatas:
-            data = metadatas[common.INSTALLED_TEXT_MODELS]
+            # Files come from the cache index, records keep the run stats
+            cached_repos = model_cache.get_index().list()
+            for metadata in metadatas[common.INSTALLED_TEXT_MODELS]:
+                files = cached_repos.pop(metadata.get("repoId"), None)
+                if files is not None:
+                    metadata = model_cache.with_cached_files(metadata, files)
+                data.append(metadata)
+            # Repos put in the cache by other tools
+            for repo_id, files in cached_repos.items():
+                data.append(model_cache.with_cached_files({"repoId": repo_id}, files))
             return {
                 "success": True,
                 "message": "This is a list of all currently installed models.",
@@ -81,12 +96,7 @@ def get_text_model(request: Request) -> classes.LoadedTextModelResponse | dict:
 # Eject the currently loaded Text Inference model
 @router.post("/unload")
 def unload_text_inference(request: Request):
-    app = request.app
-    text_llama_index.unload_text_model(app.state.llm)
-    app.state.loaded_text_model_data = {}
-    app.state.llm = None
-    app.state.path_to_model = ""
-    app.state.model_id = ""
+    unload_model(request.app)
 
     return {
         "success": True,
@@ -101,45 +111,112 @@ def load_text_inference(
     request: Request,
     data: classes.LoadInferenceRequest,
 ) -> classes.LoadInferenceResponse:
-    app = request.app
+    result = load_model(request.app, data)
+    # Ranks the models to preload on startup
+    if result["success"]:
+        common.increment_model_runs(data.modelId, data.modelPath)
+    return result
+
+
+# One load or unload at a time, the startup preload loads from its own thread
+load_lock = threading.RLock()
+
+
+def unload_model(app):
+    with load_lock:
+        lora_adapters.get_manager().detach()
+        text_llama_index.unload_text_model(app.state.llm)
+        app.state.loaded_text_model_data = {}
+        app.state.llm = None
+        app.state.path_to_model = ""
+        app.state.model_id = ""
+
+
+# Load a text model as the current one, also used by the startup preload.
+# With keep_loaded a model that is already loaded is kept (data is None).
+def load_model(
+    app, data: classes.LoadInferenceRequest, keep_loaded: bool = False
+) -> dict:
+    with load_lock:
+        if keep_loaded and app.state.llm is not None:
+            return {
+                "message": f"AI model [{app.state.model_id}] is already loaded.",
+                "success": True,
+                "data": None,
+            }
+        return _load_model(app, data)
+
 
+def _load_model(app, data: classes.LoadInferenceRequest) -> dict:
+    model_id = data.modelId
     try:
-        model_id = data.modelId
         mode = data.mode
         modelPath = data.modelPath
+        backend = data.backend or common.get_text_backend_env()
+        load_text_model = text_llama_index.TEXT_BACKENDS.get(backend)
+        if not load_text_model:
+            raise Exception(f"Unknown text inference backend [{backend}].")
         callback_manager = main.create_index_callback_manager()
-        # Record model's save path
-        app.state.model_id = model_id
-        app.state.path_to_model = modelPath
         # Unload the model if one exists
         if app.state.llm:
             print(
-                f"{common.PRNT_API} Ejecting model {model_id} currently loaded from: {modelPath}"
+                f"{common.PRNT_API} Ejecting model {app.state.model_id} currently loaded from: {app.state.path_to_model}"
             )
-            unload_text_inference()
+            unload_model(app)
+        # Record model's save path
+        app.state.model_id = model_id
+        app.state.path_to_model = modelPath
         # Load the specified Ai model
         if app.state.llm is None:
             model_settings = data.init
             generate_settings = data.call
-            app.state.llm = text_llama_index.load_text_model(
+            app.state.llm = load_text_model(
                 modelPath,
                 mode,
                 model_settings,
                 generate_settings,
                 callback_manager=callback_manager,
             )
+            kv_cache_memory = None
+            load_policy = None
+            if backend == "llama_cpp":
+                load_policy = model_prefetch.resolve_policy(model_settings)
+                # Memory taken by the KV cache for the chosen context size and cache types
+                kv_cache_memory = kv_cache.model_memory(
+                    app.state.llm, *kv_cache.resolve_cache_types(model_settings)
+                )
+            # Bots may apply their LoRA adapter to the weights of a llama.cpp model
+            if backend == "llama_cpp":
+                lora_adapters.get_manager().attach(
+                    app.state.llm, model_settings.use_mmap
+                )
+            else:
+                lora_adapters.get_manager().detach()
             # Record the currently loaded model
             app.state.loaded_text_model_data = {
                 "modelId": model_id,
                 "mode": mode,
+                "backend": backend,
                 "modelSettings": model_settings,
                 "generateSettings": generate_settings,
+                "kvCache": kv_cache_memory,
+                "loadPolicy": load_policy,
             }
-            print(f"{common.PRNT_API} Model {model_id} loaded from: {modelPath}")
+            print(
+                f"{common.PRNT_API} Model {model_id} loaded from: {modelPath} ({backend})"
+            )
+            if kv_cache_memory:
+                print(
+                    f"{common.PRNT_API} KV cache: {kv_cache_memory['total_mb']} MB ({kv_cache_memory['type_k']}/{kv_cache_memory['type_v']}, n_ctx {kv_cache_memory['n_ctx']})"
+                )
         return {
             "message": f"AI model [{model_id}] loaded.",
             "success": True,
-            "data": None,
+            "data": {
+                "kvCache": app.state.loaded_text_model_data.get("kvCache"),
+                "loadPolicy": app.state.loaded_text_model_data.get("loadPolicy"),
+                "prefetch": model_prefetch.prefetcher.stats(),
+            },
         }
     except (Exception, KeyError) as error:
         return {
@@ -149,6 +226,46 @@ def load_text_inference(
         }
 
 
+# Latency and error counts of tool calls (per tool) and the result cache hit rate
+@router.get("/toolStats")
+def get_tool_stats():
+    return {
+        "success": True,
+        "message": "Returned tool execution and cache stats.",
+        "data": tool_executor.get_executor().stats(),
+    }
+
+
+# Requests waiting for the model by priority, and how many were served
+@router.get("/schedulerStats")
+def get_scheduler_stats():
+    return {
+        "success": True,
+        "message": "Returned inference scheduler stats.",
+        "data": scheduler.stats(),
+    }
+
+
+# Progress of reading the loaded model's weights into memory (prefetch load policy)
+@router.get("/prefetchStats")
+def get_prefetch_stats():
+    return {
+        "success": True,
+        "message": "Returned model prefetch progress.",
+        "data": model_prefetch.prefetcher.stats(),
+    }
+
+
+# Models loaded or cached by the startup preload
+@router.get("/preloadStats")
+def get_preload_stats():
+    return {
+        "success": True,
+        "message": "Returned startup preload status.",
+        "data": preload.preloader.stats(),
+    }
+
+
 # Open OS file explorer on host machine
 @router.get("/modelExplore")
 def explore_text_model_dir() -> classes.FileExploreResponse:
@@ -220,66 +337,143 @@ def get_model_metadata(payload):
     }
 
 
-# Download a text model from huggingface hub
-# https://huggingface.co/docs/huggingface_hub/v0.21.4/en/package_reference/file_download#huggingface_hub.hf_hub_download
+# Download a text model from huggingface hub in the background, returns the download job.
+# Large files are fetched in parallel range segments and resume where they stopped.
 @router.post("/download")
-def download_text_model(payload: classes.DownloadTextModelRequest):
+def download_text_model(
+    payload: classes.DownloadTextModelRequest,
+) -> classes.ModelDownloadResponse:
     try:
-        repo_id = payload.repo_id
-        filename = payload.filename
-        cache_dir = common.app_path(common.TEXT_MODELS_CACHE_DIR)
-        resume_download = False
-        # repo_type = "model" # optional, specify type of data, defaults to model
-        # local_dir = "" # optional, downloaded file will be placed under this directory
-
-        # Save initial path and details to json file
-        common.save_text_model(
-            {
-                "repoId": repo_id,
-                "savePath": {filename: ""},
-            }
+        job = model_downloads.get_manager().submit(
+            payload.repo_id,
+            payload.filename,
+            segments=payload.segments,
+            max_mb_per_sec=payload.maxMbPerSec,
         )
-
-        # Download model.
-        # Returned path is symlink which isnt loadable; for our purposes we use get_cached_blob_path().
-        hf_hub_download(
-            repo_id=repo_id,
-            filename=filename,
-            cache_dir=cache_dir,
-            resume_download=resume_download,
-            # local_dir=cache_dir,
-            # local_dir_use_symlinks=False,
-            # repo_type=repo_type,
+    except (KeyError, Exception, EnvironmentError, OSError, ValueError) as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
         )
+    return {
+        "success": True,
+        "message": f"Downloading {payload.filename}.",
+        "data": job,
+    }
+
 
-        # Get actual file path
-        [model_cache_info, repo_revisions] = common.scan_cached_repo(
-            cache_dir=cache_dir, repo_id=repo_id
+# Progress of all model downloads
+@router.get("/downloads")
+def get_downloads() -> classes.ModelDownloadsResponse:
+    jobs = model_downloads.get_manager().list()
+    return {
+        "success": True,
+        "message": f"Returned {len(jobs)} download(s).",
+        "data": jobs,
+    }
+
+
+@router.get("/download")
+def get_download(id: str) -> classes.ModelDownloadResponse:
+    try:
+        job = model_downloads.get_manager().get(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Download is {job['status']}.",
+        "data": job,
+    }
+
+
+# Stream the progress of a download (SSE) until it completes, fails or is paused
+@router.get("/download/progress")
+def stream_download_progress(id: str):
+    try:
+        manager = model_downloads.get_manager()
+        manager.get(id)
+    except Exception as err:
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
         )
-        # Get from dl path
-        # file_path = common.app_path(download_path)
 
-        # Get from huggingface hub managed cache dir
-        file_path = common.get_cached_blob_path(
-            repo_revisions=repo_revisions, filename=filename
+    async def progress_events():
+        async for job in manager.watch(id):
+            yield json.dumps({"event": "DOWNLOAD_PROGRESS", "data": job})
+
+    return EventSourceResponse(progress_events())
+
+
+@router.post("/download/pause")
+def pause_download(id: str) -> classes.ModelDownloadResponse:
+    try:
+        job = model_downloads.get_manager().pause(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Download is {job['status']}.",
+        "data": job,
+    }
+
+
+# Continue a paused (or failed) download from where it stopped
+@router.post("/download/resume")
+def resume_download(id: str) -> classes.ModelDownloadResponse:
+    try:
+        job = model_downloads.get_manager().resume(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Download is {job['status']}.",
+        "data": job,
+    }
+
+
+# Stop a download and remove its partial file
+@router.delete("/download")
+def delete_download(id: str) -> classes.ModelDownloadResponse:
+    try:
+        model_downloads.get_manager().delete(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": "Removed download.",
+        "data": None,
+    }
+
+
+# Pin a model file so the disk quota never evicts it
+@router.post("/pin")
+def pin_text_model(payload: classes.PinTextModelRequest):
+    try:
+        data = common.pin_text_model(
+            repo_id=payload.repoId, filename=payload.filename, pinned=payload.pinned
         )
-        if not isinstance(file_path, str):
-            raise Exception("Path is not string.")
-
-        # Save finalized details to disk
-        common.save_text_model(
-            {
-                "repoId": repo_id,
-                "savePath": {filename: file_path},
-            }
+        return {
+            "success": True,
+            "message": f"{'Pinned' if payload.pinned else 'Unpinned'} model file {payload.filename}.",
+            "data": data,
+        }
+    except Exception as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
         )
 
+
+# Model files by last use, with the disk quota and space used
+@router.get("/diskUsage")
+def get_disk_usage():
+    try:
         return {
             "success": True,
-            "message": f"Saved model file to {file_path}.",
+            "message": "Returned model disk usage.",
+            "data": model_quota.quota.stats(),
         }
-    except (KeyError, Exception, EnvironmentError, OSError, ValueError) as err:
-        print(f"Error: {err}", flush=True)
+    except Exception as err:
         raise HTTPException(
             status_code=400, detail=f"Something went wrong. Reason: {err}"
         )
@@ -293,29 +487,18 @@ def delete_text_model(payload: classes.DeleteTextModelRequest):
     repo_id = payload.repoId
 
     try:
-        cache_dir = common.app_path(common.TEXT_MODELS_CACHE_DIR)
-
         # Checks file and throws if not found
-        common.check_cached_file_exists(
-            cache_dir=cache_dir, repo_id=repo_id, filename=filename
-        )
+        index = model_cache.get_index()
+        if not index.get_file(repo_id=repo_id, filename=filename):
+            raise Exception("File not cached.")
 
-        # Find model hash
-        [model_cache_info, repo_revisions] = common.scan_cached_repo(
-            cache_dir=cache_dir, repo_id=repo_id
-        )
-        repo_commit_hash = []
-        for r in repo_revisions:
-            repo_commit_hash.append(r.commit_hash)
-
-        # Delete weights from cache, https://huggingface.co/docs/huggingface_hub/en/guides/manage-cache
-        delete_strategy = model_cache_info.delete_revisions(*repo_commit_hash)
-        delete_strategy.execute()
-        freed_size = delete_strategy.expected_freed_size_str
+        # Delete all revisions of the repo from the cache
+        freed_bytes = index.delete_repo(repo_id=repo_id)
+        freed_size = model_cache.format_size(freed_bytes)
         print(f"Freed {freed_size} space.", flush=True)
 
         # Delete install record from json file
-        if freed_size != "0.0":
+        if freed_bytes:
             common.delete_text_model_revisions(repo_id=repo_id)
 
         return {
@@ -336,14 +519,17 @@ async def text_inference(
     payload: classes.InferenceRequest,
 ):
     app = request.app
-    QUERY_INPUT = "{query_str}"
-    TOOL_ARGUMENTS = "{tool_arguments_str}"
-    TOOL_EXAMPLE_ARGUMENTS = "{tool_example_str}"
-    TOOL_NAME = "{tool_name_str}"
-    TOOL_DESCRIPTION = "{tool_description_str}"
-    ASSIGNED_TOOLS = "{assigned_tools_str}"
+    # Template placeholders, ie {query_str}
+    QUERY_INPUT = "query_str"
+    TOOL_ARGUMENTS = "tool_arguments_str"
+    TOOL_EXAMPLE_ARGUMENTS = "tool_example_str"
+    TOOL_NAME = "tool_name_str"
+    TOOL_DESCRIPTION = "tool_description_str"
+    ASSIGNED_TOOLS = "assigned_tools_str"
 
     try:
+        # Swapped in when the request gets its turn on the model
+        lora_adapters.requested_adapter.set(payload.loraAdapter)
         assigned_tool_names = payload.tools
         prompt = payload.prompt
         query_prompt = prompt
@@ -351,6 +537,7 @@ async def text_inference(
         collection_names = payload.collectionNames
         mode = payload.mode  # conversation type
         retrieval_type = payload.retrievalType or RetrievalTypes.BASE
+        tool_call_mode = payload.toolCallMode or ToolCallModes.PARSE
         prompt_template = payload.promptTemplate
         rag_prompt_template = payload.ragPromptTemplate
         system_message = payload.systemMessage
@@ -366,7 +553,7 @@ async def text_inference(
             stop=payload.stop,
             echo=payload.echo,
             model=payload.model,
-            grammar=payload.grammar,
+            grammar=grammars.registry.from_request(payload.grammar),
             mirostat_tau=payload.mirostat_tau,
             tfs_z=payload.tfs_z,
             top_k=payload.top_k,
@@ -395,24 +582,15 @@ async def text_inference(
         )
         assigned_tool: classes.ToolDefinition = None
         if is_agent:
-            all_installed_tool_defs: List[classes.ToolDefinition] = (
-                storage_route.get_all_tool_definitions().get("data")
-            )
             # @TODO Add tool_choice setting ? Right now we are hard-coding to first one
             chosen_tool_name = assigned_tool_names[0]
-            assigned_tool_defs = [
-                item
-                for item in all_installed_tool_defs
-                if item["name"] in assigned_tool_names
+            assigned_tool_defs: List[classes.ToolDefinition] = [
+                tool_registry.registry.get(name) for name in assigned_tool_names
             ]
-            tool_def = next(
-                (
-                    item
-                    for item in assigned_tool_defs
-                    if item["name"] == chosen_tool_name
-                ),
-                None,
-            )
+            assigned_tool_defs = [item for item in assigned_tool_defs if item]
+            tool_def = tool_registry.registry.get(chosen_tool_name)
+            if not tool_def:
+                raise Exception(f"No tool found named [{chosen_tool_name}].")
             assigned_tool = tool_def
             # Construct system msg
             tool_attrs = agent.get_tool_props(tool_def=tool_def)
@@ -420,33 +598,30 @@ async def text_inference(
             description_str = tool_attrs["description"]
             args_str = tool_attrs["arguments"]
             example_str = tool_attrs["example_arguments"]
-            assigned_tools_defs_str = agent.dict_list_to_markdown(assigned_tool_defs)
+            assigned_tools_defs_str = agent.get_tools_markdown(assigned_tool_defs)
+            tool_values = {
+                TOOL_ARGUMENTS: args_str,
+                TOOL_EXAMPLE_ARGUMENTS: example_str,
+                TOOL_NAME: name_str,
+                TOOL_DESCRIPTION: description_str,
+                ASSIGNED_TOOLS: assigned_tools_defs_str,
+            }
             # Inject template args into prompt
-            query_prompt = prompt_template.replace(QUERY_INPUT, prompt)
-            query_prompt = query_prompt.replace(TOOL_ARGUMENTS, args_str)
-            query_prompt = query_prompt.replace(TOOL_EXAMPLE_ARGUMENTS, example_str)
-            query_prompt = query_prompt.replace(TOOL_NAME, name_str)
-            query_prompt = query_prompt.replace(TOOL_DESCRIPTION, description_str)
-            query_prompt = query_prompt.replace(ASSIGNED_TOOLS, assigned_tools_defs_str)
+            if prompt_template:
+                query_prompt = prompt_templates.render(
+                    prompt_template, {QUERY_INPUT: prompt, **tool_values}
+                )
             print(f"Agent prompt::\n\n{query_prompt}")
             # Inject template args into system msg
             if system_message:
-                system_message = system_message.replace(TOOL_ARGUMENTS, args_str)
-                system_message = system_message.replace(
-                    TOOL_EXAMPLE_ARGUMENTS, example_str
-                )
-                system_message = system_message.replace(TOOL_NAME, name_str)
-                system_message = system_message.replace(
-                    TOOL_DESCRIPTION, description_str
-                )
-                system_message = system_message.replace(
-                    ASSIGNED_TOOLS, assigned_tools_defs_str
-                )
+                system_message = prompt_templates.render(system_message, tool_values)
                 print(f"Agent system message::\n\n{system_message}")
 
         # Normal prompt
         elif prompt_template:
-            query_prompt = prompt_template.replace(QUERY_INPUT, prompt)
+            query_prompt = prompt_templates.render(
+                prompt_template, {QUERY_INPUT: prompt}
+            )
 
         # RAG - Call LLM with context loaded via llama-index/vector store
         # Agent flow explicitly not supported for RAG due to context complexities.
@@ -456,6 +631,11 @@ async def text_inference(
             and collection_names is not None
             and len(collection_names) > 0
         )
+        num_candidates = payload.n or 1
+        if num_candidates > 1 and (
+            is_RAG or is_agent or mode != classes.CHAT_MODES.INSTRUCT.value
+        ):
+            raise Exception("'n' is only supported for instruct mode without tools.")
         if is_RAG:
             # Only take the first collection for now
             collection_name = collection_names[0]
@@ -474,7 +654,8 @@ async def text_inference(
             vector_index = main.load_embedding(app, collection_name)
 
             # Call LLM query engine
-            res = query.query_embedding(
+            res = await scheduler.run(
+                query.query_embedding,
                 llm=app.state.llm,
                 query=query_prompt,
                 prompt_template=rag_prompt_template,
@@ -486,27 +667,71 @@ async def text_inference(
             if streaming:
                 token_generator = res.response_gen
                 response = text_llama_index.token_streamer(token_generator)
-                return EventSourceResponse(response)
+                return EventSourceResponse(scheduler.stream(response))
             # Return non-stream response
             else:
                 return res
         # Raw model - Call LLM in raw completion mode (uses training data)
         elif mode == classes.CHAT_MODES.INSTRUCT.value:
             options["n_ctx"] = n_ctx
-            # Return streaming response
-            if streaming and not is_agent:
+            # Several candidates that share one prompt prefill, returned together
+            if num_candidates > 1:
+                result = await scheduler.run(
+                    candidates.complete_candidates,
+                    llm=app.state.llm,
+                    prompt=query_prompt,
+                    system_message=system_message,
+                    message_format=message_format,
+                    n=num_candidates,
+                    options=options,
+                    select_best=payload.selectBest,
+                )
+                return {
+                    "success": True,
+                    "message": f"Generated {num_candidates} candidates.",
+                    "data": result,
+                }
+            # Stream the agent's steps, tools may be called several times
+            elif streaming and is_agent:
                 return EventSourceResponse(
-                    text_llama_index.text_stream_completion(
+                    agent_executor.agent_loop(
+                        llm=app.state.llm,
                         prompt=query_prompt,
                         system_message=system_message,
                         message_format=message_format,
-                        app=app,
-                        options=options,
+                        tool_defs=assigned_tool_defs,
+                        max_tokens=max_tokens,
+                        max_steps=payload.maxAgentSteps,
+                        token_budget=payload.agentTokenBudget,
+                    )
+                )
+            # Return streaming response
+            elif streaming and not is_agent:
+                return EventSourceResponse(
+                    scheduler.stream(
+                        text_llama_index.text_stream_completion(
+                            prompt=query_prompt,
+                            system_message=system_message,
+                            message_format=message_format,
+                            app=app,
+                            options=options,
+                        )
                     )
                 )
+            # Generate the tool call constrained to the tool's schema
+            elif is_agent and tool_call_mode == ToolCallModes.CONSTRAINED:
+                return await scheduler.run(
+                    agent.constrained_tool_call,
+                    llm=app.state.llm,
+                    prompt=query_prompt,
+                    system_message=system_message,
+                    message_format=message_format,
+                    tool_def=assigned_tool,
+                )
             # Return non-stream response
             else:
-                response = text_llama_index.text_completion(
+                response = await scheduler.run(
+                    text_llama_index.text_completion,
                     prompt=query_prompt,
                     system_message=system_message,
                     message_format=message_format,
@@ -523,13 +748,39 @@ async def text_inference(
                     response.text = output_response.get("text")
                 return response
         # @TODO Stream LLM in chat mode
-        # @TODO Agent flow here
         elif mode == classes.CHAT_MODES.CHAT.value:
             options["n_ctx"] = n_ctx
+            # Summarized turns of the thread are sent in the system message instead
+            if payload.threadId:
+                messages, system_message = compaction.apply_compaction(
+                    payload.threadId, messages, system_message
+                )
+            if is_agent:
+                return EventSourceResponse(
+                    agent_executor.agent_loop(
+                        llm=app.state.llm,
+                        prompt=agent_executor.chat_history_prompt(
+                            messages, query_prompt
+                        ),
+                        system_message=system_message,
+                        message_format=message_format,
+                        tool_defs=assigned_tool_defs,
+                        max_tokens=max_tokens,
+                        max_steps=payload.maxAgentSteps,
+                        token_budget=payload.agentTokenBudget,
+                    )
+                )
             # Returns a streaming response
             return EventSourceResponse(
-                text_llama_index.text_chat(
-                    messages, system_message, message_format, app, options
+                scheduler.stream(
+                    text_llama_index.text_chat(
+                        messages,
+                        query_prompt,
+                        system_message,
+                        message_format,
+                        app,
+                        options,
+                    )
                 )
             )
         elif mode is None:
@@ -541,3 +792,306 @@ async def text_inference(
         raise HTTPException(
             status_code=400, detail=f"Something went wrong. Reason: {err}"
         )
+
+
+# Embed a batch of texts. Concurrent requests are grouped into a single model call.
+@router.post("/embedding")
+async def create_text_embeddings(
+    request: Request,
+    payload: classes.EmbeddingRequest,
+) -> classes.EmbeddingResponse:
+    try:
+        texts = payload.texts
+        encoding = payload.encoding or EmbeddingEncodings.FLOAT
+        if not texts:
+            raise Exception("No texts provided.")
+        batcher = text_embedding.get_embedding_batcher(request.app)
+        vectors = await batcher.embed(texts)
+        return {
+            "success": True,
+            "message": f"Embedded {len(texts)} text(s).",
+            "data": {
+                "embeddings": text_embedding.encode_vectors(vectors, encoding),
+                "dimensions": vectors.shape[1],
+                "encoding": encoding,
+            },
+        }
+    except (KeyError, Exception) as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
+        )
+
+
+# Extract json matching a schema from text. Pass "documents" to extract from many texts,
+# they run at batch priority so interactive requests are served in between.
+@router.post("/extraction")
+async def extract_structured_data(
+    request: Request,
+    payload: classes.ExtractionRequest,
+) -> classes.ExtractionResponse:
+    app = request.app
+
+    try:
+        if not app.state.llm:
+            raise Exception("No LLM loaded.")
+        # May fetch a remote tool's schema
+        schema = await asyncio.to_thread(
+            extraction.resolve_schema, payload.jsonSchema, payload.schemaId
+        )
+        options = dict(
+            schema=schema,
+            prompt_template=payload.promptTemplate,
+            system_message=payload.systemMessage,
+            message_format=payload.messageFormat,
+            max_tokens=payload.max_tokens,
+        )
+        # Bulk mode
+        if payload.documents:
+            results = []
+            for text in payload.documents:
+                result = await scheduler.run(
+                    extraction.extract,
+                    app.state.llm,
+                    text,
+                    priority=Priority.BATCH,
+                    **options,
+                )
+                results.append(result)
+            num_valid = len([item for item in results if item["success"]])
+            return {
+                "success": True,
+                "message": f"Extracted {num_valid}/{len(results)} document(s).",
+                "data": results,
+            }
+        if not payload.text:
+            raise Exception("Provide 'text' or 'documents'.")
+        result = await scheduler.run(
+            extraction.extract, app.state.llm, payload.text, **options
+        )
+        return {
+            "success": result["success"],
+            "message": (
+                "Extracted data."
+                if result["success"]
+                else "Extracted data does not match the schema."
+            ),
+            "data": result,
+        }
+    except (KeyError, Exception) as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
+        )
+
+
+# Code completion for editors. Prompts are fill-in-the-middle formatted and kept short.
+@router.post("/copilot")
+async def code_completion(
+    request: Request,
+    payload: classes.CopilotRequest,
+) -> classes.CopilotResponse:
+    app = request.app
+    client_id = payload.clientId
+    generation = copilot.sessions.start(client_id)
+
+    try:
+        if not app.state.llm:
+            raise Exception("No LLM loaded.")
+        fim_format = copilot.get_fim_format(payload.fimFormat, app.state.path_to_model)
+        result = await scheduler.run(
+            copilot.complete,
+            app.state.llm,
+            payload.prefix,
+            payload.suffix or "",
+            fim_format,
+            client_id,
+            generation,
+            max_tokens=payload.max_tokens or copilot.DEFAULT_COPILOT_MAX_TOKENS,
+            temperature=payload.temperature or 0.0,
+            stop=payload.stop,
+            multiline=payload.multiline,
+        )
+        if result is None:
+            return {
+                "success": False,
+                "message": "Superseded by a newer request.",
+                "data": None,
+            }
+        return {
+            "success": True,
+            "message": "Completed code.",
+            "data": result,
+        }
+    except (KeyError, Exception) as err:
+        print(f"Error: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
+        )
+    finally:
+        copilot.sessions.end(client_id, generation)
+
+
+# Submit a JSONL file of inference requests (one per line) to run in the background
+@router.post("/batch-job")
+async def create_batch_job(
+    file: UploadFile = File(...),
+) -> classes.BatchJobResponse:
+    try:
+        content = await file.read()
+        job = batch_jobs.get_manager().submit(content, name=file.filename)
+    except Exception as err:
+        print(f"{common.PRNT_API} Failed to create batch job: {err}", flush=True)
+        raise HTTPException(
+            status_code=400, detail=f"Something went wrong. Reason: {err}"
+        )
+    return {
+        "success": True,
+        "message": f"Queued batch job with {job['total']} item(s).",
+        "data": job,
+    }
+
+
+# Progress of all batch jobs
+@router.get("/batch-jobs")
+def get_batch_jobs() -> classes.BatchJobsResponse:
+    jobs = batch_jobs.get_manager().list()
+    return {
+        "success": True,
+        "message": f"Returned {len(jobs)} batch job(s).",
+        "data": jobs,
+    }
+
+
+# Progress of a batch job
+@router.get("/batch-job")
+def get_batch_job(id: str) -> classes.BatchJobResponse:
+    try:
+        job = batch_jobs.get_manager().get(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Batch job is {job['status']}.",
+        "data": job,
+    }
+
+
+# Stop processing a batch job after the current item
+@router.post("/batch-job/pause")
+def pause_batch_job(id: str) -> classes.BatchJobResponse:
+    try:
+        job = batch_jobs.get_manager().pause(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Batch job is {job['status']}.",
+        "data": job,
+    }
+
+
+# Continue a paused (or failed) batch job from the last finished item
+@router.post("/batch-job/resume")
+def resume_batch_job(id: str) -> classes.BatchJobResponse:
+    try:
+        job = batch_jobs.get_manager().resume(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Batch job is {job['status']}.",
+        "data": job,
+    }
+
+
+# Download the results (JSONL) finished so far, lines are {index, id, success, text, error}
+@router.get("/batch-job/results")
+def download_batch_job_results(id: str):
+    try:
+        path = batch_jobs.get_manager().results_path(id)
+    except Exception as err:
+        raise HTTPException(status_code=404, detail=f"{err}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No results yet.")
+    return FileResponse(
+        path, media_type="application/x-ndjson", filename=f"{id}-results.jsonl"
+    )
+
+
+# Stop a batch job and remove its files
+@router.delete("/batch-job")
+def delete_batch_job(id: str) -> classes.BatchJobResponse:
+    try:
+        batch_jobs.get_manager().delete(id)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": "Removed batch job.",
+        "data": None,
+    }
+
+
+# Register a LoRA adapter that bots can apply to the loaded model
+@router.post("/lora-adapter")
+def register_lora_adapter(data: classes.LoraAdapter) -> classes.LoraAdapterResponse:
+    try:
+        adapter = lora_adapters.get_manager().register(
+            data.name, data.path, data.scale, data.base
+        )
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Registered LoRA adapter [{data.name}].",
+        "data": adapter,
+    }
+
+
+# All registered LoRA adapters
+@router.get("/lora-adapters")
+def get_lora_adapters() -> classes.LoraAdaptersResponse:
+    adapters = lora_adapters.get_manager().list()
+    return {
+        "success": True,
+        "message": f"Returned {len(adapters)} LoRA adapter(s).",
+        "data": adapters,
+    }
+
+
+# Apply a LoRA adapter to the loaded model now, leave out the name to remove the active one
+@router.post("/lora-adapter/activate")
+async def activate_lora_adapter(name: str = ""):
+    try:
+        await scheduler.run(lora_adapters.get_manager().activate, name or None)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"LoRA adapter [{name or 'none'}] is active.",
+        "data": lora_adapters.get_manager().stats(),
+    }
+
+
+@router.delete("/lora-adapter")
+def delete_lora_adapter(name: str):
+    try:
+        lora_adapters.get_manager().unregister(name)
+    except Exception as err:
+        return {"success": False, "message": f"{err}", "data": None}
+    return {
+        "success": True,
+        "message": f"Removed LoRA adapter [{name}].",
+        "data": None,
+    }
+
+
+# Active adapter, swap count and time, and the in-memory adapter cache
+@router.get("/loraStats")
+def get_lora_stats():
+    return {
+        "success": True,
+        "message": "Returned LoRA adapter stats.",
+        "data": lora_adapters.get_manager().stats(),
+    }
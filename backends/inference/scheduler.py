@@ -0,0 +1,122 @@
+###
+# Gives out turns on the loaded text model. One request generates at a time and waiting interactive
+# requests (chat, completions) always go before batch work (bulk extraction, batch jobs), which
+# waits for a free slot between items.
+###
+import heapq
+import asyncio
+import itertools
+from enum import IntEnum
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Iterator, List
+from starlette.concurrency import iterate_in_threadpool
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+# Run a blocking call in a worker thread and wait for it to be done. A thread can not be stopped,
+# so if the caller is cancelled this still waits for the call to finish (and the slot stays held)
+# before the cancellation goes on.
+async def run_in_thread(func: Callable, *args, **kwargs) -> Any:
+    work = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(work)
+    except asyncio.CancelledError:
+        while not work.done():
+            try:
+                await asyncio.wait([work])
+            except asyncio.CancelledError:
+                pass
+        # Nobody is left to read the result
+        if not work.cancelled():
+            work.exception()
+        raise
+
+
+class InferenceScheduler:
+    def __init__(self):
+        self._busy = False
+        # (priority, order, future) of requests waiting for the model
+        self._waiters: List[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self.completed = {Priority.INTERACTIVE: 0, Priority.BATCH: 0}
+        # Awaited each time a request gets the slot, before it uses the model
+        self._acquire_hooks: List[Callable[[], Awaitable]] = []
+
+    def add_acquire_hook(self, hook: Callable[[], Awaitable]):
+        if hook not in self._acquire_hooks:
+            self._acquire_hooks.append(hook)
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE):
+        if not self._busy and not self._waiters:
+            self._busy = True
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was handed over just as the request went away, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    # Hands the slot straight to the next waiter so nobody can jump the queue
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._busy = False
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            for hook in self._acquire_hooks:
+                await hook()
+            yield
+        finally:
+            self.completed[priority] += 1
+            self.release()
+
+    # Run a blocking call on the model in a worker thread
+    async def run(
+        self,
+        func: Callable,
+        *args,
+        priority: Priority = Priority.INTERACTIVE,
+        **kwargs,
+    ) -> Any:
+        async with self.slot(priority):
+            return await run_in_thread(func, *args, **kwargs)
+
+    # Iterate a (blocking) token generator in a worker thread, the slot is held until it is done
+    async def stream(
+        self, iterator: Iterator, priority: Priority = Priority.INTERACTIVE
+    ):
+        async with self.slot(priority):
+            async for item in iterate_in_threadpool(iterator):
+                yield item
+
+    def stats(self) -> dict:
+        waiting = [item for item in self._waiters if not item[2].done()]
+        return {
+            "busy": self._busy,
+            "waiting_interactive": len(
+                [item for item in waiting if item[0] == Priority.INTERACTIVE]
+            ),
+            "waiting_batch": len(
+                [item for item in waiting if item[0] == Priority.BATCH]
+            ),
+            "completed_interactive": self.completed[Priority.INTERACTIVE],
+            "completed_batch": self.completed[Priority.BATCH],
+        }
+
+
+# Shared by all requests
+scheduler = InferenceScheduler()
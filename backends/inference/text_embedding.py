@@ -0,0 +1,125 @@
+###
+# Text embeddings for the /v1/text/embedding endpoint.
+# Concurrent requests are collected for a short window (or until a batch is full) and embedded
+# together in a single call to the model, then split back up per request.
+# The embedder is the HuggingFace model used for memories, or a GGUF model run by llama.cpp
+# when TEXT_EMBEDDING_MODEL_PATH is set.
+###
+import os
+import base64
+import asyncio
+from typing import Callable, List, Optional
+import numpy as np
+from llama_cpp import Llama
+from embeddings import main
+from inference.classes import EmbeddingEncodings
+
+DEFAULT_BATCH_WINDOW_MS = 5.0
+DEFAULT_MAX_BATCH_SIZE = 64
+
+
+# Returns a function that embeds a list of texts, the model is loaded on first use
+def create_embedder(app) -> Callable[[List[str]], List[List[float]]]:
+    model_path = os.getenv("TEXT_EMBEDDING_MODEL_PATH")
+    if model_path:
+        llm: Optional[Llama] = None
+
+        def embed_gguf(texts: List[str]):
+            nonlocal llm
+            if llm is None:
+                llm = Llama(model_path=model_path, embedding=True, verbose=False)
+            return [item["embedding"] for item in llm.create_embedding(texts)["data"]]
+
+        return embed_gguf
+
+    def embed_hf(texts: List[str]):
+        embed_model = app.state.embed_model or main.define_embedding_model(app)
+        return embed_model.get_text_embedding_batch(texts)
+
+    return embed_hf
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        embed_texts: Callable[[List[str]], List[List[float]]],
+        window_ms: float = DEFAULT_BATCH_WINDOW_MS,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ):
+        self.embed_texts = embed_texts
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self._pending: List[tuple[List[str], asyncio.Future]] = []
+        self._pending_size = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # The model runs one batch at a time
+        self._model_lock = asyncio.Lock()
+        # The loop only keeps weak references to tasks
+        self._tasks: set[asyncio.Task] = set()
+
+    # Returns a (len(texts), dimensions) float32 array
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((texts, future))
+        self._pending_size += len(texts)
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch = self._pending
+        self._pending = []
+        self._pending_size = 0
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[tuple[List[str], asyncio.Future]]):
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        try:
+            async with self._model_lock:
+                vectors = await asyncio.to_thread(self.embed_texts, texts)
+            vectors = np.asarray(vectors, dtype=np.float32)
+            self.batches += 1
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        offset = 0
+        for request_texts, future in batch:
+            if not future.done():
+                future.set_result(vectors[offset : offset + len(request_texts)])
+            offset += len(request_texts)
+
+
+def encode_vectors(vectors: np.ndarray, encoding: EmbeddingEncodings) -> list:
+    if encoding == EmbeddingEncodings.BASE64:
+        little_endian = vectors.astype("<f4", copy=False)
+        return [
+            base64.b64encode(row.tobytes()).decode("ascii") for row in little_endian
+        ]
+    return vectors.tolist()
+
+
+# Shared by all requests, created on first use
+def get_embedding_batcher(app) -> EmbeddingBatcher:
+    if app.state.embedding_batcher is None:
+        app.state.embedding_batcher = EmbeddingBatcher(
+            embed_texts=create_embedder(app),
+            window_ms=float(
+                os.getenv("EMBEDDING_BATCH_WINDOW_MS", DEFAULT_BATCH_WINDOW_MS)
+            ),
+            max_batch_size=int(
+                os.getenv("EMBEDDING_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE)
+            ),
+        )
+    return app.state.embedding_batcher
@@ -0,0 +1,113 @@
+###
+# A deterministic stand-in for a real text model. It exposes the same LlamaIndex LLM interface
+# as LlamaCPP so routing, streaming (SSE) and RAG glue can be benchmarked without a model file.
+###
+import time
+import random
+import hashlib
+from typing import Any, Dict, List
+from llama_index.core.base.llms.types import (
+    CompletionResponse,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+DEFAULT_PREFILL_MS_PER_TOKEN = 0.5
+DEFAULT_DECODE_MS_PER_TOKEN = 20.0
+# Words used to build the (deterministic) responses
+FAKE_VOCABULARY = [
+    "the",
+    "model",
+    "answer",
+    "is",
+    "a",
+    "simple",
+    "result",
+    "of",
+    "local",
+    "inference",
+    "and",
+    "text",
+    "with",
+    "context",
+    "data",
+    "memory",
+]
+
+
+class FakeLLM(CustomLLM):
+    model_path: str = Field(default="fake", description="Name of the fake model.")
+    context_window: int = Field(description="The maximum number of context tokens.")
+    max_new_tokens: int = Field(description="The number of tokens to generate.")
+    seed: int = Field(description="Seed mixed into the prompt hash.")
+    prefill_ms_per_token: float = Field(
+        default=DEFAULT_PREFILL_MS_PER_TOKEN,
+        description="Simulated prompt processing time per prompt token.",
+    )
+    decode_ms_per_token: float = Field(
+        default=DEFAULT_DECODE_MS_PER_TOKEN,
+        description="Simulated generation time per output token.",
+    )
+    generate_kwargs: Dict[str, Any] = Field(
+        default_factory=dict, description="Kwargs used for generation."
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(
+            context_window=self.context_window,
+            num_output=self.max_new_tokens,
+            model_name=self.model_path,
+        )
+
+    # Rough token count, good enough to scale the simulated prefill time
+    def count_tokens(self, text: str) -> int:
+        return max(1, len(text) // 4)
+
+    # Same prompt and seed always produce the same tokens
+    def _generate_tokens(self, prompt: str) -> List[str]:
+        max_tokens = self.generate_kwargs.get("max_tokens") or self.max_new_tokens
+        digest = hashlib.sha256(f"{self.seed}:{prompt}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest, 16))
+        return [f"{rng.choice(FAKE_VOCABULARY)} " for _ in range(max_tokens)]
+
+    def _prefill(self, prompt: str):
+        time.sleep(self.count_tokens(prompt) * self.prefill_ms_per_token / 1000)
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        if not formatted:
+            prompt = self.completion_to_prompt(prompt)
+        self._prefill(prompt)
+        tokens = self._generate_tokens(prompt)
+        time.sleep(len(tokens) * self.decode_ms_per_token / 1000)
+        text = "".join(tokens)
+        return CompletionResponse(text=text, raw={"choices": [{"text": text}]})
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        if not formatted:
+            prompt = self.completion_to_prompt(prompt)
+
+        def gen() -> CompletionResponseGen:
+            self._prefill(prompt)
+            text = ""
+            for token in self._generate_tokens(prompt):
+                time.sleep(self.decode_ms_per_token / 1000)
+                text += token
+                yield CompletionResponse(
+                    delta=token, text=text, raw={"choices": [{"text": token}]}
+                )
+
+        return gen()
@@ -4,11 +4,14 @@
 ###
 import os
 import json
-from typing import List, Optional, Sequence
+from contextlib import contextmanager
+from typing import Any, List, Optional, Sequence, Tuple
 from llama_index.llms.llama_cpp import LlamaCPP
 from llama_index.core.base.llms.types import ChatMessage, MessageRole
 from llama_index.core.callbacks import CallbackManager
 from core import common, classes
+from inference import text_fake_llm, grammars, prompt_templates, context_shift
+from inference import kv_cache, model_prefetch
 
 # These generic helper funcs wont add End_of_seq tokens etc but construct the Prompt/Message
 # from llama_index.llms.generic_utils import messages_to_prompt
@@ -45,28 +48,29 @@ def completion_to_prompt(
         return f"{system_prompt.strip()} {completion.strip()}"
 
     # Format to specified template
-    prompt_str = template_str.replace("{prompt}", completion.strip())
-    completion_str = prompt_str.replace("{system_message}", system_prompt.strip())
-    return completion_str
+    return prompt_templates.render(
+        template_str,
+        {"prompt": completion.strip(), "system_message": system_prompt.strip()},
+    )
 
 
-# Format the prompt for chat conversations
-# @TODO Could also use: from llama_index.llms.llama_cpp.llama_utils import messages_to_prompt
-def messages_to_prompt(
+# Split a chat conversation into the part that never changes (system message) and one segment per turn.
+# Joined they are the full prompt. Dropping the oldest turns still leaves a well formed prompt.
+def chat_segments(
     messages: Sequence[ChatMessage],
     system_prompt: Optional[str] = DEFAULT_SYSTEM_MESSAGE,
-    template: Optional[dict] = {},  # Model specific template
-) -> str:
+    template: Optional[dict] = None,  # Model specific template
+) -> Tuple[str, List[str]]:
     # (end tokens, structure, etc)
     # @TODO Pass these in from UI model_configs.json (values found in config.json of HF model card)
-    BOS = template["BOS"] or ""
-    EOS = template["EOS"] or ""
-    B_INST = template["B_INST"] or ""
-    E_INST = template["E_INST"] or ""
-    B_SYS = template["B_SYS"] or ""
-    E_SYS = template["E_SYS"] or ""
-
-    string_messages: List[str] = []
+    template = template or {}
+    BOS = template.get("BOS") or ""
+    EOS = template.get("EOS") or ""
+    B_INST = template.get("B_INST") or ""
+    E_INST = template.get("E_INST") or ""
+    B_SYS = template.get("B_SYS") or ""
+    E_SYS = template.get("E_SYS") or ""
+
     if messages[0].role == MessageRole.SYSTEM:
         # pull out the system message (if it exists in messages)
         system_message_str = messages[0].content or ""
@@ -75,23 +79,17 @@ def messages_to_prompt(
         system_message_str = system_prompt
 
     system_message_str = f"{B_SYS} {system_message_str.strip()} {E_SYS}"
+    # make sure system prompt is included at the start
+    pinned = f"{BOS} {B_INST} {system_message_str} "
 
+    turns: List[str] = []
     for i in range(0, len(messages), 2):
         # first message should always be a user
         user_message = messages[i]
         assert user_message.role == MessageRole.USER
 
-        if i == 0:
-            # make sure system prompt is included at the start
-            str_message = f"{BOS} {B_INST} {system_message_str} "
-        else:
-            # end previous user-assistant interaction
-            string_messages[-1] += f" {EOS}"
-            # no need to include system prompt
-            str_message = f"{BOS} {B_INST} "
-
         # include user message content
-        str_message += f"{user_message.content} {E_INST}"
+        str_message = f"{user_message.content} {E_INST}"
 
         if len(messages) > (i + 1):
             # if assistant message exists, add to str_message
@@ -99,9 +97,50 @@ def messages_to_prompt(
             assert assistant_message.role == MessageRole.ASSISTANT
             str_message += f" {assistant_message.content}"
 
-        string_messages.append(str_message)
+        if len(messages) > (i + 2):
+            # end this user-assistant interaction and start the next one
+            str_message += f" {EOS}{BOS} {B_INST} "
 
-    return "".join(string_messages)
+        turns.append(str_message)
+
+    return pinned, turns
+
+
+# Format the prompt for chat conversations
+# @TODO Could also use: from llama_index.llms.llama_cpp.llama_utils import messages_to_prompt
+def messages_to_prompt(
+    messages: Sequence[ChatMessage],
+    system_prompt: Optional[str] = DEFAULT_SYSTEM_MESSAGE,
+    template: Optional[dict] = None,  # Model specific template
+) -> str:
+    pinned, turns = chat_segments(messages, system_prompt, template)
+    return "".join([pinned, *turns])
+
+
+# Chat history from the request, followed by the new prompt.
+# Plain strings take turns with the message before them: user, assistant, user...
+def to_chat_messages(messages: Sequence[Any], prompt: str) -> List[ChatMessage]:
+    chat_messages = []
+    for message in messages or []:
+        if isinstance(message, str):
+            last = chat_messages[-1] if chat_messages else None
+            role = (
+                MessageRole.ASSISTANT
+                if last and last.role == MessageRole.USER
+                else MessageRole.USER
+            )
+            chat_messages.append(ChatMessage(role=role, content=message))
+        else:
+            chat_messages.append(
+                ChatMessage(role=MessageRole(message.role), content=message.content)
+            )
+    # The prompt may already be the last message
+    last = chat_messages[-1] if chat_messages else None
+    if prompt and not (
+        last and last.role == MessageRole.USER and last.content == prompt
+    ):
+        chat_messages.append(ChatMessage(role=MessageRole.USER, content=prompt))
+    return chat_messages
 
 
 # Methods
@@ -179,14 +218,17 @@ def load_text_model(
         "frequency_penalty": gen_settings.frequency_penalty,
         "temperature": temperature,
         "seed": seed,
-        "grammar": gen_settings.grammar,
+        "grammar": grammars.registry.from_request(gen_settings.grammar),
         "max_tokens": max_tokens,
     }
 
+    # How the weights get from disk into memory
+    load_policy = model_prefetch.resolve_policy(init_settings)
+
     model_kwargs = {
         "n_gpu_layers": init_settings.n_gpu_layers,
         "use_mmap": init_settings.use_mmap,
-        "use_mlock": init_settings.use_mlock,
+        "use_mlock": load_policy == model_prefetch.MLOCK,
         "f16_kv": init_settings.f16_kv,
         "seed": seed,
         "n_ctx": n_ctx,
@@ -198,39 +240,130 @@ def load_text_model(
         # "load_in_8bit": True,
     }
 
+    # Quantized KV cache, validated before loading
+    type_k, type_v = kv_cache.resolve_cache_types(init_settings)
+
+    if load_policy == model_prefetch.MLOCK:
+        mlock_limit = model_prefetch.mlock_limit()
+        if mlock_limit is not None and mlock_limit < os.path.getsize(path_to_model):
+            print(
+                f"{common.PRNT_API} RLIMIT_MEMLOCK ({mlock_limit // (1024 * 1024)} MB) is smaller than the model, it may not stay locked.",
+                flush=True,
+            )
+    # Reads the weights into the page cache while the model loads
+    model_prefetch.prefetcher.start(path_to_model, load_policy)
+
     # @TODO Can we update these without needing to unload model?
     # From: https://docs.llamaindex.ai/en/stable/examples/llm/llama_2_llama_cpp.html
-    llm = LlamaCPP(
-        # Provide a url to download a model from
-        model_url=None,
-        # Or, you can set the path to a pre-downloaded model instead of model_url
-        model_path=path_to_model,
-        # Both max_new_tokens and temperature will override their generate_kwargs counterparts
-        max_new_tokens=max_tokens,
-        temperature=temperature,
-        # llama2 has a context window of 4096 tokens, but we set it lower to allow for some wiggle room.
-        # Note, this sets n_ctx in the model_kwargs below, so you don't need to pass it there.
+    try:
+        with kv_cache.context_params(type_k, type_v):
+            llm = LlamaCPP(
+                # Provide a url to download a model from
+                model_url=None,
+                # Or, you can set the path to a pre-downloaded model instead of model_url
+                model_path=path_to_model,
+                # Both max_new_tokens and temperature will override their generate_kwargs counterparts
+                max_new_tokens=max_tokens,
+                temperature=temperature,
+                # llama2 has a context window of 4096 tokens, but we set it lower to allow for some wiggle room.
+                # Note, this sets n_ctx in the model_kwargs below, so you don't need to pass it there.
+                context_window=n_ctx,
+                # kwargs to pass to __call__()
+                generate_kwargs=generate_kwargs,
+                # kwargs to pass to __init__()
+                model_kwargs=model_kwargs,
+                # Transform inputs into model specific format
+                messages_to_prompt=messages_to_prompt,
+                completion_to_prompt=completion_to_prompt,
+                callback_manager=callback_manager,
+                verbose=True,
+            )
+    except Exception:
+        # Stop reading the weights of a model that did not load
+        model_prefetch.prefetcher.cancel()
+        raise
+    return llm
+
+
+# Deterministic fake model used for load testing, no model file is needed.
+# Latencies are configured with env vars FAKE_LLM_PREFILL_MS and FAKE_LLM_DECODE_MS (per token).
+def load_fake_text_model(
+    path_to_model: str,
+    mode: str,
+    init_settings: classes.LoadTextInferenceInit,  # init settings
+    gen_settings: classes.LoadTextInferenceCall,  # generation settings
+    callback_manager: CallbackManager = None,  # Optional, debugging
+):
+    n_ctx = init_settings.n_ctx or classes.DEFAULT_CONTEXT_WINDOW
+    if n_ctx <= 0:
+        n_ctx = classes.DEFAULT_CONTEXT_WINDOW
+    max_tokens = common.calc_max_tokens(gen_settings.max_tokens, n_ctx, mode)
+    return text_fake_llm.FakeLLM(
+        model_path=path_to_model or "fake",
         context_window=n_ctx,
-        # kwargs to pass to __call__()
-        generate_kwargs=generate_kwargs,
-        # kwargs to pass to __init__()
-        model_kwargs=model_kwargs,
-        # Transform inputs into model specific format
+        max_new_tokens=max_tokens,
+        seed=init_settings.seed or classes.DEFAULT_SEED,
+        prefill_ms_per_token=float(
+            os.getenv(
+                "FAKE_LLM_PREFILL_MS", text_fake_llm.DEFAULT_PREFILL_MS_PER_TOKEN
+            )
+        ),
+        decode_ms_per_token=float(
+            os.getenv(
+                "FAKE_LLM_DECODE_MS", text_fake_llm.DEFAULT_DECODE_MS_PER_TOKEN
+            )
+        ),
+        generate_kwargs={"max_tokens": max_tokens},
         messages_to_prompt=messages_to_prompt,
         completion_to_prompt=completion_to_prompt,
         callback_manager=callback_manager,
-        verbose=True,
     )
-    return llm
+
+
+# Loaders for each text inference backend. All of them return a LlamaIndex LLM.
+TEXT_BACKENDS = {
+    "llama_cpp": load_text_model,
+    "fake": load_fake_text_model,
+}
 
 
 # Remove from memory
 def unload_text_model(llm):
+    model_prefetch.prefetcher.cancel()
     # Python garbage collector should cleanup if no ref to obj exists
     # https://github.com/abetlen/llama-cpp-python/issues/302
     del llm
 
 
+# LlamaCPP ignores per-call kwargs and only reads `generate_kwargs`,
+# so a request's settings are swapped in while the call is made.
+@contextmanager
+def request_generate_kwargs(llm, overrides: dict):
+    generate_kwargs: dict = getattr(llm, "generate_kwargs", None)
+    if not overrides or generate_kwargs is None:
+        yield
+        return
+    missing = object()
+    prev_values = {key: generate_kwargs.get(key, missing) for key in overrides}
+    generate_kwargs.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in prev_values.items():
+            if value is missing:
+                generate_kwargs.pop(key, None)
+            else:
+                generate_kwargs[key] = value
+
+
+# Swap in a request's compiled grammar
+@contextmanager
+def request_grammar(llm, grammar):
+    overrides = {"grammar": grammar} if grammar is not None else {}
+    with request_generate_kwargs(llm, overrides):
+        yield
+
+
 def token_streamer(token_generator):
     # @TODO We may need to do some token parsing here...multi-byte encoding can cut off emoji/khanji chars.
     # result = "" # accumulate a final response to be encoded in utf-8 in entirety
@@ -264,7 +397,8 @@ def text_stream_completion(
     print(f"{common.PRNT_API} Text Stream Completion: {message}", flush=True)
 
     # Stream response
-    token_generator = llm.stream_complete(message, formatted=True, kwargs=options)
+    with request_grammar(llm, options.get("grammar")):
+        token_generator = llm.stream_complete(message, formatted=True, kwargs=options)
     for token in token_generator:
         # print(token.delta, end="", flush=True)
         payload = {"event": "GENERATING_TOKENS", "data": f"{token.delta}"}
@@ -290,13 +424,15 @@ def text_completion(
     print(f"{common.PRNT_API} Text Non Stream Completion: {message}", flush=True)
 
     # Get response
-    res = llm.complete(message, formatted=True, kwargs=options)
+    with request_grammar(llm, options.get("grammar")):
+        res = llm.complete(message, formatted=True, kwargs=options)
     return res
 
 
 # Perform a normal text chat conversation
 def text_chat(
-    messages: Sequence[str],
+    messages: Sequence[Any],
+    prompt: str,
     system_message: str,
     message_format: str,
     app,
@@ -306,15 +442,31 @@ def text_chat(
     if llm == None:
         raise Exception("No Ai loaded.")
 
-    sys_message = system_message or ""
-    formatted_messages = messages
-
-    if message_format:
-        # Manually format to model spec, inject system message and prompt into query
-        formatted_messages = messages_to_prompt(messages, sys_message)
+    sys_message = system_message or DEFAULT_SYSTEM_MESSAGE
+    chat_messages = to_chat_messages(messages, prompt)
+
+    # Long chats drop their oldest turns from the KV cache instead of overflowing it
+    model = getattr(llm, "_model", None)
+    if context_shift.is_supported(model):
+        pinned, turns = chat_segments(chat_messages, sys_message)
+        tokens, max_tokens, shift = context_shift.prepare_chat_tokens(
+            model, pinned, turns, options.get("max_tokens")
+        )
+        if shift:
+            yield json.dumps({"event": "CONTEXT_SHIFT", "data": shift})
+        generate_kwargs = {**llm.generate_kwargs, "stream": True}
+        generate_kwargs["max_tokens"] = max_tokens
+        if options.get("grammar") is not None:
+            generate_kwargs["grammar"] = options.get("grammar")
+        for chunk in model(prompt=tokens, **generate_kwargs):
+            text = chunk["choices"][0]["text"]
+            payload = {"event": "GENERATING_TOKENS", "data": f"{text}"}
+            yield json.dumps(payload)
+        return
 
     # Stream response
-    token_generator = llm.stream_chat(formatted_messages, kwargs=options)
+    with request_grammar(llm, options.get("grammar")):
+        token_generator = llm.stream_chat(chat_messages, kwargs=options)
     for token in token_generator:
         # print(token.delta, end="", flush=True)
         payload = {"event": "GENERATING_TOKENS", "data": f"{token.delta}"}
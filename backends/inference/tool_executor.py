@@ -0,0 +1,303 @@
+###
+# Runs tool functions in a warm pool of worker processes so a slow, hung or memory hungry
+# tool cannot block inference. Every call has a timeout, failures are returned as structured
+# errors instead of raised, and latency is recorded per tool.
+###
+import os
+import json
+import time
+import asyncio
+import multiprocessing
+from threading import Lock
+from collections import OrderedDict
+from typing import Optional
+from core import classes
+from inference import remote_tools, tool_registry, tool_worker
+
+DEFAULT_TOOL_WORKERS = 2
+DEFAULT_TOOL_TIMEOUT_SECS = 30.0
+DEFAULT_TOOL_MEMORY_LIMIT_MB = 512  # 0 disables the limit
+DEFAULT_TOOL_CACHE_SIZE = 256  # results kept for tools marked "cacheable"
+DEFAULT_TOOL_CACHE_TTL_SECS = 300.0
+
+
+def tool_error(type: str, message: str) -> dict:
+    return {
+        "success": False,
+        "result": None,
+        "error": {"type": type, "message": message},
+    }
+
+
+# Memoized results of pure tools, keyed by tool name and canonical (sorted) arguments
+class ToolResultCache:
+    def __init__(
+        self,
+        max_size: int = DEFAULT_TOOL_CACHE_SIZE,
+        default_ttl: float = DEFAULT_TOOL_CACHE_TTL_SECS,
+    ):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires_at, result)
+        self._results: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = Lock()
+
+    def key(self, tool_def: classes.ToolDefinition, args: dict) -> Optional[str]:
+        if not tool_def.get("cacheable"):
+            return None
+        try:
+            return f"{tool_def['name']}:{json.dumps(args, sort_keys=True)}"
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, key: Optional[str]) -> Optional[dict]:
+        if key is None:
+            return None
+        with self._lock:
+            item = self._results.get(key)
+            if item and item[0] > time.monotonic():
+                self._results.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                del self._results[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Optional[str], tool_def: classes.ToolDefinition, result: dict):
+        # Errors (and timeouts) are never cached
+        if key is None or not result["success"]:
+            return
+        ttl = tool_def.get("cache_ttl") or self.default_ttl
+        with self._lock:
+            self._results[key] = (time.monotonic() + ttl, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ToolExecutor:
+    def __init__(
+        self,
+        workers: int = DEFAULT_TOOL_WORKERS,
+        timeout: float = DEFAULT_TOOL_TIMEOUT_SECS,
+        memory_limit_mb: int = DEFAULT_TOOL_MEMORY_LIMIT_MB,
+        cache: Optional[ToolResultCache] = None,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.cache = cache or ToolResultCache()
+        self._pool = None
+        self._lock = Lock()
+        # tool name -> {"calls", "cache_hits", "errors", "timeouts", "total_ms", "max_ms"}
+        self._stats: dict[str, dict] = {}
+
+    # Paths of all installed tools, compiled by each worker when it starts
+    def _tool_paths(self) -> list:
+        paths = []
+        for tool_def in tool_registry.registry.definitions():
+            try:
+                paths.append(tool_registry.find_function_path(tool_def["path"]))
+            except Exception:
+                pass
+        return paths
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                # "spawn" behaves the same on every OS and does not copy the loaded model
+                context = multiprocessing.get_context("spawn")
+                self._pool = context.Pool(
+                    processes=self.workers,
+                    initializer=tool_worker.init_worker,
+                    initargs=(self._tool_paths(), self.memory_limit_mb),
+                )
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    # A timed out tool keeps running in its worker, the only way to stop it is to replace the pool.
+    # Other calls still running in the old pool will time out too.
+    def _restart(self, pool):
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        pool.terminate()
+
+    def _record(self, name: str, result: dict, start: float) -> dict:
+        elapsed = time.perf_counter() - start
+        result["elapsed"] = elapsed
+        with self._lock:
+            stats = self._stats.setdefault(
+                name,
+                dict(
+                    calls=0,
+                    cache_hits=0,
+                    errors=0,
+                    timeouts=0,
+                    total_ms=0.0,
+                    max_ms=0.0,
+                ),
+            )
+            stats["calls"] += 1
+            if result.get("cached"):
+                stats["cache_hits"] += 1
+            stats["total_ms"] += elapsed * 1000
+            stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+            if not result["success"]:
+                stats["errors"] += 1
+                if result["error"]["type"] == "timeout":
+                    stats["timeouts"] += 1
+        if not result["success"]:
+            print(f"Tool [{name}] failed: {result['error']['message']}", flush=True)
+        return result
+
+    def _timeout_error(self, timeout: float) -> dict:
+        return tool_error("timeout", f"Tool did not finish within {timeout}s.")
+
+    # Blocks the calling thread until the tool returns
+    def execute(
+        self,
+        tool_def: classes.ToolDefinition,
+        args: dict,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+        cache_key = self.cache.key(tool_def, args)
+        cached = self.cache.get(cache_key)
+        if cached:
+            return self._record(tool_def["name"], {**cached, "cached": True}, start)
+        pool = None
+        try:
+            if remote_tools.is_url(tool_def["path"]):
+                client = remote_tools.get_client()
+                result = client.call(tool_def["path"], args, timeout)
+            else:
+                path = tool_registry.find_function_path(tool_def["path"])
+                pool = self.start()
+                pending = pool.apply_async(tool_worker.run_tool, (path, args))
+                result = pending.get(timeout)
+        except (multiprocessing.TimeoutError, TimeoutError):
+            if pool:
+                self._restart(pool)
+            result = self._timeout_error(timeout)
+        except Exception as err:
+            result = tool_error("exception", f"{err}")
+        self.cache.set(cache_key, tool_def, result)
+        return self._record(tool_def["name"], result, start)
+
+    # Same as execute() but awaits the result without blocking the event loop
+    async def execute_async(
+        self,
+        tool_def: classes.ToolDefinition,
+        args: dict,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        timeout = timeout or self.timeout
+        start = time.perf_counter()
+        cache_key = self.cache.key(tool_def, args)
+        cached = self.cache.get(cache_key)
+        if cached:
+            return self._record(tool_def["name"], {**cached, "cached": True}, start)
+        if remote_tools.is_url(tool_def["path"]):
+            try:
+                client = remote_tools.get_client()
+                result = await client.call_async(tool_def["path"], args, timeout)
+            except asyncio.TimeoutError:
+                result = self._timeout_error(timeout)
+            self.cache.set(cache_key, tool_def, result)
+            return self._record(tool_def["name"], result, start)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result: dict):
+            if not future.done():
+                future.set_result(result)
+
+        pool = None
+        try:
+            path = tool_registry.find_function_path(tool_def["path"])
+            pool = self.start()
+            # Callbacks run on the pool's result thread
+            pool.apply_async(
+                tool_worker.run_tool,
+                (path, args),
+                callback=lambda res: loop.call_soon_threadsafe(resolve, res),
+                error_callback=lambda err: loop.call_soon_threadsafe(
+                    resolve, tool_error("exception", f"{err}")
+                ),
+            )
+            result = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._restart(pool)
+            result = self._timeout_error(timeout)
+        except Exception as err:
+            result = tool_error("exception", f"{err}")
+        self.cache.set(cache_key, tool_def, result)
+        return self._record(tool_def["name"], result, start)
+
+    def stats(self) -> dict:
+        with self._lock:
+            tools = {
+                name: {
+                    **stats,
+                    "avg_ms": stats["total_ms"] / stats["calls"],
+                }
+                for name, stats in self._stats.items()
+            }
+        return {"tools": tools, "cache": self.cache.stats()}
+
+
+_executor: Optional[ToolExecutor] = None
+_executor_lock = Lock()
+
+
+# Created on first use so settings from .env are loaded by then
+def get_executor() -> ToolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ToolExecutor(
+                workers=int(os.getenv("TOOL_WORKERS", DEFAULT_TOOL_WORKERS)),
+                timeout=float(
+                    os.getenv("TOOL_TIMEOUT_SECS", DEFAULT_TOOL_TIMEOUT_SECS)
+                ),
+                memory_limit_mb=int(
+                    os.getenv("TOOL_MEMORY_LIMIT_MB", DEFAULT_TOOL_MEMORY_LIMIT_MB)
+                ),
+                cache=ToolResultCache(
+                    max_size=int(os.getenv("TOOL_CACHE_SIZE", DEFAULT_TOOL_CACHE_SIZE)),
+                ),
+            )
+        return _executor
+
+
+def shutdown():
+    with _executor_lock:
+        executor = _executor
+    if executor:
+        executor.shutdown()
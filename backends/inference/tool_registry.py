@@ -0,0 +1,143 @@
+###
+# In-memory index of tool definitions (tools/defs/*.json) and their compiled code modules.
+# Lookups are served from memory. Files are only re-checked (by mtime) every few seconds,
+# and saving/deleting a tool through the api invalidates the index immediately.
+###
+import os
+import time
+import importlib.util
+from threading import RLock
+from typing import List, Optional
+from core import classes, common
+
+REFRESH_INTERVAL_SECS = 5.0
+PARAMS_MODEL_NAME = "Params"  # Required name of the pydantic model in a tool's code
+
+
+# Prebuilt funcs are checked first, then custom user funcs
+def find_function_path(filename: str) -> str:
+    prebuilt_funcs_path = common.dep_path(
+        os.path.join(common.TOOL_PREBUILT_PATH, filename)
+    )
+    custom_funcs_path = os.path.join(common.TOOL_FUNCS_PATH, filename)
+    for path in [prebuilt_funcs_path, custom_funcs_path]:
+        if os.path.isfile(path):
+            return path
+    raise Exception("No path/function found.")
+
+
+# Load the code module and pydantic model for the tool
+# file name and function name must be the same!
+def compile_function_file(filename: str, path: str) -> dict:
+    func_name = os.path.splitext(filename)[0]
+    spec = importlib.util.spec_from_file_location(name=filename, location=path)
+    if not spec:
+        raise Exception("No tool found.")
+    tool_code = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tool_code)
+    tool_func = getattr(tool_code, func_name)
+    pydantic_model = getattr(tool_code, PARAMS_MODEL_NAME)
+    return {
+        "func": tool_func,
+        "model": pydantic_model.model_json_schema(),
+        "params": pydantic_model,
+    }
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+class ToolRegistry:
+    def __init__(self, refresh_interval: float = REFRESH_INTERVAL_SECS):
+        self.refresh_interval = refresh_interval
+        self._lock = RLock()
+        self._by_name: dict[str, classes.ToolDefinition] = {}
+        self._by_id: dict[str, classes.ToolDefinition] = {}
+        self._defs_signature = None
+        self._defs_checked_at = 0.0
+        # filename -> {"func", "model", "params", "path", "mtime", "checked_at"}
+        self._modules: dict[str, dict] = {}
+
+    # Snapshot of the defs folder, changes when a file is added, removed or edited
+    def _read_defs_signature(self):
+        folderpath = common.TOOL_DEFS_PATH
+        if not os.path.isdir(folderpath):
+            return ()
+        return tuple(
+            sorted(
+                (name, _mtime(os.path.join(folderpath, name)))
+                for name in os.listdir(folderpath)
+                if name.endswith(".json")
+            )
+        )
+
+    def _load_definitions(self):
+        tools = common.store_tool_definition(
+            operation="r",
+            folderpath=common.TOOL_DEFS_PATH,
+        )
+        self._by_name = {tool["name"]: tool for tool in tools if tool.get("name")}
+        self._by_id = {tool["id"]: tool for tool in tools if tool.get("id")}
+
+    def _refresh_definitions(self):
+        now = time.monotonic()
+        if (
+            self._defs_signature is not None
+            and now - self._defs_checked_at < self.refresh_interval
+        ):
+            return
+        self._defs_checked_at = now
+        signature = self._read_defs_signature()
+        if signature != self._defs_signature:
+            self._load_definitions()
+            self._defs_signature = signature
+
+    # Force a reload on next access (after a tool is saved or deleted)
+    def invalidate(self):
+        with self._lock:
+            self._defs_signature = None
+            self._modules = {}
+
+    def definitions(self) -> List[classes.ToolDefinition]:
+        with self._lock:
+            self._refresh_definitions()
+            return list(self._by_name.values())
+
+    def get(self, name: str) -> Optional[classes.ToolDefinition]:
+        with self._lock:
+            self._refresh_definitions()
+            return self._by_name.get(name)
+
+    def get_by_id(self, id: str) -> Optional[classes.ToolDefinition]:
+        with self._lock:
+            self._refresh_definitions()
+            return self._by_id.get(id)
+
+    # Compiled code for a tool, re-executed only when its source file changes
+    def get_module(self, filename: str) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            module = self._modules.get(filename)
+            if module and now - module["checked_at"] < self.refresh_interval:
+                return module
+            if module and _mtime(module["path"]) == module["mtime"]:
+                module["checked_at"] = now
+                return module
+            path = find_function_path(filename)
+            mtime = _mtime(path)
+            module = {
+                **compile_function_file(filename, path),
+                "path": path,
+                "mtime": mtime,
+                "checked_at": now,
+            }
+            self._modules[filename] = module
+            return module
+
+
+# Shared by all requests
+registry = ToolRegistry()
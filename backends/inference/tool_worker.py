@@ -0,0 +1,66 @@
+###
+# Code that runs inside the tool pool's worker processes.
+# Keep imports light, this module is loaded by every worker.
+###
+import os
+import importlib.util
+
+# path -> (mtime, func)
+_tool_funcs = {}
+
+
+# Set a memory limit (POSIX only) and compile the tools ahead of the first call
+def init_worker(paths: list, memory_limit_mb: int):
+    if memory_limit_mb:
+        try:
+            import resource
+
+            # Address space already in use by the interpreter is added to the budget
+            with open("/proc/self/statm", "r") as file:
+                page_size = os.sysconf("SC_PAGE_SIZE")
+                in_use = int(file.read().split()[0]) * page_size
+            limit = in_use + memory_limit_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, OSError, ValueError):
+            # Not supported on this OS (ie Windows)
+            pass
+    for path in paths:
+        try:
+            load_tool_func(path)
+        except Exception as err:
+            print(f"Failed to preload tool {path}: {err}", flush=True)
+
+
+# File name and function name must be the same!
+def load_tool_func(path: str):
+    mtime = os.path.getmtime(path)
+    cached = _tool_funcs.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    filename = os.path.basename(path)
+    func_name = os.path.splitext(filename)[0]
+    spec = importlib.util.spec_from_file_location(name=filename, location=path)
+    tool_code = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tool_code)
+    func = getattr(tool_code, func_name)
+    _tool_funcs[path] = (mtime, func)
+    return func
+
+
+# Errors are returned as data since tool exceptions may not be picklable
+def run_tool(path: str, args: dict) -> dict:
+    try:
+        result = load_tool_func(path)(args)
+        return {"success": True, "result": result, "error": None}
+    except MemoryError:
+        return {
+            "success": False,
+            "result": None,
+            "error": {"type": "memory", "message": "Tool exceeded its memory limit."},
+        }
+    except Exception as err:
+        return {
+            "success": False,
+            "result": None,
+            "error": {"type": "exception", "message": f"{type(err).__name__}: {err}"},
+        }
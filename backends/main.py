@@ -2,12 +2,11 @@ import os
 import sys
 import socket
 import signal
+import multiprocessing
 from dotenv import load_dotenv
 
-# Custom
-from ui.view import WEBVIEW
-from ui.api_ui import Api
-from core import common
+# The tool worker processes (spawn) import this file too, as __mp_main__. Only stdlib modules are
+# imported here so they stay light, the app's modules are imported at the bottom of this file.
 
 
 ###############
@@ -42,17 +41,20 @@ def parse_runtime_args():
     }
 
 
-# Path to the .env file in either the parent or /_deps directory
-try:
-    # Look in app's _deps dir
-    if sys._MEIPASS:
-        env_path = common.dep_path(".env")
-except Exception:
-    # Otherwise look in codebase root dir
-    current_directory = os.path.dirname(os.path.abspath(__file__))
-    parent_directory = os.path.dirname(current_directory)
-    env_path = os.path.join(parent_directory, ".env")
-load_dotenv(env_path)
+# Load the .env file from either the parent or /_deps directory
+def load_env():
+    try:
+        # Look in app's _deps dir
+        if sys._MEIPASS:
+            env_path = common.dep_path(".env")
+    except Exception:
+        # Otherwise look in codebase root dir
+        current_directory = os.path.dirname(os.path.abspath(__file__))
+        parent_directory = os.path.dirname(current_directory)
+        env_path = os.path.join(parent_directory, ".env")
+    # The tool worker processes inherit these
+    load_dotenv(env_path)
+
 
 # Check what env is running - prod/dev
 build_env = parse_runtime_args()
@@ -66,12 +68,6 @@ is_dev = build_env["mode"] == "dev" or is_debug
 is_prod = build_env["mode"] == "prod" or not is_dev
 webui_url = "https://studio.openbrewai.com"
 
-# Comment out if you want to debug on prod build (or set --mode=prod flag in command)
-if is_prod:
-    # Remove prints in prod when deploying in window mode
-    sys.stdout = open(os.devnull, "w")
-    sys.stderr = open(os.devnull, "w")
-
 ###############
 ### Methods ###
 ###############
@@ -161,5 +157,20 @@ def main():
 
 # This script is the loader for the rest of the backend. It only handles UI and starting dependencies.
 if __name__ == "__main__":
+    # Required by the tool worker processes in a frozen (PyInstaller) build
+    multiprocessing.freeze_support()
+    # Custom
+    from core import common
+
+    # Before the app's modules, some read settings when imported
+    load_env()
+    from ui.view import WEBVIEW
+    from ui.api_ui import Api
+
+    # Comment out if you want to debug on prod build (or set --mode=prod flag in command)
+    if is_prod:
+        # Remove prints in prod when deploying in window mode
+        sys.stdout = open(os.devnull, "w")
+        sys.stderr = open(os.devnull, "w")
     print(f"{common.PRNT_APP} Starting app...", flush=True)
     main()
@@ -1,9 +1,9 @@
 import os
 import glob
 import json
-from fastapi import APIRouter, Depends
-from core import classes, common
-from inference import agent
+from fastapi import APIRouter, Depends, Request
+from core import classes, common, settings_store
+from inference import agent, compaction, tool_executor, tool_registry
 from storage import classes as storage_classes
 from nanoid import generate as uuid
 
@@ -51,11 +51,12 @@ def save_tool_definition(
             id = tool_def.id
         else:
             id = uuid()
-        # Paths - @TODO Check for url or filename and handle accordingly
-        # For urls, make call to endpoint.json to fetch descr, args, example
+        # Paths - For urls, descr, args and example are read from the tool's endpoint.json
         file_name = f"{id}.json"
         file_path = os.path.join(common.TOOL_DEFS_PATH, file_name)
-        # Create arguments and example response for llm prompt from pydantic model
+        # Create arguments and example response for llm prompt from pydantic model.
+        # Drop cached code first in case the tool's file was edited.
+        tool_registry.registry.invalidate()
         tool_def = agent.create_tool_args(tool_def=tool_def)
         # Save tool to file
         common.store_tool_definition(
@@ -64,6 +65,9 @@ def save_tool_definition(
             filepath=file_path,
             data={**tool_def, "id": id},
         )
+        tool_registry.registry.invalidate()
+        # Results of the old code or settings must not be reused
+        tool_executor.get_executor().cache.clear()
     except Exception as err:
         return {
             "success": False,
@@ -82,11 +86,8 @@ def save_tool_definition(
 @router.get("/tool-settings")
 def get_all_tool_definitions() -> classes.GetToolSettingsResponse:
     try:
-        # Load tools from file
-        tools = common.store_tool_definition(
-            operation="r",
-            folderpath=common.TOOL_DEFS_PATH,
-        )
+        # Load tools from the in-memory registry
+        tools = tool_registry.registry.definitions()
         numTools = len(tools)
     except Exception as err:
         return {
@@ -111,6 +112,8 @@ def delete_tool_definition_by_id(id: str) -> classes.EmptyToolSettingsResponse:
         folderpath=common.TOOL_DEFS_PATH,
         id=id,
     )
+    tool_registry.registry.invalidate()
+    tool_executor.get_executor().cache.clear()
 
     return {
         "success": True,
@@ -140,41 +143,24 @@ def save_bot_settings(settings: dict) -> classes.BotSettingsResponse:
 # Delete bot settings
 @router.delete("/bot-settings")
 def delete_bot_settings(name: str) -> classes.BotSettingsResponse:
-    new_settings = []
     # Paths
-    base_path = common.APP_SETTINGS_PATH
     file_name = BOT_SETTINGS_FILE_NAME
-    file_path = os.path.join(base_path, file_name)
-    try:
-        # Try to open the file (if it exists)
-        if os.path.exists(base_path):
-            prev_settings = None
-            with open(file_path, "r") as file:
-                prev_settings = json.load(file)
-                for setting in prev_settings:
-                    if name == setting.get("model").get("botName"):
-                        # Delete setting dict
-                        del_index = prev_settings.index(setting)
-                        del prev_settings[del_index]
-                        # Save new settings
-                        new_settings = prev_settings
-                        break
-            # Save new settings to file
-            with open(file_path, "w") as file:
-                if new_settings is not None:
-                    json.dump(new_settings, file, indent=2)
-    except FileNotFoundError:
-        return {
-            "success": False,
-            "message": "Failed to delete bot setting. File does not exist.",
-            "data": None,
-        }
-    except json.JSONDecodeError:
+    file_path = os.path.join(common.APP_SETTINGS_PATH, file_name)
+    store = settings_store.get_store(file_path)
+    if store.read() is None:
         return {
             "success": False,
-            "message": "Failed to delete bot setting. Invalid JSON format or empty file.",
+            "message": "Failed to delete bot setting. File does not exist or has invalid JSON.",
             "data": None,
         }
+    # Delete setting dict and save new settings
+    new_settings = store.update(
+        lambda prev_settings: [
+            setting
+            for setting in prev_settings
+            if name != setting.get("model").get("botName")
+        ]
+    )
 
     msg = "Removed bot setting."
     print(f"{common.PRNT_API} {msg}")
@@ -200,22 +186,13 @@ def get_bot_settings() -> classes.BotSettingsResponse:
             "data": [],
         }
 
-    # Try to open the file (if it exists)
-    loaded_data = []
-    try:
-        with open(file_path, "r") as file:
-            loaded_data = json.load(file)
-    except FileNotFoundError:
+    # Served from memory after the first read
+    loaded_data = settings_store.get_store(file_path).read()
+    if loaded_data is None:
         # If the file doesn't exist, return empty
         return {
             "success": False,
-            "message": "Failed to return settings. File does not exist.",
-            "data": [],
-        }
-    except json.JSONDecodeError:
-        return {
-            "success": False,
-            "message": "Invalid JSON format or empty file.",
+            "message": "Failed to return settings. File does not exist or has invalid JSON.",
             "data": [],
         }
 
@@ -231,7 +208,7 @@ def get_bot_settings() -> classes.BotSettingsResponse:
 async def get_chat_thread(
     params: storage_classes.GetChatThreadRequest = Depends(),
 ) -> storage_classes.GetChatThreadResponse:
-    folder_path = common.app_path("threads")
+    folder_path = common.THREADS_PATH
     threadId = params.threadId
     file_name = f"{threadId}.json"
     file_path = os.path.join(folder_path, file_name)
@@ -281,17 +258,28 @@ async def get_chat_thread(
 
 # Save chat thread
 @router.post("/chat-thread")
-async def save_chat_thread(params: storage_classes.SaveChatThreadRequest):
+async def save_chat_thread(
+    request: Request, params: storage_classes.SaveChatThreadRequest
+):
     thread_id = params.threadId
     thread = params.thread
     # Path
-    folder_path = common.app_path("threads")
+    folder_path = common.THREADS_PATH
     file_name = f"{thread_id}.json"
     file_path = os.path.join(folder_path, file_name)
     # Create folder/file
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
     try:
+        # Keep the summary of older turns, clients do not send it back.
+        # It is dropped when the summarized turns were edited or removed.
+        key = compaction.COMPACTION_KEY
+        if key not in thread:
+            prev_thread = compaction.read_thread(thread_id) or {}
+            if compaction.is_current(
+                prev_thread.get(key), thread.get("messages") or []
+            ):
+                thread[key] = prev_thread[key]
         # Save the data to the file, this will overwrite all values
         with open(file_path, "w") as file:
             json.dump(thread, file, indent=2)
@@ -301,6 +289,8 @@ async def save_chat_thread(params: storage_classes.SaveChatThreadRequest):
             "message": f"Failed to save chat thread to {file_path} \n{err}",
             "data": None,
         }
+    # Summarize older turns in the background once the thread is long
+    compaction.compactor.schedule(request.app, thread_id)
 
     return {
         "success": True,
@@ -315,7 +305,7 @@ async def delete_chat_thread(
     params: storage_classes.DeleteChatThreadRequest = Depends(),
 ):
     thread_id = params.threadId
-    folder_path = common.app_path("threads")
+    folder_path = common.THREADS_PATH
     if not os.path.exists(folder_path):
         raise Exception("Folder does not exist")
     try:
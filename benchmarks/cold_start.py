@@ -0,0 +1,192 @@
+###
+# Cold start benchmark: time to first token of the first request after a model load, for each
+# model load policy (lazy, prefetch, mlock). Run it on the machine that runs the server, it drops
+# the model file from the page cache (posix_fadvise) before every load:
+#   python ./benchmarks/cold_start.py --model-path=/models/llama-2-7b.Q4_K_M.gguf --runs=3
+###
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from typing import List
+import httpx
+
+DEFAULT_URL = "http://localhost:8008"
+DEFAULT_POLICIES = "lazy,prefetch,mlock"
+PROMPT = "Why is the sky blue?"
+
+
+# Helpers
+
+
+# Drop the file's cached pages, only works for pages no process has mapped
+def evict_page_cache(path: str) -> bool:
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+async def load_model(client: httpx.AsyncClient, args, policy: str) -> float:
+    payload = {
+        "modelPath": args.model_path,
+        "modelId": args.model_id or os.path.basename(args.model_path),
+        "mode": "instruct",
+        "backend": "llama_cpp",
+        "init": {
+            "n_ctx": args.n_ctx,
+            "n_gpu_layers": args.n_gpu_layers,
+            "use_mmap": True,
+            "load_policy": policy,
+        },
+        "call": {"max_tokens": args.max_tokens},
+    }
+    start = time.perf_counter()
+    res = await client.post("/v1/text/load", json=payload, timeout=None)
+    res.raise_for_status()
+    body = res.json()
+    if not body.get("success"):
+        raise Exception(body.get("message"))
+    return time.perf_counter() - start
+
+
+async def unload_model(client: httpx.AsyncClient):
+    res = await client.post("/v1/text/unload")
+    res.raise_for_status()
+
+
+async def prefetch_status(client: httpx.AsyncClient) -> dict:
+    res = await client.get("/v1/text/prefetchStats")
+    res.raise_for_status()
+    return res.json()["data"]
+
+
+async def wait_for_prefetch(client: httpx.AsyncClient):
+    while (await prefetch_status(client))["status"] == "running":
+        await asyncio.sleep(0.1)
+
+
+# Seconds until the first streamed token
+async def time_to_first_token(client: httpx.AsyncClient, args) -> float:
+    payload = {
+        "prompt": PROMPT,
+        "mode": "instruct",
+        "stream": True,
+        "max_tokens": args.max_tokens,
+    }
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", "/v1/text/inference", json=payload) as res:
+        res.raise_for_status()
+        async for line in res.aiter_lines():
+            if ttft is None and line.startswith("data:"):
+                ttft = time.perf_counter() - start
+    return ttft if ttft is not None else time.perf_counter() - start
+
+
+# Run
+
+
+async def run_policy(client: httpx.AsyncClient, args, policy: str) -> dict:
+    samples = []
+    for _ in range(args.runs):
+        evicted = not args.no_evict and evict_page_cache(args.model_path)
+        load_secs = await load_model(client, args, policy)
+        # Time the user takes to write the first message
+        await asyncio.sleep(args.idle)
+        if args.wait_prefetch:
+            await wait_for_prefetch(client)
+        prefetch = await prefetch_status(client)
+        cold_ttft = await time_to_first_token(client, args)
+        warm_ttft = await time_to_first_token(client, args)
+        await unload_model(client)
+        samples.append(
+            {
+                "evicted": evicted,
+                "load": load_secs,
+                "cold_ttft": cold_ttft,
+                "warm_ttft": warm_ttft,
+                "prefetched_percent": prefetch.get("percent", 0.0),
+            }
+        )
+    return {
+        "runs": samples,
+        "load": statistics.median([s["load"] for s in samples]),
+        "cold_ttft": statistics.median([s["cold_ttft"] for s in samples]),
+        "warm_ttft": statistics.median([s["warm_ttft"] for s in samples]),
+        "evicted": all(s["evicted"] for s in samples),
+    }
+
+
+def print_report(results: dict):
+    header = (
+        f"{'policy':<10}{'load':>9}{'ttft cold':>11}{'ttft warm':>11}{'load+ttft':>11}"
+    )
+    print(header)
+    print("-" * len(header))
+    for policy, r in results.items():
+        print(
+            f"{policy:<10}{r['load']:>9.2f}{r['cold_ttft']:>11.3f}{r['warm_ttft']:>11.3f}"
+            f"{r['load'] + r['cold_ttft']:>11.2f}"
+        )
+    if not all(r["evicted"] for r in results.values()):
+        print("note: the page cache was not dropped, cold numbers may be warm")
+
+
+async def main(args):
+    if not os.path.isfile(args.model_path):
+        raise Exception(f"No model file found at [{args.model_path}]")
+    policies = [item.strip() for item in args.policies.split(",") if item.strip()]
+    results = {}
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=httpx.Timeout(args.timeout), verify=not args.insecure
+    ) as client:
+        for policy in policies:
+            print(f"Benchmarking load policy [{policy}]...", flush=True)
+            results[policy] = await run_policy(client, args, policy)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Obrew model cold start benchmark")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--model-path", required=True, help="GGUF file on this machine")
+    parser.add_argument("--model-id", default=None)
+    parser.add_argument("--policies", default=DEFAULT_POLICIES, help="policy,...")
+    parser.add_argument("--runs", type=int, default=3, help="loads per policy")
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=0.0,
+        help="seconds between the load and the first request",
+    )
+    parser.add_argument(
+        "--wait-prefetch",
+        action="store_true",
+        help="send the first request once the prefetch is done",
+    )
+    parser.add_argument(
+        "--no-evict", action="store_true", help="keep the model in the page cache"
+    )
+    parser.add_argument("--max-tokens", type=int, default=16)
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--insecure", action="store_true", help="skip SSL verify")
+    parser.add_argument("--output", default=None, help="write results to a json file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))
@@ -0,0 +1,319 @@
+###
+# Load generator that replays a weighted mix of requests against a running Obrew server.
+# Run the server first (with a real model or the "fake" text backend), then:
+#   python ./benchmarks/load_test.py --backend=fake --mix=chat:4,instruct:2,rag:2,ingest:1,thread:1
+###
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Callable, Dict, List
+import httpx
+
+DEFAULT_URL = "http://localhost:8008"
+DEFAULT_MIX = "chat:4,instruct:2,rag:2,ingest:1,thread:1"
+DEFAULT_COLLECTION = "loadtest"
+PROMPTS = [
+    "Why is the sky blue?",
+    "Summarize the plot of a detective story in three sentences.",
+    "What is the capital of France and what is it known for?",
+    "Explain how a hash map works.",
+    "List five uses for a paperclip.",
+]
+RAG_TEMPLATE = {
+    "id": "loadtest",
+    "name": "Load test",
+    "text": "Context:\n{context_str}\nAnswer the question: {query_str}\n",
+}
+DOCUMENT_TEXT = (
+    "# Load test document\n\n"
+    "The Obrew server stores memories in collections. "
+    "Each memory is split into chunks and embedded into a vector database.\n"
+)
+
+
+class Sample(dict):
+    name: str
+    latency: float  # seconds until the response completed
+    ttft: float  # seconds until the first streamed event (or full response)
+    ok: bool
+
+
+# Helpers
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition(":")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario [{name}]. Use one of {list(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def inference_payload(prompt: str, mode: str, stream: bool, max_tokens: int):
+    return {
+        "prompt": prompt,
+        "mode": mode,
+        "stream": stream,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": prompt}],
+    }
+
+
+async def consume_stream(client: httpx.AsyncClient, url: str, payload: dict):
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", url, json=payload) as res:
+        res.raise_for_status()
+        async for line in res.aiter_lines():
+            if ttft is None and line.startswith("data:"):
+                ttft = time.perf_counter() - start
+    return ttft
+
+
+# Scenarios, each returns the time to first token (or None if not streamed)
+
+
+async def run_chat(client: httpx.AsyncClient, args, rng: random.Random):
+    payload = inference_payload(rng.choice(PROMPTS), "chat", True, args.max_tokens)
+    return await consume_stream(client, "/v1/text/inference", payload)
+
+
+async def run_instruct(client: httpx.AsyncClient, args, rng: random.Random):
+    payload = inference_payload(
+        rng.choice(PROMPTS), "instruct", False, args.max_tokens
+    )
+    res = await client.post("/v1/text/inference", json=payload)
+    res.raise_for_status()
+
+
+async def run_rag(client: httpx.AsyncClient, args, rng: random.Random):
+    payload = inference_payload(rng.choice(PROMPTS), "instruct", True, args.max_tokens)
+    payload["retrievalType"] = "augmented"
+    payload["collectionNames"] = [args.collection]
+    payload["ragPromptTemplate"] = RAG_TEMPLATE
+    return await consume_stream(client, "/v1/text/inference", payload)
+
+
+async def run_ingest(client: httpx.AsyncClient, args, rng: random.Random):
+    params = {
+        "collectionName": args.collection,
+        "documentName": f"doc-{rng.randrange(1_000_000)}",
+        "textInput": DOCUMENT_TEXT,
+    }
+    res = await client.post("/v1/memory/addDocument", params=params)
+    res.raise_for_status()
+    if not res.json().get("success"):
+        raise Exception(res.json().get("message"))
+
+
+async def run_thread(client: httpx.AsyncClient, args, rng: random.Random):
+    thread_id = f"loadtest-{rng.randrange(args.threads)}"
+    prompt = rng.choice(PROMPTS)
+    thread = {
+        "id": thread_id,
+        "title": "Load test thread",
+        "messages": [
+            {"id": f"{thread_id}-0", "role": "user", "content": prompt, "order": 0}
+        ],
+    }
+    res = await client.post(
+        "/v1/persist/chat-thread", json={"threadId": thread_id, "thread": thread}
+    )
+    res.raise_for_status()
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "chat": run_chat,
+    "instruct": run_instruct,
+    "rag": run_rag,
+    "ingest": run_ingest,
+    "thread": run_thread,
+}
+
+
+# Setup
+
+
+async def load_model(client: httpx.AsyncClient, args):
+    payload = {
+        "modelPath": args.model_path or args.backend,
+        "modelId": args.model_id or args.backend,
+        "mode": "instruct",
+        "backend": args.backend,
+        "init": {"n_ctx": args.n_ctx},
+        "call": {"max_tokens": args.max_tokens},
+    }
+    res = await client.post("/v1/text/load", json=payload, timeout=None)
+    res.raise_for_status()
+    body = res.json()
+    if not body.get("success"):
+        raise Exception(body.get("message"))
+    print(f"Loaded model: {body.get('message')}", flush=True)
+
+
+async def create_collection(client: httpx.AsyncClient, args):
+    params = {"collectionName": args.collection, "description": "Load test memories"}
+    # Fails harmlessly if the collection already exists
+    await client.get("/v1/memory/addCollection", params=params)
+    rng = random.Random(args.seed)
+    await run_ingest(client, args, rng)
+
+
+# Run
+
+
+async def worker(
+    client: httpx.AsyncClient,
+    args,
+    weights: Dict[str, float],
+    rng: random.Random,
+    deadline: float,
+    samples: List[Sample],
+):
+    names = list(weights.keys())
+    probabilities = list(weights.values())
+    while time.perf_counter() < deadline:
+        if args.requests and len(samples) >= args.requests:
+            return
+        name = rng.choices(names, probabilities)[0]
+        start = time.perf_counter()
+        ok = True
+        ttft = None
+        try:
+            ttft = await SCENARIOS[name](client, args, rng)
+        except Exception as err:
+            ok = False
+            if args.verbose:
+                print(f"[{name}] {err}", flush=True)
+        latency = time.perf_counter() - start
+        samples.append(
+            Sample(name=name, latency=latency, ttft=ttft or latency, ok=ok)
+        )
+
+
+def report(samples: List[Sample], elapsed: float) -> dict:
+    results = {}
+    for name in sorted({s["name"] for s in samples}):
+        items = [s for s in samples if s["name"] == name]
+        latencies = [s["latency"] for s in items if s["ok"]]
+        ttfts = [s["ttft"] for s in items if s["ok"]]
+        errors = len([s for s in items if not s["ok"]])
+        results[name] = {
+            "requests": len(items),
+            "errors": errors,
+            "error_rate": errors / len(items),
+            "throughput": len(items) / elapsed,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "ttft_p50": percentile(ttfts, 50),
+            "ttft_p90": percentile(ttfts, 90),
+        }
+    errors = len([s for s in samples if not s["ok"]])
+    results["total"] = {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "throughput": len(samples) / elapsed,
+        "elapsed": elapsed,
+    }
+    return results
+
+
+def print_report(results: dict):
+    header = f"{'endpoint':<10}{'reqs':>7}{'err%':>8}{'req/s':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'ttft50':>9}{'ttft90':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        if name == "total":
+            continue
+        print(
+            f"{name:<10}{r['requests']:>7}{r['error_rate'] * 100:>7.1f}%{r['throughput']:>8.2f}"
+            f"{r['p50']:>9.3f}{r['p90']:>9.3f}{r['p99']:>9.3f}{r['ttft_p50']:>9.3f}{r['ttft_p90']:>9.3f}"
+        )
+    total = results["total"]
+    print("-" * len(header))
+    print(
+        f"total: {total['requests']} requests in {total['elapsed']:.1f}s, "
+        f"{total['throughput']:.2f} req/s, {total['error_rate'] * 100:.1f}% errors"
+    )
+
+
+async def main(args):
+    weights = parse_mix(args.mix)
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=timeout, limits=limits, verify=not args.insecure
+    ) as client:
+        if args.backend:
+            await load_model(client, args)
+        if "rag" in weights or "ingest" in weights:
+            await create_collection(client, args)
+        samples: List[Sample] = []
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(
+            *[
+                worker(
+                    client,
+                    args,
+                    weights,
+                    random.Random(args.seed + i),
+                    deadline,
+                    samples,
+                )
+                for i in range(args.concurrency)
+            ]
+        )
+        elapsed = time.perf_counter() - start
+    results = report(samples, elapsed)
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def parse_args(argv: List[str]):
+    parser = argparse.ArgumentParser(description="Obrew server load test")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="name:weight,...")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--requests", type=int, default=0, help="0 means no limit")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--n-ctx", type=int, default=2048)
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION)
+    parser.add_argument("--threads", type=int, default=20, help="distinct chat threads")
+    parser.add_argument(
+        "--backend",
+        default=None,
+        help="load a model before the run, ie 'fake' or 'llama_cpp' (needs --model-path)",
+    )
+    parser.add_argument("--model-path", default=None)
+    parser.add_argument("--model-id", default=None)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--insecure", action="store_true", help="skip SSL verify")
+    parser.add_argument("--output", default=None, help="write results to a json file")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args(sys.argv[1:])))